@@ -10,19 +10,93 @@ from routes.main import main_bp
 from routes.files import files_bp
 from routes.admin import admin_bp
 from routes.api import api_bp
-
-app = Flask(__name__)
+from routes.tus import tus_bp
+from routes.metrics import metrics_bp
+from routes.assets import assets_bp
+import storage
+from services.expiry import expiry_sweeper
+from services.deletion import unlink_queue
+from services.compression import cold_tier
+from services.access import access_counter
+from services.metrics import metrics_exporter
+from services.profiling import request_profiler
+from services.hashing import hash_backfill, hasher
+from services.quota import upload_task_expirer
+from services.listing_cache import listing_cache
+from services.public_listing import public_listing
+from services.assets import assets
+from services.text_preview import text_preview
+from services.archives import archive_inspector
+from services.metadata import metadata_extractor
+from services.form_upload import StreamingUploadRequest
+
+# 实例目录、数据库和上传目录可通过环境变量指定（基准测试等在临时目录中运行）
+app = Flask(__name__, instance_path=os.environ.get('INSTANCE_PATH'))
+app.request_class = StreamingUploadRequest  # 表单上传的文件可直接写入存储
 app.config['SECRET_KEY'] = 'your-secret-key-here'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///fileshare.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///fileshare.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['UPLOAD_FOLDER'] = 'uploads'
+app.config['UPLOAD_FOLDER'] = os.environ.get('UPLOAD_FOLDER', 'uploads')
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024 * 1024  # 16GB
+# 存储后端: local 为本地磁盘，s3 为 S3 兼容对象存储（需要安装 boto3，MinIO 等填写 S3_ENDPOINT_URL）
+app.config['STORAGE_BACKEND'] = os.environ.get('STORAGE_BACKEND', 'local')
+app.config['STORAGE_SHARD_DEPTH'] = 2  # 新文件按哈希分散到两级子目录，如 ab/cd/<文件名>
+app.config['S3_BUCKET'] = os.environ.get('S3_BUCKET')
+app.config['S3_PREFIX'] = os.environ.get('S3_PREFIX', '')
+app.config['S3_ENDPOINT_URL'] = os.environ.get('S3_ENDPOINT_URL')
+app.config['S3_REGION'] = os.environ.get('S3_REGION')
+app.config['S3_ACCESS_KEY'] = os.environ.get('S3_ACCESS_KEY')
+app.config['S3_SECRET_KEY'] = os.environ.get('S3_SECRET_KEY')
+app.config['EXPIRY_SWEEP_INTERVAL'] = 60  # 过期文件清理间隔(秒)
+app.config['EXPIRY_SWEEP_BATCH_SIZE'] = 500  # 每批清理的文件数
+app.config['EXPIRY_SWEEP_WORKERS'] = 4  # 删除文件的线程数
+app.config['UNLINK_QUEUE_INTERVAL'] = 5  # 待删除文件队列轮询间隔(秒)
+app.config['UNLINK_QUEUE_MAX_ATTEMPTS'] = 10  # 磁盘文件删除最大重试次数
+app.config['COLD_TIER_AFTER_DAYS'] = 7  # 超过多少天未访问的文件压缩存储
+app.config['COLD_TIER_CODEC'] = 'zstd'  # 未安装 zstandard 时自动使用 gzip
+app.config['ACCESS_COUNTER_INTERVAL'] = 30  # 访问计数写入数据库的间隔(秒)
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')  # /metrics 的访问令牌，未设置时只允许本机访问
+app.config['SLOW_REQUEST_THRESHOLD'] = 1.0  # 超过该耗时(秒)的请求记录耗时分解
+app.config['HASH_WORKERS'] = 4  # 批量计算文件哈希的线程数
+app.config['HASH_BACKFILL_INTERVAL'] = 300  # 为缺少哈希的文件（如刚完成的分块上传）计算哈希的间隔(秒)，上传完成时立即触发
+app.config['METADATA_EXTRACTOR_INTERVAL'] = 30  # 提取新文件元数据（类型、尺寸、时长、页数）的间隔(秒)，上传完成时立即触发
+app.config['METADATA_EXTRACTOR_WORKERS'] = 4  # 提取元数据的线程数
+app.config['UPLOAD_TASK_TTL_HOURS'] = 24  # 分块上传任务超过多少小时没有新分块即过期并释放配额
+app.config['FSCK_GRACE_SECONDS'] = 3600  # fsck 不把最近多少秒内写入的文件当作孤立文件（上传在提交数据库前就已写入存储）
+app.config['ASYNC_BUFFER_SIZE'] = 256 * 1024  # 异步服务模式（asgi.py）下每次读取并发送的响应体字节数
+app.config['ASYNC_THREADS'] = 32  # 异步服务模式下执行视图和读取文件的线程数，与并发下载数无关
+app.config['LISTING_CACHE_MAX_BYTES'] = 64 * 1024 * 1024  # 首页文件列表缓存占用的内存上限
+app.config['LISTING_CACHE_URL'] = os.environ.get('LISTING_CACHE_URL')  # 多进程部署时共享的 Redis，如 redis://localhost:6379/0
+app.config['PUBLIC_LISTING_PAGE_SIZE'] = 60  # 匿名首页每页显示的公开文件数
+app.config['PUBLIC_LISTING_CHECK_INTERVAL'] = 5  # 匿名首页快照检查文件列表变化的间隔(秒)，也是浏览器缓存的最长时间
+app.config['PUBLIC_LISTING_CACHED_PAGES'] = 20  # 匿名首页在内存中缓存的渲染好的分页数
+app.config['LINE_INDEX_STRIDE'] = 256  # 文本预览行索引每隔多少行记录一次字节偏移
+app.config['ARCHIVE_MAX_MEMBERS'] = 10000  # 压缩包内容最多列出的项数
+app.config['ASSET_IMAGE_WIDTHS'] = (640, 1280, 1920, 2560)  # 本地背景图片生成的缩小版本宽度（需要安装 Pillow）
+app.config['FILE_VERSIONS_KEEP'] = 20  # 每个文件保留的版本数，更早的版本及不再使用的数据块会被清理
+app.config['FILE_VERSIONS_MAX_SIZE'] = None  # 可以创建版本的最大文件字节数，None 不限制；有版本的文件约占两倍空间
 
 # 初始化扩展
 db.init_app(app)
 migrate = Migrate(app, db)
 login_manager = LoginManager(app)
 login_manager.login_view = 'auth.login'
+storage.init_app(app)
+hasher.init_app(app)
+hash_backfill.init_app(app)
+expiry_sweeper.init_app(app)
+unlink_queue.init_app(app)
+upload_task_expirer.init_app(app)
+cold_tier.init_app(app)
+access_counter.init_app(app)
+metrics_exporter.init_app(app)
+request_profiler.init_app(app)
+listing_cache.init_app(app)
+public_listing.init_app(app)
+assets.init_app(app)
+text_preview.init_app(app)
+archive_inspector.init_app(app)
+metadata_extractor.init_app(app)
 
 # 确保上传文件夹存在
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
@@ -33,6 +107,9 @@ app.register_blueprint(main_bp, url_prefix='')
 app.register_blueprint(files_bp, url_prefix='')
 app.register_blueprint(admin_bp, url_prefix='')
 app.register_blueprint(api_bp, url_prefix='/api')
+app.register_blueprint(tus_bp, url_prefix='/api/tus')
+app.register_blueprint(metrics_bp, url_prefix='')
+app.register_blueprint(assets_bp, url_prefix='')
 
 @login_manager.user_loader
 def load_user(user_id):
@@ -0,0 +1,9 @@
+"""
+ASGI 入口：以异步服务模式运行，慢速客户端的下载不占用工作线程
+    uvicorn asgi:application --host 0.0.0.0 --port 5000 --workers 4
+"""
+
+from app import app
+from services.async_server import create_asgi_app
+
+application = create_asgi_app(app)
@@ -0,0 +1,61 @@
+"""
+对比两次基准测试结果
+按 (测试名, 参数) 匹配两份 JSON 中的结果，输出中位耗时的变化；
+指定 --threshold 时，任一项变慢超过该比例则以状态码 1 退出，便于在 CI 中使用。
+
+用法:
+    python -m benchmarks.compare before.json after.json --threshold 0.1
+"""
+
+import argparse
+import json
+import sys
+
+
+def _load(path):
+    with open(path, encoding='utf-8') as f:
+        report = json.load(f)
+    return report, {
+        (result['name'], json.dumps(result['params'], sort_keys=True)): result
+        for result in report['results']
+    }
+
+
+def _format_params(params):
+    return ', '.join(f'{key}={value}' for key, value in sorted(json.loads(params).items()))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='对比两次基准测试结果')
+    parser.add_argument('baseline')
+    parser.add_argument('current')
+    parser.add_argument('--threshold', type=float, help='允许的最大变慢比例，如 0.1 表示 10%%')
+    args = parser.parse_args(argv)
+
+    baseline_report, baseline = _load(args.baseline)
+    current_report, current = _load(args.current)
+    print(f"基准: {baseline_report['environment'].get('commit')}  当前: {current_report['environment'].get('commit')}")
+    print(f"{'测试':<20} {'参数':<50} {'基准(ms)':>10} {'当前(ms)':>10} {'变化':>8}")
+
+    regressions = []
+    for key in sorted(set(baseline) | set(current)):
+        name, params = key
+        if key not in baseline or key not in current:
+            side = '仅当前' if key not in baseline else '仅基准'
+            print(f'{name:<20} {_format_params(params):<50} {side:>30}')
+            continue
+        before = baseline[key]['seconds']['median']
+        after = current[key]['seconds']['median']
+        change = (after - before) / before if before else 0.0
+        print(f'{name:<20} {_format_params(params):<50} {before * 1000:>10.1f} {after * 1000:>10.1f} {change:>+8.1%}')
+        if args.threshold is not None and change > args.threshold:
+            regressions.append(key)
+
+    if regressions:
+        print(f'\n{len(regressions)} 项变慢超过 {args.threshold:.0%}')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
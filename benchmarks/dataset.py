@@ -0,0 +1,20 @@
+"""
+基准测试用的合成数据
+只插入数据库记录，不在存储中创建文件；同一种子生成的数据完全相同，保证不同提交之间可比
+"""
+
+import random
+
+from services.seed import FileRowGenerator, seed_files
+from storage import get_storage
+
+
+def ensure_files(db, File, user_id, total, batch_size=20000, seed=0):
+    """保证 user_id 名下恰好有 total 条合成文件记录（只增不减），返回新插入的条数"""
+    existing = File.query.filter_by(user_id=user_id).count()
+    if existing >= total:
+        return 0
+    # 以已有条数作为种子的一部分，按规模逐级补齐时结果仍然确定；
+    # 不生成已过期的文件，避免运行期间被过期清理删除
+    generator = FileRowGenerator(random.Random(f'{seed}-{existing}'), get_storage(), expired_ratio=0)
+    return seed_files(generator, [user_id], total - existing, start=existing, batch_size=batch_size)
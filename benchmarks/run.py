@@ -0,0 +1,316 @@
+"""
+基准测试
+在临时目录中以进程内方式（Flask test client）运行应用，用合成数据测量：
+分块上传在不同分块大小和并发数下的吞吐、complete_upload 耗时随文件大小的变化、下载吞吐，
+以及不同文件数量下首页、文件管理页和统计页的耗时。
+结果为 JSON，可用 benchmarks/compare.py 对比两次提交的结果。
+
+用法:
+    python -m benchmarks.run --output before.json
+    python -m benchmarks.run --scales 1000,100000,1000000 --output full.json
+    python -m benchmarks.run --only download,listing
+    python -m benchmarks.compare before.json after.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MB = 1024 * 1024
+
+BENCHMARKS = ('chunked_upload', 'complete_upload', 'download', 'listing')
+PASSWORD = 'bench-password'
+
+
+def _int_list(value):
+    return [int(item) for item in value.split(',') if item]
+
+
+def summarize(samples):
+    ordered = sorted(samples)
+    return {
+        'runs': len(ordered),
+        'min': ordered[0],
+        'median': statistics.median(ordered),
+        'mean': statistics.fmean(ordered),
+        'p95': ordered[min(len(ordered) - 1, int(round(0.95 * (len(ordered) - 1))))],
+        'max': ordered[-1],
+    }
+
+
+def measure(fn, repeat, budget, warmup=1, setup=None):
+    """重复执行 fn 并计时；总耗时超过 budget 秒后提前停止（至少执行一次）。
+    setup 在每次计时前执行，返回值作为 fn 的参数，不计入耗时"""
+    for _ in range(warmup):
+        fn(setup() if setup else None)
+    samples = []
+    deadline = time.perf_counter() + budget
+    for _ in range(repeat):
+        arg = setup() if setup else None
+        start = time.perf_counter()
+        fn(arg)
+        samples.append(time.perf_counter() - start)
+        if time.perf_counter() > deadline:
+            break
+    return summarize(samples)
+
+
+def _git(*args):
+    try:
+        return subprocess.check_output(['git', *args], cwd=ROOT, stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment_info(args):
+    return {
+        'commit': _git('rev-parse', 'HEAD'),
+        'dirty': bool(_git('status', '--porcelain', '--untracked-files=no')),
+        'timestamp': datetime.utcnow().isoformat() + 'Z',
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'sqlite': sqlite3.sqlite_version,
+        'args': vars(args),
+    }
+
+
+class Bench:
+    """持有应用和已登录的测试客户端"""
+
+    def __init__(self, workdir):
+        # 必须在导入 app 之前设置，应用在导入时读取这些路径
+        os.environ['INSTANCE_PATH'] = os.path.join(workdir, 'instance')
+        os.environ['UPLOAD_FOLDER'] = os.path.join(workdir, 'uploads')
+        os.environ.pop('DATABASE_URL', None)
+        sys.path.insert(0, ROOT)
+
+        from app import app
+        from models import File, User, db
+
+        self.app, self.db, self.File, self.User = app, db, File, User
+        app.config['WTF_CSRF_ENABLED'] = False
+        app.config['SLOW_REQUEST_THRESHOLD'] = float('inf')
+        os.makedirs(app.instance_path, exist_ok=True)
+        os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+
+        with app.app_context():
+            db.create_all()
+            # admin 拥有列表测试用的合成文件，uploader 用于上传测试，不受默认配额限制
+            self.admin_id = self._create_user('bench_admin', 'admin')
+            self.uploader_id = self._create_user('bench_uploader', 'user')
+
+    def _create_user(self, username, role):
+        user = self.User(username=username, role=role, max_file_size=1 << 50,
+                         max_total_files=1 << 30, max_total_size=1 << 50)
+        user.set_password(PASSWORD)
+        self.db.session.add(user)
+        self.db.session.commit()
+        return user.id
+
+    def shutdown(self):
+        """写回缓冲的数据并停止后台任务，避免退出时再写入已删除的临时目录"""
+        from services.access import access_counter
+        from services.background import BackgroundWorker
+
+        access_counter.flush()
+        self.app.config['METRICS_ENABLED'] = False
+        for worker in self.app.extensions.values():
+            if isinstance(worker, BackgroundWorker):
+                worker.stop()
+
+    def client(self, username=None):
+        client = self.app.test_client()
+        if username:
+            response = client.post('/login', data={'username': username, 'password': PASSWORD})
+            if response.status_code != 302:
+                raise RuntimeError(f'登录失败: {username}')
+        return client
+
+    # ---- 分块上传 ----
+
+    def create_task(self, client, size, chunk_size):
+        response = client.post('/api/files/upload/create', json={
+            'hash': uuid.uuid4().hex * 2, 'file_name': f'bench_{uuid.uuid4().hex[:8]}.bin',
+            'file_size': size, 'content_type': 'application/octet-stream', 'chunk_size': chunk_size,
+            'share_type': 'public',
+        })
+        data = response.get_json()
+        if response.status_code != 200 or 'task_id' not in data:
+            raise RuntimeError(f'创建上传任务失败: {data}')
+        return data
+
+    def upload_chunks(self, clients, task, payload, pool):
+        chunk_size = task['chunk_size']
+
+        def send(index):
+            client = clients[index % len(clients)]
+            chunk = payload[index * chunk_size:(index + 1) * chunk_size]
+            response = client.post(f"/api/files/upload/chunk/{task['task_id']}/{index}", data=chunk,
+                                   content_type='application/octet-stream')
+            if response.status_code != 200:
+                raise RuntimeError(f'上传分块失败: {response.get_data(as_text=True)}')
+
+        list(pool.map(send, range(task['chunks_count'])))
+
+    def complete(self, client, task):
+        response = client.post(f"/api/files/upload/complete/{task['task_id']}")
+        if response.status_code != 200:
+            raise RuntimeError(f'完成上传失败: {response.get_data(as_text=True)}')
+        return response.get_json()['file_id']
+
+    def upload(self, clients, payload, chunk_size, pool):
+        task = self.create_task(clients[0], len(payload), chunk_size)
+        self.upload_chunks(clients, task, payload, pool)
+        return self.complete(clients[0], task)
+
+
+def bench_chunked_upload(bench, args):
+    results = []
+    payload = os.urandom(args.upload_size_mb * MB)
+    for concurrency in args.concurrency:
+        clients = [bench.client('bench_uploader') for _ in range(concurrency)]
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for chunk_size_mb in args.chunk_sizes_mb:
+                seconds = measure(lambda _: bench.upload(clients, payload, chunk_size_mb * MB, pool),
+                                  args.repeat, args.budget)
+                results.append({
+                    'name': 'chunked_upload',
+                    'params': {'file_size': len(payload), 'chunk_size': chunk_size_mb * MB, 'concurrency': concurrency},
+                    'seconds': seconds,
+                    'throughput_mb_s': len(payload) / MB / seconds['median'],
+                })
+    return results
+
+
+def bench_complete_upload(bench, args):
+    results = []
+    clients = [bench.client('bench_uploader')]
+    chunk_size = 5 * MB
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        for size_mb in args.complete_sizes_mb:
+            payload = os.urandom(size_mb * MB)
+
+            def prepare():
+                task = bench.create_task(clients[0], len(payload), chunk_size)
+                bench.upload_chunks(clients, task, payload, pool)
+                return task
+
+            seconds = measure(lambda task: bench.complete(clients[0], task), args.repeat, args.budget, setup=prepare)
+            results.append({'name': 'complete_upload', 'params': {'file_size': len(payload)}, 'seconds': seconds})
+    return results
+
+
+def bench_download(bench, args):
+    results = []
+    uploader = bench.client('bench_uploader')
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        for size_mb in args.download_sizes_mb:
+            payload = os.urandom(size_mb * MB)
+            file_id = bench.upload([uploader], payload, 5 * MB, pool)
+
+            def download(_):
+                response = uploader.get(f'/file/{file_id}')
+                if response.status_code != 200 or len(response.get_data()) != len(payload):
+                    raise RuntimeError(f'下载失败: {response.status_code}')
+
+            seconds = measure(download, args.repeat, args.budget)
+            results.append({
+                'name': 'download',
+                'params': {'file_size': len(payload)},
+                'seconds': seconds,
+                'throughput_mb_s': len(payload) / MB / seconds['median'],
+            })
+    return results
+
+
+def bench_listing(bench, args):
+    from benchmarks.dataset import ensure_files
+
+    results = []
+    admin = bench.client('bench_admin')
+    anonymous = bench.client()
+    pages = [
+        ('index_owner', admin, '/'),
+        ('index_anonymous', anonymous, '/'),
+        ('admin_files', admin, '/files'),
+        ('admin_statistics', admin, '/statistics'),
+    ]
+    for scale in sorted(args.scales):
+        with bench.app.app_context():
+            started = time.perf_counter()
+            inserted = ensure_files(bench.db, bench.File, bench.admin_id, scale)
+            seed_seconds = time.perf_counter() - started
+        print(f'  数据集: {scale} 个文件（新插入 {inserted} 条，用时 {seed_seconds:.1f} 秒）', file=sys.stderr)
+
+        for name, client, url in pages:
+            def request_page(_, client=client, url=url):
+                response = client.get(url)
+                if response.status_code != 200:
+                    raise RuntimeError(f'{url} 返回 {response.status_code}')
+                response.get_data()
+
+            seconds = measure(request_page, args.repeat, args.budget)
+            results.append({'name': name, 'params': {'files': scale}, 'seconds': seconds})
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='文件分享系统基准测试')
+    parser.add_argument('--output', help='结果 JSON 文件，默认输出到标准输出')
+    parser.add_argument('--only', help=f'只运行指定的测试，逗号分隔: {",".join(BENCHMARKS)}')
+    parser.add_argument('--scales', type=_int_list, default=[1000, 100000], help='列表测试的文件数量')
+    parser.add_argument('--upload-size-mb', type=int, default=32, help='分块上传测试的文件大小(MB)')
+    parser.add_argument('--chunk-sizes-mb', type=_int_list, default=[1, 5, 16], help='分块大小(MB)')
+    parser.add_argument('--concurrency', type=_int_list, default=[1, 4], help='并发上传分块的线程数')
+    parser.add_argument('--complete-sizes-mb', type=_int_list, default=[1, 16, 64], help='complete_upload 测试的文件大小(MB)')
+    parser.add_argument('--download-sizes-mb', type=_int_list, default=[1, 64], help='下载测试的文件大小(MB)')
+    parser.add_argument('--repeat', type=int, default=5, help='每项最多重复次数')
+    parser.add_argument('--budget', type=float, default=30, help='每项最多计时多少秒')
+    parser.add_argument('--workdir', help='数据目录，默认使用临时目录并在结束后删除')
+    args = parser.parse_args(argv)
+
+    selected = args.only.split(',') if args.only else list(BENCHMARKS)
+    unknown = set(selected) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f'未知的测试: {", ".join(sorted(unknown))}')
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='fileshare-bench-')
+    bench = None
+    try:
+        bench = Bench(workdir)
+        report = {'environment': environment_info(args), 'results': []}
+        # 上传和下载在空数据集上运行，列表测试最后运行并逐级扩大数据集
+        for name in BENCHMARKS:
+            if name not in selected:
+                continue
+            print(f'运行 {name} ...', file=sys.stderr)
+            report['results'].extend(globals()[f'bench_{name}'](bench, args))
+    finally:
+        if bench is not None:
+            bench.shutdown()
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
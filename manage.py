@@ -17,6 +17,8 @@ sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 from app import app, db
 from models import User, File, Config
+from services.deletion import delete_files, unlink_queue
+from storage import get_storage
 
 # 初始化迁移
 migrate_obj = Migrate(app, db)
@@ -109,20 +111,23 @@ def delete_user():
                 print("操作已取消")
                 return
 
-        # 删除用户的文件
-        files = File.query.filter_by(user_id=user.id).all()
-        for file in files:
-            try:
-                os.remove(file.filepath)
-                print(f"删除文件: {file.original_filename}")
-            except:
-                print(f"无法删除文件: {file.original_filename}")
-
-        # 删除数据库记录
-        File.query.filter_by(user_id=user.id).delete()
+        # 批量删除文件记录，再删除磁盘文件
+        result = delete_files(user_id=user.id, on_batch=_print_delete_progress)
         db.session.delete(user)
         db.session.commit()
-        print(f"用户 '{username}' 及其所有文件已删除")
+        _drain_unlink_queue()
+        print(f"用户 '{username}' 及其 {result['files']} 个文件已删除")
+
+def _print_delete_progress(progress):
+    print(f"已删除 {progress['files']} 条文件记录 ({progress['bytes'] / (1024*1024):.2f} MB)")
+
+def _drain_unlink_queue():
+    """命令行没有后台线程，直接处理待删除文件队列"""
+    done, failed = unlink_queue.drain(
+        on_batch=lambda done, failed: print(f"已删除 {done} 个磁盘文件，失败 {failed} 个")
+    )
+    if failed:
+        print(f"{failed} 个磁盘文件删除失败，已保留在队列中等待重试")
 
 def reset_password():
     """重置用户密码"""
@@ -154,10 +159,7 @@ def list_files():
         print(f"{'ID':<5} {'文件名':<30} {'用户':<15} {'大小(MB)':<10} {'公开':<6} {'上传时间':<20}")
         print("-" * 90)
         for file in files:
-            try:
-                size_mb = os.path.getsize(file.filepath) / (1024*1024)
-            except:
-                size_mb = 0
+            size_mb = file.get_size() / (1024*1024)
             public = "是" if file.is_public else "否"
             print(f"{file.id:<5} {file.original_filename[:28]:<30} {file.user.username:<15} "
                   f"{size_mb:<10.2f} {public:<6} "
@@ -171,26 +173,15 @@ def delete_file():
         print("文件ID不能为空")
         return
 
-    try:
-        file_id = int(file_id)
-    except:
-        print("文件ID必须是数字")
-        return
-
     with app.app_context():
         file = File.query.get(file_id)
         if not file:
             print(f"文件ID '{file_id}' 不存在")
             return
 
-        try:
-            os.remove(file.filepath)
-            print(f"删除文件: {file.original_filename}")
-        except:
-            print(f"无法删除文件: {file.original_filename}")
-
-        db.session.delete(file)
-        db.session.commit()
+        print(f"删除文件: {file.original_filename}")
+        delete_files([file.id])
+        _drain_unlink_queue()
         print("文件记录已删除")
 
 def show_config():
@@ -231,39 +222,175 @@ def set_config():
 
 def clean_expired_files():
     """清理过期文件"""
+    from services.expiry import expiry_sweeper
+
+    def report(progress):
+        print(f"已清理 {progress['files']} 个过期文件，释放 {progress['bytes'] / (1024*1024):.2f} MB")
+
+    result = expiry_sweeper.sweep(on_batch=report)
+    if not result['batches']:
+        print("没有过期文件")
+        return
+
+    if result['errors']:
+        print(f"{result['errors']} 个过期文件无法删除，已保留记录")
+    print("过期文件清理完成")
+
+def fsck(repair=None, verify_hash=None, workers=8, hash_cache=True):
+    """检查存储与数据库是否一致"""
+    from services.fsck import run_fsck, QUARANTINE_DIR
+
+    if repair is None:
+        repair = input("是否修复问题（隔离孤立文件、清理残留分块并标记记录）? (yes/no): ").strip().lower() == 'yes'
+    if verify_hash is None:
+        verify_hash = input("是否校验文件哈希（较慢）? (yes/no): ").strip().lower() == 'yes'
+
+    labels = {
+        'orphan': '孤立文件',
+        'orphan_temp': '残留分块上传',
+        'missing': '文件缺失',
+        'size_mismatch': '大小不一致',
+        'hash_mismatch': '哈希不一致',
+    }
+
+    def report(kind, path, file_id):
+        print(f"[{labels[kind]}] {path}" + (f" (文件ID: {file_id})" if file_id else ""))
+
     with app.app_context():
-        now = datetime.utcnow()
-        expired_files = File.query.filter(File.expiry_time.isnot(None), File.expiry_time < now).all()
+        summary = run_fsck(get_storage(), repair=repair, verify_hash=verify_hash,
+                           workers=workers, on_issue=report, hash_cache=hash_cache,
+                           grace_seconds=app.config.get('FSCK_GRACE_SECONDS', 3600))
+
+    print("=== 一致性检查结果 ===")
+    print(f"磁盘文件数: {summary['disk_files']}")
+    print(f"数据库记录数: {summary['db_rows']}")
+    for kind, label in labels.items():
+        print(f"{label}: {summary[kind]}")
+    if summary['recent']:
+        print(f"最近写入、暂未检查的无记录文件: {summary['recent']}")
+    if repair:
+        print(f"已隔离孤立文件到 {QUARANTINE_DIR}/，已清理残留分块并标记问题记录")
+        print(f"已清除 {summary['cleared']} 条记录的旧标记")
+
+def migrate_layout(batch_size=500, pause=0):
+    """把平铺存放的旧文件迁移到分级目录"""
+    from services.layout import migrate_flat_files
+    from storage import LocalStorage
 
-        if not expired_files:
-            print("没有过期文件")
+    with app.app_context():
+        storage = get_storage()
+        if not isinstance(storage, LocalStorage) or not storage.shard_depth:
+            print("只有启用分级目录的本地存储需要迁移")
             return
 
-        print(f"发现 {len(expired_files)} 个过期文件")
-        for file in expired_files:
-            try:
-                os.remove(file.filepath)
-                print(f"删除过期文件: {file.original_filename}")
-            except:
-                print(f"无法删除过期文件: {file.original_filename}")
+        def report(progress):
+            print(f"已检查 {progress['scanned']} 条记录，迁移 {progress['moved']} 个文件，缺失 {progress['missing']} 个")
 
-            db.session.delete(file)
+        result = migrate_flat_files(storage, batch_size=batch_size, pause=pause, on_batch=report)
 
-        db.session.commit()
-        print("过期文件清理完成")
+    print(f"迁移完成，共迁移 {result['moved']} 个文件")
+    if result['missing']:
+        print(f"{result['missing']} 个文件在存储中不存在，可运行 fsck 检查")
+
+def compress_cold_files(max_files=None):
+    """压缩长时间未访问的文件"""
+    from services.compression import cold_tier
+
+    def report(file, saved):
+        if saved is not None:
+            print(f"已压缩: {file.original_filename}，节省 {saved / 1024:.1f} KB")
+
+    compressed, skipped, saved = cold_tier.compress_cold_files(max_files=max_files, on_file=report)
+    print(f"压缩完成，共压缩 {compressed} 个文件，跳过 {skipped} 个，节省 {saved / (1024*1024):.2f} MB")
+
+def seed(users=100, files=100000, upload_tasks=100, sparse=False, seed_value=0, batch_size=50000):
+    """批量生成合成数据，用于压测和规模测试"""
+    import time
+    from services.seed import SEED_PASSWORD, seed_database
+
+    started = time.perf_counter()
+
+    def report(kind, count):
+        elapsed = time.perf_counter() - started
+        if kind == 'files':
+            print(f"已插入 {count} 条文件记录 ({count / max(elapsed, 1e-9):.0f} 条/秒)")
+        elif kind == 'users':
+            print(f"可用的合成用户: {count} 个")
+
+    with app.app_context():
+        try:
+            result = seed_database(get_storage(), users=users, files=files, upload_tasks=upload_tasks,
+                                   sparse=sparse, seed=seed_value, batch_size=batch_size, on_progress=report)
+        except ValueError as e:
+            print(f"错误: {e}")
+            return
+
+    print(f"生成完成，用时 {time.perf_counter() - started:.1f} 秒: 用户 {result['users']} 个，"
+          f"文件 {result['files']} 条，上传任务 {result['upload_tasks']} 个（分块 {result['upload_chunks']} 条）")
+    if result['users']:
+        print(f"合成用户的密码均为: {SEED_PASSWORD}")
+
+def ingest(source, username, share_type='link_only', password=None, expiry_hours=None,
+           link_mode='auto', workers=None, batch_size=500):
+    """把已有目录中的文件批量导入到指定用户名下"""
+    from services.ingest import ingest_directory
+
+    def report(result):
+        elapsed = max(result['elapsed'], 1e-9)
+        print(f"已检查 {result['scanned']} 个文件，导入 {result['imported']} 个，跳过已导入 {result['skipped']} 个，"
+              f"失败 {result['errors']} 个 ({result['imported'] / elapsed:.0f} 个/秒, "
+              f"{result['bytes'] / (1024*1024) / elapsed:.1f} MB/秒)")
+
+    with app.app_context():
+        user = User.query.filter_by(username=username).first()
+        if not user:
+            print("用户不存在")
+            return
+        try:
+            result = ingest_directory(get_storage(), source, user.id, share_type=share_type, password=password,
+                                      expiry_hours=expiry_hours, link_mode=link_mode, workers=workers,
+                                      batch_size=batch_size, on_batch=report)
+        except ValueError as e:
+            print(f"错误: {e}")
+            return
+
+    print(f"导入完成，用时 {result['elapsed']:.1f} 秒: 导入 {result['imported']} 个文件 "
+          f"({result['bytes'] / (1024*1024):.2f} MB)，硬链接 {result['hardlink']} 个，"
+          f"reflink {result['reflink']} 个，复制 {result['copy']} 个")
+    if result['errors']:
+        print(f"{result['errors']} 个文件无法读取或放入存储，重新执行会重试这些文件")
+
+def recalculate_quota(username=None):
+    """按文件记录和进行中的上传任务重新统计用户的配额用量"""
+    from services.quota import recalculate_usage
 
-def show_stats():
-    """显示系统统计信息"""
     with app.app_context():
-        user_count = User.query.count()
-        file_count = File.query.count()
-        admin_count = User.query.filter_by(role='admin').count()
+        user_ids = None
+        if username:
+            user = User.query.filter_by(username=username).first()
+            if not user:
+                print("用户不存在")
+                return
+            user_ids = [user.id]
+        recalculate_usage(user_ids)
+        count = len(user_ids) if user_ids else User.query.count()
+    print(f"已重新统计 {count} 个用户的配额用量")
 
-        total_size = 0
-        for user in User.query.all():
-            total_size += user.get_total_files_size()
+def show_stats():
+    """显示系统统计信息（来自统计汇总表）"""
+    from services import stats
 
-        public_files = File.query.filter_by(is_public=True).count()
+    with app.app_context():
+        user_count, admin_count = db.session.query(
+            db.func.count(User.id),
+            db.func.coalesce(db.func.sum(db.case((User.role == 'admin', 1), else_=0)), 0)
+        ).one()
+        summary = stats.summary()
+        if not summary['built']:
+            print("统计汇总尚未建立，请先执行 python manage.py rebuild_stats")
+            return
+        file_count = summary['total_files']
+        public_files = summary['share_types']['public']
         private_files = file_count - public_files
 
         print("=== 系统统计 ===")
@@ -273,7 +400,16 @@ def show_stats():
         print(f"总文件数: {file_count}")
         print(f"公开文件数: {public_files}")
         print(f"私密文件数: {private_files}")
-        print(f"总存储量: {total_size / (1024*1024*1024):.2f} GB")
+        print(f"总存储量: {summary['total_bytes'] / (1024*1024*1024):.2f} GB")
+        print(f"最近7天上传: {summary['recent_files']}")
+
+def rebuild_stats():
+    """按文件记录重新计算统计汇总和用户用量"""
+    from services import stats
+
+    with app.app_context():
+        count = stats.rebuild()
+    print(f"统计汇总已重建，共 {count} 个文件")
 
 def db_migrate():
     """生成数据库迁移"""
@@ -397,6 +533,12 @@ def main():
 
 统计信息:
 18. 显示系统统计
+22. 重建统计汇总
+
+存储维护:
+19. 存储一致性检查
+20. 迁移旧文件到分级目录
+21. 压缩冷文件
 
 其他:
 0. 初始化数据库
@@ -445,6 +587,14 @@ q. 退出
             restore_database()
         elif choice == '18':
             show_stats()
+        elif choice == '19':
+            fsck()
+        elif choice == '20':
+            migrate_layout()
+        elif choice == '21':
+            compress_cold_files()
+        elif choice == '22':
+            rebuild_stats()
         elif choice.lower() == 'q':
             print("再见!")
             break
@@ -453,5 +603,79 @@ q. 退出
 
         input("\n按Enter键继续...")
 
+def run_command(argv):
+    """非交互方式执行子命令，例如: python manage.py fsck --repair"""
+    import argparse
+
+    parser = argparse.ArgumentParser(description='文件分享系统管理工具')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    fsck_parser = subparsers.add_parser('fsck', help='检查存储与数据库是否一致')
+    fsck_parser.add_argument('--repair', action='store_true', help='隔离孤立文件、清理残留分块并标记问题记录')
+    fsck_parser.add_argument('--verify-hash', action='store_true', help='校验文件哈希')
+    fsck_parser.add_argument('--workers', type=int, default=8, help='扫描线程数')
+    fsck_parser.add_argument('--no-hash-cache', action='store_true', help='校验哈希时忽略缓存，重新读取每个文件')
+
+    layout_parser = subparsers.add_parser('migrate_layout', help='把平铺存放的旧文件迁移到分级目录')
+    layout_parser.add_argument('--batch-size', type=int, default=500, help='每批迁移的记录数')
+    layout_parser.add_argument('--pause', type=float, default=0, help='每批之间暂停的秒数')
+
+    compress_parser = subparsers.add_parser('compress_cold_files', help='压缩长时间未访问的文件')
+    compress_parser.add_argument('--max-files', type=int, default=None, help='本次最多处理的文件数')
+
+    seed_parser = subparsers.add_parser('seed', help='批量生成合成数据')
+    seed_parser.add_argument('--users', type=int, default=100, help='新建的用户数')
+    seed_parser.add_argument('--files', type=int, default=100000, help='文件记录数')
+    seed_parser.add_argument('--upload-tasks', type=int, default=100, help='分块上传任务数')
+    seed_parser.add_argument('--sparse', action='store_true', help='在本地存储中创建对应大小的稀疏文件')
+    seed_parser.add_argument('--seed', type=int, default=0, help='随机数种子')
+    seed_parser.add_argument('--batch-size', type=int, default=50000, help='每个事务插入的行数')
+
+    ingest_parser = subparsers.add_parser('ingest', help='把已有目录中的文件批量导入到指定用户名下')
+    ingest_parser.add_argument('source', help='要导入的目录')
+    ingest_parser.add_argument('--user', required=True, help='文件所属的用户名')
+    ingest_parser.add_argument('--share-type', choices=['public', 'link_only', 'specified_users'],
+                               default='link_only', help='分享方式')
+    ingest_parser.add_argument('--password', help='访问密码')
+    ingest_parser.add_argument('--expiry-hours', type=int, help='多少小时后过期，默认永不过期')
+    ingest_parser.add_argument('--link-mode', choices=['auto', 'hardlink', 'reflink', 'copy'], default='auto',
+                               help='放入存储的方式；硬链接与源文件共享数据，之后修改源文件会影响已导入的文件')
+    ingest_parser.add_argument('--workers', type=int, default=None, help='计算哈希的进程数，默认为CPU核数')
+    ingest_parser.add_argument('--batch-size', type=int, default=500, help='每个事务插入的记录数')
+
+    quota_parser = subparsers.add_parser('recalculate_quota', help='重新统计用户的配额用量')
+    quota_parser.add_argument('--user', help='只统计指定用户名，默认所有用户')
+
+    subparsers.add_parser('clean_expired_files', help='清理过期文件')
+    subparsers.add_parser('show_stats', help='显示系统统计')
+    subparsers.add_parser('rebuild_stats', help='按文件记录重新计算统计汇总')
+
+    args = parser.parse_args(argv)
+    if args.command == 'fsck':
+        fsck(repair=args.repair, verify_hash=args.verify_hash, workers=args.workers,
+             hash_cache=not args.no_hash_cache)
+    elif args.command == 'migrate_layout':
+        migrate_layout(batch_size=args.batch_size, pause=args.pause)
+    elif args.command == 'compress_cold_files':
+        compress_cold_files(max_files=args.max_files)
+    elif args.command == 'seed':
+        seed(users=args.users, files=args.files, upload_tasks=args.upload_tasks, sparse=args.sparse,
+             seed_value=args.seed, batch_size=args.batch_size)
+    elif args.command == 'ingest':
+        ingest(args.source, args.user, share_type=args.share_type, password=args.password,
+               expiry_hours=args.expiry_hours, link_mode=args.link_mode, workers=args.workers,
+               batch_size=args.batch_size)
+    elif args.command == 'recalculate_quota':
+        recalculate_quota(args.user)
+    elif args.command == 'clean_expired_files':
+        clean_expired_files()
+    elif args.command == 'show_stats':
+        show_stats()
+    elif args.command == 'rebuild_stats':
+        rebuild_stats()
+
 if __name__ == '__main__':
-    main()
+    if len(sys.argv) > 1:
+        run_command(sys.argv[1:])
+    else:
+        main()
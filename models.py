@@ -2,8 +2,8 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
+import hashlib
 import uuid
-import os
 
 db = SQLAlchemy()
 
@@ -28,6 +28,14 @@ class User(UserMixin, db.Model):
     language = db.Column(db.String(10), default='zh')  # 语言设置
     theme = db.Column(db.String(10), default='light')  # 主题设置
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # 配额用量，由 services.quota 维护；预留量是进行中的分块上传占用的配额
+    used_bytes = db.Column(db.BigInteger, default=0, server_default='0', nullable=False)
+    used_files = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    reserved_bytes = db.Column(db.BigInteger, default=0, server_default='0', nullable=False)
+    reserved_files = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    usage_synced_at = db.Column(db.DateTime, default=datetime.utcnow)  # 为空时用量尚未统计（旧数据）
+    # 文件列表每次变化时加一，作为首页列表缓存键的一部分
+    listing_version = db.Column(db.Integer, default=0, server_default='0', nullable=False)
 
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
@@ -36,13 +44,24 @@ class User(UserMixin, db.Model):
         return check_password_hash(self.password_hash, password)
 
     def get_total_files_count(self):
+        if self.usage_synced_at is not None:
+            return self.used_files
         return File.query.filter_by(user_id=self.id).count()
 
     def get_total_files_size(self):
-        total_size = 0
-        for file in File.query.filter_by(user_id=self.id).all():
+        if self.usage_synced_at is not None:
+            return self.used_bytes
+        # 优先使用上传时记录的大小，旧数据没有记录时再读取磁盘
+        total_size = db.session.query(db.func.coalesce(db.func.sum(File.file_size), 0)).filter(
+            File.user_id == self.id
+        ).scalar()
+        from storage import get_storage
+        storage = get_storage()
+        for (filepath,) in db.session.query(File.filepath).filter(
+            File.user_id == self.id, File.file_size.is_(None)
+        ):
             try:
-                total_size += os.path.getsize(file.filepath)
+                total_size += storage.size(storage.key_from_filepath(filepath))
             except:
                 pass
         return total_size
@@ -53,12 +72,25 @@ class File(db.Model):
     filename = db.Column(db.String(255), nullable=False)
     original_filename = db.Column(db.String(255), nullable=False)
     raw_filename = db.Column(db.String(255), nullable=False)  # 完全原始的文件名
-    filepath = db.Column(db.String(500), nullable=False)
+    # 匿名首页按 (upload_time, id) 倒序分页读取公开文件
+    __table_args__ = (db.Index('ix_file_public_listing', 'is_public', 'upload_time', 'id'),)
+
+    filepath = db.Column(db.String(500), nullable=False, index=True)
     upload_time = db.Column(db.DateTime, default=datetime.utcnow)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     is_public = db.Column(db.Boolean, default=False)
     password = db.Column(db.String(150))
-    expiry_time = db.Column(db.DateTime)
+    expiry_time = db.Column(db.DateTime, index=True)  # 过期清理按此列扫描
+    file_size = db.Column(db.BigInteger)  # 文件字节数，上传时记录
+    file_hash = db.Column(db.String(128))  # 文件内容的 SHA-256；分块上传完成后由后台计算，之前为空
+    storage_issue = db.Column(db.String(20))  # 一致性检查发现的问题: missing, size_mismatch, hash_mismatch
+    codec = db.Column(db.String(20))  # 冷数据压缩编码: gzip, zstd；identity 表示已检查但不压缩
+    compressed_size = db.Column(db.BigInteger)  # 压缩后在存储中占用的字节数
+    # 访问计数由 services.access 在内存中累计后定期批量写入
+    download_count = db.Column(db.Integer, default=0, server_default='0', nullable=False, index=True)
+    view_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    bytes_served = db.Column(db.BigInteger, default=0, server_default='0', nullable=False)
+    last_accessed_at = db.Column(db.DateTime)  # 最近一次下载或预览的时间
     # 新增权限字段
     allow_edit = db.Column(db.Boolean, default=False)  # 允许编辑
     allow_download = db.Column(db.Boolean, default=True)  # 允许下载
@@ -71,6 +103,92 @@ class File(db.Model):
     tags = db.Column(db.String(500))  # 标签，用逗号分隔
 
     user = db.relationship('User', backref=db.backref('files', lazy=True))
+    media_info = db.relationship('FileMetadata', uselist=False, lazy=True)
+
+    @property
+    def storage_key(self):
+        """文件在存储后端中的键"""
+        from storage import get_storage
+        return get_storage().key_from_filepath(self.filepath)
+
+    @property
+    def is_compressed(self):
+        return self.codec not in (None, 'identity')
+
+    @property
+    def content_key(self):
+        """由内容派生的缓存（行索引、压缩包目录等）的键：文件ID、内容哈希和大小，任一变化都使用新的缓存。
+        内容哈希由客户端提供，未经校验，因此不同文件之间不共享缓存；旧记录没有哈希时用存储路径代替"""
+        content = self.file_hash.lower() if self.file_hash else self.filepath
+        return hashlib.sha256(f'{self.id}:{content}:{self.file_size}'.encode('utf-8')).hexdigest()
+
+    def get_size(self):
+        """文件大小，优先使用上传时记录的值，其次是提取元数据时记录的值"""
+        if self.file_size is not None:
+            return self.file_size
+        if self.media_info is not None and self.media_info.size is not None:
+            return self.media_info.size
+        from storage import get_storage
+        try:
+            return get_storage().size(self.storage_key)
+        except:
+            return 0
+
+# 文件元数据：上传完成后由 services.metadata 在后台提取，详情页和列表只读这里，不读取文件内容
+class FileMetadata(db.Model):
+    file_id = db.Column(db.String(36), db.ForeignKey('file.id'), primary_key=True)
+    mime_type = db.Column(db.String(100), nullable=False, index=True)  # 按文件头识别的真实类型
+    kind = db.Column(db.String(20), nullable=False, index=True)  # image, video, audio, pdf, text, archive, other
+    size = db.Column(db.BigInteger)
+    width = db.Column(db.Integer)  # 图片、视频的像素尺寸
+    height = db.Column(db.Integer)
+    duration = db.Column(db.Float)  # 音视频时长(秒)
+    pages = db.Column(db.Integer)  # PDF 页数
+    error = db.Column(db.String(255))  # 读取失败的原因，不再重试
+    extracted_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    @property
+    def summary(self):
+        """列表中显示的简要说明，如 1920×1080 · 3:25"""
+        parts = []
+        if self.width and self.height:
+            parts.append(f'{self.width}×{self.height}')
+        if self.duration:
+            seconds = int(round(self.duration))
+            hours, seconds = divmod(seconds, 3600)
+            minutes, seconds = divmod(seconds, 60)
+            parts.append(f'{hours}:{minutes:02d}:{seconds:02d}' if hours else f'{minutes}:{seconds:02d}')
+        if self.pages:
+            parts.append(f'{self.pages} 页')
+        return ' · '.join(parts)
+
+# 文件版本：内容由按内容切分的数据块依次组成，同一文件的各版本共享相同的块
+class FileVersion(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    file_id = db.Column(db.String(36), db.ForeignKey('file.id'), nullable=False, index=True)
+    version = db.Column(db.Integer, nullable=False)  # 从1开始，最大的为当前版本
+    file_size = db.Column(db.BigInteger, nullable=False)
+    file_hash = db.Column(db.String(128))  # 整个版本的 SHA-256
+    blocks_count = db.Column(db.Integer, nullable=False)
+    comment = db.Column(db.String(255))
+    created_by = db.Column(db.Integer, db.ForeignKey('user.id'))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (db.UniqueConstraint('file_id', 'version'),)
+
+# 版本数据块，按 SHA-256 保存在存储的 .versions/<文件ID>/ 下
+class FileBlock(db.Model):
+    file_id = db.Column(db.String(36), primary_key=True)
+    block_hash = db.Column(db.String(64), primary_key=True)
+    size = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# 版本由哪些块按什么顺序组成
+class FileVersionBlock(db.Model):
+    version_id = db.Column(db.Integer, db.ForeignKey('file_version.id'), primary_key=True)
+    seq = db.Column(db.Integer, primary_key=True)
+    block_hash = db.Column(db.String(64), nullable=False, index=True)
+    offset = db.Column(db.BigInteger, nullable=False)  # 块在该版本中的起始字节
 
 # 分块上传任务模型
 class UploadTask(db.Model):
@@ -87,7 +205,10 @@ class UploadTask(db.Model):
     encrypt_password = db.Column(db.String(150))  # 加密密码
     expired_at = db.Column(db.DateTime)  # 过期时间
     share_options = db.Column(db.Text)  # JSON格式的分享选项
-    status = db.Column(db.String(20), default='uploading')  # uploading, completed, failed
+    storage_key = db.Column(db.String(500))  # 合并后文件在存储后端中的键
+    storage_upload_id = db.Column(db.String(255))  # 存储后端的分块上传ID
+    upload_offset = db.Column(db.BigInteger)  # tus 上传已接收的字节数，分块上传为空
+    status = db.Column(db.String(20), default='uploading')  # uploading, completed, failed, expired, cancelled
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
@@ -102,3 +223,32 @@ class UploadChunk(db.Model):
     uploaded_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     task = db.relationship('UploadTask', backref=db.backref('chunks', lazy=True))
+
+# 待删除文件队列模型（记录删除后由后台线程删除磁盘文件）
+class UnlinkTask(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    filepath = db.Column(db.String(500), nullable=False)
+    file_id = db.Column(db.String(36))  # 原文件ID，仅用于追踪
+    file_size = db.Column(db.BigInteger)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# 全局文件列表的版本号，列表内容变化时递增；public 为匿名首页的公开文件列表
+class ListingVersion(db.Model):
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.BigInteger, default=0, nullable=False)
+
+# 统计汇总：按维度累计的数量和字节数，写入文件时由 services.stats 增量更新
+class StatsCounter(db.Model):
+    dimension = db.Column(db.String(20), primary_key=True)  # total, ext, share, access, compression；meta 行表示汇总已建立
+    key = db.Column(db.String(255), primary_key=True, default='')  # 扩展名、分享类型等，total 为空
+    count = db.Column(db.BigInteger, default=0, nullable=False)
+    bytes = db.Column(db.BigInteger, default=0, nullable=False)
+
+# 现存文件按上传日（UTC）统计的文件数和字节数
+class StatsDaily(db.Model):
+    day = db.Column(db.Date, primary_key=True)
+    uploads = db.Column(db.BigInteger, default=0, nullable=False)
+    upload_bytes = db.Column(db.BigInteger, default=0, nullable=False)
@@ -1,12 +1,16 @@
-from flask import Blueprint, render_template, redirect, url_for, flash, request
+from flask import Blueprint, render_template, redirect, url_for, flash, request, jsonify, send_from_directory
 from flask_login import login_required, current_user
 from models import User, File, db
 from forms import ConfigForm, UserLimitForm, RegisterForm
 from utils import get_config_dict
+from services.expiry import expiry_sweeper
+from services.deletion import delete_files, unlink_queue
+from services.profiling import request_profiler
+from services.listing_cache import bump_listing_version
+from services import stats
 from flask_wtf import FlaskForm
 from wtforms import StringField, SelectField, SubmitField, BooleanField, PasswordField
 from wtforms.validators import DataRequired, Length
-import os
 
 admin_bp = Blueprint('admin', __name__)
 
@@ -184,20 +188,14 @@ def admin_delete_user(user_id):
         flash('不能删除自己的账号')
         return redirect(url_for('admin.admin_users'))
 
-    # 删除用户的文件
-    files = File.query.filter_by(user_id=user.id).all()
-    for file in files:
-        try:
-            os.remove(file.filepath)
-        except:
-            pass
+    # 批量删除文件记录，磁盘文件由后台队列删除
+    result = delete_files(user_id=user.id)
 
-    # 删除数据库记录
-    File.query.filter_by(user_id=user.id).delete()
+    username = user.username
     db.session.delete(user)
     db.session.commit()
 
-    flash(f'用户 "{user.username}" 及其所有文件已删除')
+    flash(f'用户 "{username}" 及其 {result["files"]} 个文件已删除')
     return redirect(url_for('admin.admin_users'))
 
 @admin_bp.route('/files')
@@ -240,6 +238,7 @@ def admin_edit_file(file_id):
 
     form = EditFileForm()
     if form.validate_on_submit():
+        before = stats.entry(file)
         file.original_filename = form.original_filename.data
         file.share_type = form.share_type.data
         file.allow_view = form.allow_view.data
@@ -247,6 +246,8 @@ def admin_edit_file(file_id):
         file.allow_edit = form.allow_edit.data
         file.password = form.password.data if form.password.data else None
         file.is_public = (form.share_type.data == 'public')
+        stats.replace_file(before, file)
+        bump_listing_version([file.user_id], public=before.share_type == 'public' or file.is_public)
 
         db.session.commit()
         flash('文件信息已更新')
@@ -270,62 +271,48 @@ def admin_statistics():
         flash('无权访问此页面')
         return redirect(url_for('main.index'))
 
-    # 获取统计数据
+    # 获取统计数据：文件相关的数字来自汇总表，不扫描文件表
     from models import User, File
     from datetime import datetime, timedelta
 
-    # 用户统计
-    total_users = User.query.count()
-    admin_users = User.query.filter_by(role='admin').count()
-    regular_users = total_users - admin_users
-
-    # 新用户统计（最近30天）
+    # 用户统计（一次查询）
     thirty_days_ago = datetime.utcnow() - timedelta(days=30)
-    new_users_30d = User.query.filter(User.created_at >= thirty_days_ago).count()
+    total_users, admin_users, new_users_30d = db.session.query(
+        db.func.count(User.id),
+        db.func.coalesce(db.func.sum(db.case((User.role == 'admin', 1), else_=0)), 0),
+        db.func.coalesce(db.func.sum(db.case((User.created_at >= thirty_days_ago, 1), else_=0)), 0)
+    ).one()
+    regular_users = total_users - admin_users
 
-    # 文件统计
-    total_files = File.query.count()
-    total_file_size = 0
-    for file in File.query.all():
-        try:
-            if os.path.exists(file.filepath):
-                total_file_size += os.path.getsize(file.filepath)
-        except:
-            pass
-
-    # 文件类型统计
-    file_types = {}
-    for file in File.query.all():
-        ext = os.path.splitext(file.original_filename.lower())[1]
-        if ext:
-            file_types[ext] = file_types.get(ext, 0) + 1
-
-    # 分享类型统计
-    share_types = {
-        'public': File.query.filter_by(share_type='public').count(),
-        'link_only': File.query.filter_by(share_type='link_only').count(),
-        'specified_users': File.query.filter_by(share_type='specified_users').count()
-    }
-
-    # 最近文件上传统计（最近7天）
-    seven_days_ago = datetime.utcnow() - timedelta(days=7)
-    recent_files = File.query.filter(File.upload_time >= seven_days_ago).count()
-
-    # 存储空间使用统计（GB）
-    total_size_gb = total_file_size / (1024 * 1024 * 1024)
+    summary = stats.summary()
+    hot_files = File.query.filter(File.download_count > 0).order_by(File.download_count.desc()).limit(10).all()
 
     return render_template('admin/admin_statistics.html',
                          total_users=total_users,
                          admin_users=admin_users,
                          regular_users=regular_users,
                          new_users_30d=new_users_30d,
-                         total_files=total_files,
-                         total_size_gb=round(total_size_gb, 2),
-                         file_types=file_types,
-                         share_types=share_types,
-                         recent_files=recent_files,
+                         stats_built=summary['built'],
+                         total_files=summary['total_files'],
+                         total_size_gb=round(summary['total_bytes'] / (1024 * 1024 * 1024), 2),
+                         file_types=summary['file_types'],
+                         share_types=summary['share_types'],
+                         recent_files=summary['recent_files'],
+                         daily_uploads=summary['daily_uploads'],
+                         top_users=stats.top_users(),
+                         expiry_metrics=expiry_sweeper.get_metrics(),
+                         access_totals=summary['access_totals'],
+                         hot_files=hot_files,
                          config=get_config_dict())
 
+@admin_bp.route('/statistics/expiry')
+@login_required
+def admin_expiry_metrics():
+    if current_user.role != 'admin':
+        return jsonify({'error': '无权访问'}), 403
+
+    return jsonify(expiry_sweeper.get_metrics())
+
 @admin_bp.route('/file/<file_id>/delete', methods=['POST'])
 @login_required
 def admin_delete_file(file_id):
@@ -334,18 +321,12 @@ def admin_delete_file(file_id):
         return redirect(url_for('main.index'))
 
     file = File.query.get_or_404(file_id)
+    filename = file.original_filename
 
-    # 删除文件
-    try:
-        os.remove(file.filepath)
-    except:
-        pass
-
-    # 删除数据库记录
-    db.session.delete(file)
-    db.session.commit()
+    # 删除数据库记录，磁盘文件由后台队列删除
+    delete_files([file.id])
 
-    flash(f'文件 "{file.original_filename}" 已删除')
+    flash(f'文件 "{filename}" 已删除')
     return redirect(url_for('admin.admin_files'))
 
 @admin_bp.route('/files/batch-delete', methods=['POST'])
@@ -360,22 +341,61 @@ def admin_batch_delete_files():
         flash('未选择任何文件')
         return redirect(url_for('admin.admin_files'))
 
-    deleted_count = 0
-    for file_id in file_ids:
-        try:
-            file = File.query.get(file_id)
-            if file:
-                # 删除文件
-                try:
-                    os.remove(file.filepath)
-                except:
-                    pass
-                # 删除数据库记录
-                db.session.delete(file)
-                deleted_count += 1
-        except:
-            continue
-
-    db.session.commit()
-    flash(f'成功删除 {deleted_count} 个文件')
+    result = delete_files(file_ids)
+    flash(f'成功删除 {result["files"]} 个文件')
     return redirect(url_for('admin.admin_files'))
+
+@admin_bp.route('/files/delete-queue')
+@login_required
+def admin_delete_queue_status():
+    if current_user.role != 'admin':
+        return jsonify({'error': '无权访问'}), 403
+
+    return jsonify(unlink_queue.get_status())
+
+@admin_bp.route('/profiling')
+@login_required
+def admin_profiling_status():
+    if current_user.role != 'admin':
+        return jsonify({'error': '无权访问'}), 403
+
+    return jsonify(request_profiler.get_status())
+
+@admin_bp.route('/profiling/start', methods=['POST'])
+@login_required
+def admin_profiling_start():
+    """对指定路由开启 cProfile 采样，参数: endpoint, duration(秒), rate(0-1), max_dumps"""
+    if current_user.role != 'admin':
+        return jsonify({'error': '无权访问'}), 403
+
+    data = request.get_json(silent=True) or request.form
+    try:
+        target = request_profiler.start(
+            data['endpoint'],
+            duration=int(data.get('duration', 300)),
+            rate=float(data.get('rate', 1.0)),
+            max_dumps=int(data.get('max_dumps', 20))
+        )
+    except KeyError:
+        return jsonify({'error': '缺少 endpoint 参数'}), 400
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    return jsonify(target)
+
+@admin_bp.route('/profiling/stop', methods=['POST'])
+@login_required
+def admin_profiling_stop():
+    if current_user.role != 'admin':
+        return jsonify({'error': '无权访问'}), 403
+
+    request_profiler.stop()
+    return jsonify({'success': True})
+
+@admin_bp.route('/profiling/dumps/<name>')
+@login_required
+def admin_profiling_dump(name):
+    if current_user.role != 'admin':
+        return jsonify({'error': '无权访问'}), 403
+
+    return send_from_directory(request_profiler.directory, name, as_attachment=True)
@@ -1,16 +1,112 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, url_for
 from flask_login import login_required, current_user
-from models import UploadTask, UploadChunk, File, db
-from werkzeug.utils import secure_filename
+from models import UploadTask, UploadChunk, File, FileVersion, db
+from storage import get_storage, StorageError
+from services.metrics import assembly_duration, observe_chunk
+from services.hashing import hash_backfill
+from services import quota, stats
+from services.quota import QuotaExceeded
+from services import versions
+from services.versions import VersionError
+from services.listing_cache import bump_listing_version
+from services.metadata import metadata_extractor
 from datetime import datetime, timedelta
-import os
-import shutil
-import uuid
 import json
+import time
 
 # API蓝图
 api_bp = Blueprint('api', __name__)
 
+def _ensure_task_storage(task):
+    """补全旧任务缺少的存储键和分块上传ID"""
+    if not task.storage_key:
+        task.storage_key = get_storage().new_key(task.file_name)
+    if not task.storage_upload_id:
+        # 旧任务的分块保存在 temp/<任务ID> 下
+        task.storage_upload_id = task.id
+
+def share_options(data):
+    """从创建上传任务的参数中取出分享选项，保存到 UploadTask.share_options"""
+    # 获取分享选项
+    share_type = data.get('share_type', 'link_only')
+    allow_view = data.get('allow_view', True)
+    allow_download = data.get('allow_download', True)
+    allow_edit = data.get('allow_edit', False)
+    password = data.get('password')
+    expiry_type = data.get('expiry_type', 'never')
+    expiry_hours = data.get('expiry_hours')
+    custom_expiry = data.get('custom_expiry')
+    allowed_users = data.get('allowed_users')
+
+    # 处理过期时间
+    expiry_time = None
+    if expiry_type == 'hours' and expiry_hours:
+        try:
+            expiry_time = datetime.utcnow() + timedelta(hours=int(expiry_hours))
+        except ValueError:
+            pass
+    elif expiry_type == 'custom' and custom_expiry:
+        try:
+            expiry_time = datetime.strptime(custom_expiry, '%Y-%m-%d %H:%M')
+        except ValueError:
+            pass
+
+    # 处理允许用户列表
+    allowed_users_json = None
+    if share_type == 'specified_users' and allowed_users:
+        allowed_users_list = [u.strip() for u in allowed_users.split('\n') if u.strip()]
+        allowed_users_json = json.dumps(allowed_users_list)
+
+    return {
+        'share_type': share_type,
+        'allow_view': allow_view,
+        'allow_download': allow_download,
+        'allow_edit': allow_edit,
+        'password': password,
+        'expiry_time': expiry_time.isoformat() if expiry_time else None,
+        'allowed_users': allowed_users_json
+    }
+
+def file_from_task(task, size):
+    """由完成的上传任务及其分享选项生成文件记录"""
+    final_filename = task.storage_key.rsplit('/', 1)[-1]
+    final_path = get_storage().filepath_for(task.storage_key)
+
+    # 从share_options获取分享选项
+    metadata = json.loads(task.share_options) if task.share_options else {}
+    share_type = metadata.get('share_type', 'link_only')
+    allow_view = metadata.get('allow_view', True)
+    allow_download = metadata.get('allow_download', True)
+    allow_edit = metadata.get('allow_edit', False)
+    password = metadata.get('password')
+    expiry_time_str = metadata.get('expiry_time')
+    allowed_users = metadata.get('allowed_users')
+
+    expiry_time = None
+    if expiry_time_str:
+        try:
+            expiry_time = datetime.fromisoformat(expiry_time_str)
+        except:
+            pass
+
+    return File(
+        filename=final_filename,
+        original_filename=task.file_name,
+        raw_filename=task.file_name,  # 保存原始文件名
+        filepath=final_path,
+        file_size=size,
+        file_hash=task.file_hash,
+        user_id=task.user_id,
+        is_public=(share_type == 'public'),
+        share_type=share_type,
+        allow_view=allow_view,
+        allow_download=allow_download,
+        allow_edit=allow_edit,
+        password=password,
+        expiry_time=expiry_time,
+        allowed_users=allowed_users
+    )
+
 @api_bp.route('/files/upload/create', methods=['POST'])
 @login_required
 def create_upload_task():
@@ -31,44 +127,26 @@ def create_upload_task():
         file_size = int(data['file_size'])
         content_type = data['content_type']
 
-        # 获取分享选项
-        share_type = data.get('share_type', 'link_only')
-        allow_view = data.get('allow_view', True)
-        allow_download = data.get('allow_download', True)
-        allow_edit = data.get('allow_edit', False)
-        password = data.get('password')
-        expiry_type = data.get('expiry_type', 'never')
-        expiry_hours = data.get('expiry_hours')
-        custom_expiry = data.get('custom_expiry')
-        allowed_users = data.get('allowed_users')
-
         # 检查用户限制
         if file_size > current_user.max_file_size:
             return jsonify({'error': f'文件大小超过限制 ({current_user.max_file_size // (1024*1024)}MB)'}), 400
 
-        current_total_size = current_user.get_total_files_size()
-        if current_total_size + file_size > current_user.max_total_size:
-            return jsonify({'error': '上传后将超过总文件大小限制'}), 400
-
-        current_files_count = current_user.get_total_files_count()
-        if current_files_count >= current_user.max_total_files:
-            return jsonify({'error': '已达到总文件数量限制'}), 400
-
-        # 检查是否已有相同哈希的文件
+        # 检查是否已有相同哈希的文件（File.file_hash 由分块上传、导入和哈希服务填写）
         existing_file = File.query.filter_by(user_id=current_user.id).filter(
-            File.filename.like(f'%{file_hash}%')
+            db.or_(File.file_hash == str(file_hash).lower(), File.filename.like(f'%{file_hash}%'))
         ).first()
 
         if existing_file:
             # 检查文件是否完整
             try:
-                if os.path.getsize(existing_file.filepath) == file_size:
+                existing_size = existing_file.get_size()
+                if existing_size == file_size:
                     return jsonify({
                         'file_exists': True,
                         'file': {
                             'id': existing_file.id,
                             'filename': existing_file.original_filename,
-                            'size': os.path.getsize(existing_file.filepath),
+                            'size': existing_size,
                             'upload_time': existing_file.upload_time.isoformat()
                         }
                     }), 200
@@ -91,7 +169,9 @@ def create_upload_task():
             }), 200
 
         # 创建新的上传任务
+        storage = get_storage()
         chunk_size = int(data.get('chunk_size', 5 * 1024 * 1024))  # 默认5MB
+        chunk_size = max(chunk_size, storage.min_part_size)  # 对象存储对分块大小有下限
         chunks_count = (file_size + chunk_size - 1) // chunk_size  # 向上取整
 
         expired_at = None
@@ -101,36 +181,6 @@ def create_upload_task():
             except:
                 pass
 
-        # 处理过期时间
-        expiry_time = None
-        if expiry_type == 'hours' and expiry_hours:
-            try:
-                expiry_time = datetime.utcnow() + timedelta(hours=int(expiry_hours))
-            except ValueError:
-                pass
-        elif expiry_type == 'custom' and custom_expiry:
-            try:
-                expiry_time = datetime.strptime(custom_expiry, '%Y-%m-%d %H:%M')
-            except ValueError:
-                pass
-
-        # 处理允许用户列表
-        allowed_users_json = None
-        if share_type == 'specified_users' and allowed_users:
-            allowed_users_list = [u.strip() for u in allowed_users.split('\n') if u.strip()]
-            allowed_users_json = json.dumps(allowed_users_list)
-
-        # 存储分享选项到metadata
-        metadata = {
-            'share_type': share_type,
-            'allow_view': allow_view,
-            'allow_download': allow_download,
-            'allow_edit': allow_edit,
-            'password': password,
-            'expiry_time': expiry_time.isoformat() if expiry_time else None,
-            'allowed_users': allowed_users_json
-        }
-
         new_task = UploadTask(
             user_id=current_user.id,
             file_hash=file_hash,
@@ -143,9 +193,19 @@ def create_upload_task():
             bundle_id=data.get('bundle_id'),
             encrypt_password=data.get('encrypt_password'),
             expired_at=expired_at,
-            share_options=json.dumps(metadata)
+            share_options=json.dumps(share_options(data))
         )
+        new_task.storage_key = storage.new_key(file_name)
+        new_task.storage_upload_id = storage.begin_multipart(new_task.storage_key)
 
+        # 预留配额与任务在同一事务中提交，并发创建的任务不会超出总量限制
+        quota.ensure_usage(current_user.id)
+        try:
+            quota.reserve(current_user.id, file_size)
+        except QuotaExceeded as e:
+            db.session.rollback()
+            storage.abort_multipart(new_task.storage_key, new_task.storage_upload_id)
+            return jsonify({'error': str(e)}), 400
         db.session.add(new_task)
         db.session.commit()
 
@@ -191,16 +251,11 @@ def upload_chunk(task_id, chunk_index):
         if chunk_size != expected_size:
             return jsonify({'error': f'分块大小不正确，期望 {expected_size} 字节，实际 {chunk_size} 字节'}), 400
 
-        # 创建临时目录存储分块
-        from flask import current_app
-        upload_dir = current_app.config['UPLOAD_FOLDER']
-        temp_dir = os.path.join(upload_dir, 'temp', task_id)
-        os.makedirs(temp_dir, exist_ok=True)
-
         # 保存分块
-        chunk_path = os.path.join(temp_dir, f'chunk_{chunk_index:06d}')
-        with open(chunk_path, 'wb') as f:
-            f.write(chunk_data)
+        _ensure_task_storage(task)
+        started = time.perf_counter()
+        get_storage().upload_part(task.storage_key, task.storage_upload_id, chunk_index, chunk_data)
+        observe_chunk(chunk_size, time.perf_counter() - started)
 
         # 记录分块信息
         new_chunk = UploadChunk(
@@ -231,94 +286,48 @@ def complete_upload(task_id):
         if task.status != 'uploading':
             return jsonify({'error': '上传任务已完成或失败'}), 400
 
+        if task.upload_offset is not None:
+            return jsonify({'error': '该任务为 tus 上传，请通过 tus 接口继续上传'}), 400
+
         # 检查所有分块是否已上传
         uploaded_chunks = UploadChunk.query.filter_by(task_id=task_id).count()
         if uploaded_chunks != task.chunks_count:
             return jsonify({'error': f'分块不完整，已上传 {uploaded_chunks}/{task.chunks_count}'}), 400
 
         # 合并分块
-        from flask import current_app
-        upload_dir = current_app.config['UPLOAD_FOLDER']
-        temp_dir = os.path.join(upload_dir, 'temp', task_id)
-        final_filename = str(uuid.uuid4()) + '_' + secure_filename(task.file_name)
-        final_path = os.path.join(upload_dir, final_filename)
-
-        # 确保uploads目录存在
-        os.makedirs(upload_dir, exist_ok=True)
-
-        # 检查temp目录是否存在
-        if not os.path.exists(temp_dir):
-            # temp目录不存在，标记任务失败并要求重新上传
-            task.status = 'failed'
+        storage = get_storage()
+        _ensure_task_storage(task)
+        started = time.perf_counter()
+        try:
+            actual_size = storage.complete_multipart(task.storage_key, task.storage_upload_id, task.chunks_count)
+            assembly_duration.observe(time.perf_counter() - started)
+        except StorageError as e:
+            # 分块丢失，标记任务失败、释放预留并要求重新上传
+            quota.finish_task(task, 'failed')
             db.session.commit()
-            return jsonify({'error': '分块文件已丢失，请重新上传文件'}), 400
-
-        with open(final_path, 'wb') as final_file:
-            for i in range(task.chunks_count):
-                chunk_path = os.path.join(temp_dir, f'chunk_{i:06d}')
-                if not os.path.exists(chunk_path):
-                    # 清理已创建的文件
-                    if os.path.exists(final_path):
-                        os.remove(final_path)
-                    # 标记任务失败
-                    task.status = 'failed'
-                    db.session.commit()
-                    raise Exception(f'分块文件不存在: {chunk_path}')
-                with open(chunk_path, 'rb') as chunk_file:
-                    final_file.write(chunk_file.read())
+            return jsonify({'error': str(e)}), 400
 
         # 验证文件大小
-        actual_size = os.path.getsize(final_path)
         if actual_size != task.file_size:
-            os.remove(final_path)
+            storage.delete(task.storage_key)
+            quota.finish_task(task, 'failed')
+            db.session.commit()
             raise Exception(f'文件大小不匹配，期望 {task.file_size} 字节，实际 {actual_size} 字节')
 
-        # 从share_options获取分享选项
-        metadata = json.loads(task.share_options) if task.share_options else {}
-        share_type = metadata.get('share_type', 'link_only')
-        allow_view = metadata.get('allow_view', True)
-        allow_download = metadata.get('allow_download', True)
-        allow_edit = metadata.get('allow_edit', False)
-        password = metadata.get('password')
-        expiry_time_str = metadata.get('expiry_time')
-        allowed_users = metadata.get('allowed_users')
-
-        expiry_time = None
-        if expiry_time_str:
-            try:
-                expiry_time = datetime.fromisoformat(expiry_time_str)
-            except:
-                pass
-
-        # 创建文件记录
-        new_file = File(
-            filename=final_filename,
-            original_filename=task.file_name,
-            raw_filename=task.file_name,  # 保存原始文件名
-            filepath=final_path,
-            user_id=current_user.id,
-            is_public=(share_type == 'public'),
-            share_type=share_type,
-            allow_view=allow_view,
-            allow_download=allow_download,
-            allow_edit=allow_edit,
-            password=password,
-            expiry_time=expiry_time,
-            allowed_users=allowed_users
-        )
+        new_file = file_from_task(task, actual_size)
+        # 客户端提供的哈希未经校验，不写入文件记录；按合并后的内容计算需要读取整个文件，由后台完成
+        new_file.file_hash = None
+        # 更新任务状态，预留转为已用量；任务已被过期清理时放弃
+        if not quota.finish_task(task, 'completed'):
+            db.session.rollback()
+            storage.delete(task.storage_key)
+            return jsonify({'error': '上传任务已过期，请重新上传'}), 400
         db.session.add(new_file)
-
-        # 更新任务状态
-        task.status = 'completed'
+        stats.add_files([new_file])
+        bump_listing_version([task.user_id], public=new_file.is_public)
         db.session.commit()
-
-        # 立即清理临时分块文件
-        try:
-            shutil.rmtree(temp_dir, ignore_errors=True)
-        except Exception as e:
-            # 记录清理失败，但不影响上传成功
-            import logging
-            logging.warning(f"清理临时文件失败: {temp_dir}, 错误: {str(e)}")
+        metadata_extractor.wakeup()
+        hash_backfill.wakeup()
 
         return jsonify({
             'file_id': new_file.id,
@@ -331,3 +340,137 @@ def complete_upload(task_id):
         import logging
         logging.error(f"完成上传失败: {str(e)}", exc_info=True)
         return jsonify({'error': '服务器内部错误，请稍后重试'}), 500
+
+def _editable_file(file_id):
+    """当前用户可以上传新版本的文件：所有者和管理员，或文件允许编辑且当前用户可以访问"""
+    file = db.session.get(File, file_id)
+    if file is None:
+        return None
+    if current_user.role == 'admin' or current_user.id == file.user_id:
+        return file
+    if not file.allow_edit:
+        return None
+    if file.expiry_time and datetime.utcnow() > file.expiry_time:
+        return None
+    if file.share_type == 'specified_users':
+        try:
+            allowed_users = json.loads(file.allowed_users) if file.allowed_users else []
+        except ValueError:
+            return None
+        if current_user.username not in allowed_users:
+            return None
+    return file
+
+@api_bp.route('/files/<file_id>/versions', methods=['GET'])
+@login_required
+def list_versions(file_id):
+    """列出文件的版本和客户端切块参数；第一次上传新版本前，原内容会被保存为版本 1"""
+    file = _editable_file(file_id)
+    if not file:
+        return jsonify({'error': '文件不存在或无权编辑'}), 404
+
+    file_versions = FileVersion.query.filter_by(file_id=file.id).order_by(FileVersion.version.desc()).all()
+    return jsonify({
+        'file_id': file.id,
+        'chunking': versions.chunking_parameters(),
+        'versions': [{
+            'version': v.version,
+            'size': v.file_size,
+            'hash': v.file_hash,
+            'blocks': v.blocks_count,
+            'comment': v.comment,
+            'created_at': v.created_at.isoformat(),
+            'download_url': url_for('files.download_version', file_id=file.id, version=v.version)
+        } for v in file_versions]
+    }), 200
+
+@api_bp.route('/files/<file_id>/versions/missing', methods=['POST'])
+@login_required
+def missing_version_blocks(file_id):
+    """客户端提交新版本的块哈希列表，返回需要上传的块"""
+    try:
+        file = _editable_file(file_id)
+        if not file:
+            return jsonify({'error': '文件不存在或无权编辑'}), 404
+
+        data = request.get_json(silent=True) or {}
+        hashes = data.get('blocks')
+        if not isinstance(hashes, list) or not all(versions.is_block_hash(h) for h in hashes):
+            return jsonify({'error': 'blocks 必须是 SHA-256 十六进制字符串列表'}), 400
+
+        storage = get_storage()
+        try:
+            versions.ensure_base_version(storage, file)
+        except VersionError as e:
+            return jsonify({'error': str(e)}), 400
+        return jsonify({'missing': versions.missing_blocks(file.id, hashes)}), 200
+
+    except Exception as e:
+        import logging
+        logging.error(f"查询缺少的数据块失败: {str(e)}", exc_info=True)
+        return jsonify({'error': '服务器内部错误，请稍后重试'}), 500
+
+@api_bp.route('/files/<file_id>/blocks/<block_hash>', methods=['PUT'])
+@login_required
+def upload_version_block(file_id, block_hash):
+    """上传新版本中服务器缺少的一个数据块，请求体为块内容"""
+    try:
+        file = _editable_file(file_id)
+        if not file:
+            return jsonify({'error': '文件不存在或无权编辑'}), 404
+        if not versions.is_block_hash(block_hash):
+            return jsonify({'error': '块哈希无效'}), 400
+        if request.content_length is not None and request.content_length > versions.CHUNK_MAX:
+            return jsonify({'error': f'数据块超过 {versions.CHUNK_MAX} 字节'}), 413
+
+        try:
+            versions.store_block(get_storage(), file.id, request.get_data(), block_hash)
+        except VersionError as e:
+            return jsonify({'error': str(e)}), 400
+        return '', 201
+
+    except Exception as e:
+        import logging
+        logging.error(f"上传数据块失败: {str(e)}", exc_info=True)
+        return jsonify({'error': '服务器内部错误，请稍后重试'}), 500
+
+@api_bp.route('/files/<file_id>/versions', methods=['POST'])
+@login_required
+def create_version(file_id):
+    """创建新版本：JSON 请求体 {"blocks": [...], "hash": ..., "comment": ...} 引用已上传的块；
+    其他请求体视为完整的新内容，由服务器切块"""
+    try:
+        file = _editable_file(file_id)
+        if not file:
+            return jsonify({'error': '文件不存在或无权编辑'}), 404
+
+        storage = get_storage()
+        try:
+            if request.is_json:
+                data = request.get_json(silent=True) or {}
+                hashes = data.get('blocks')
+                if not isinstance(hashes, list) or not all(versions.is_block_hash(h) for h in hashes):
+                    return jsonify({'error': 'blocks 必须是 SHA-256 十六进制字符串列表'}), 400
+                new_version = versions.create_version(storage, file, hashes, current_user.id,
+                                                      expected_hash=data.get('hash'), comment=data.get('comment'))
+            else:
+                if request.content_length and request.content_length > file.user.max_file_size:
+                    return jsonify({'error': f'文件大小超过限制 ({file.user.max_file_size // (1024*1024)}MB)'}), 400
+                new_version = versions.create_version_from_stream(storage, file, request.stream, current_user.id,
+                                                                  comment=request.args.get('comment'))
+        except VersionError as e:
+            return jsonify({'error': str(e), 'missing': e.missing}), 400
+        except QuotaExceeded as e:
+            return jsonify({'error': str(e)}), 400
+
+        return jsonify({
+            'file_id': file.id,
+            'version': new_version.version,
+            'size': new_version.file_size,
+            'hash': new_version.file_hash
+        }), 200
+
+    except Exception as e:
+        import logging
+        logging.error(f"创建文件版本失败: {str(e)}", exc_info=True)
+        return jsonify({'error': '服务器内部错误，请稍后重试'}), 500
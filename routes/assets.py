@@ -0,0 +1,11 @@
+from flask import Blueprint
+
+from services.assets import assets
+
+# 带内容哈希的静态资源蓝图
+assets_bp = Blueprint('assets', __name__)
+
+@assets_bp.route('/assets/<path:name>')
+def asset(name):
+    """以内容哈希命名的静态资源，可以永久缓存"""
+    return assets.send(name)
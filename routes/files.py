@@ -1,135 +1,166 @@
-from flask import Blueprint, render_template, redirect, url_for, flash, request, send_from_directory, abort, jsonify
+from flask import Blueprint, render_template, redirect, url_for, flash, request, abort, jsonify
 from flask_login import login_required, current_user
-from models import File, db
+from models import File, FileVersion, db
 from forms import UploadForm, ShareForm
 from utils import get_config_dict
+from storage import get_storage
+from services.compression import send_stored_file
+from services.access import access_counter, response_bytes
+from services.metrics import download_bytes
+from services import quota, stats
+from services.quota import QuotaExceeded
+from services.form_upload import FileTooLarge, StreamingUploads
+from services.versions import send_version
+from services.listing_cache import bump_listing_version
+from services.text_preview import NotTextError, text_preview
+from services.archives import ArchiveError, archive_format, archive_inspector
+from services.metadata import PREVIEW_TYPES, metadata_extractor
 from werkzeug.utils import secure_filename
 from datetime import datetime, timedelta
 import os
 import json
-import uuid
 
 files_bp = Blueprint('files', __name__)
 
+# 按行分页预览的文本文件
+TEXT_EXTENSIONS = {'.txt', '.md', '.py', '.js', '.html', '.css', '.json', '.xml', '.log', '.csv'}
+
 @files_bp.route('/upload', methods=['GET', 'POST'])
 @login_required
 def upload():
     if request.method == 'POST':
-        # 处理通过JavaScript发送的请求（没有CSRF token）
-        files = request.files.getlist('files')
-        if not files:
-            flash('请选择要上传的文件')
-            return redirect(request.url)
-
-        # 获取表单参数
-        share_type = request.form.get('share_type', 'link_only')
-        allow_view = request.form.get('allow_view', 'true').lower() == 'true'
-        allow_download = request.form.get('allow_download', 'true').lower() == 'true'
-        allow_edit = request.form.get('allow_edit', 'false').lower() == 'true'
-        password = request.form.get('password') or None
-        expiry_type = request.form.get('expiry_type', 'never')
-        expiry_hours = request.form.get('expiry_hours')
-        custom_expiry = request.form.get('custom_expiry')
-        allowed_users = request.form.get('allowed_users')
-
-        # 检查用户限制
-        current_files_count = current_user.get_total_files_count()
-        current_total_size = current_user.get_total_files_size()
-
-        uploaded_files = []
-        skipped_files = []
-
-        for file in files:
-            if file and file.filename:
-                # 检查单文件大小限制
-                file.seek(0, os.SEEK_END)
-                file_size = file.tell()
-                file.seek(0)
-
-                if file_size > current_user.max_file_size:
-                    skipped_files.append(f'文件 "{file.filename}" 超过单文件大小限制 ({current_user.max_file_size // (1024*1024)}MB)')
-                    continue
-
-                # 检查总文件数量限制
-                if current_files_count >= current_user.max_total_files:
-                    skipped_files.append('已达到总文件数量限制，无法上传更多文件')
-                    break
-
-                # 检查总文件大小限制
-                if current_total_size + file_size > current_user.max_total_size:
-                    skipped_files.append('上传后将超过总文件大小限制，无法上传')
-                    break
-
-                raw_filename = file.filename  # 完全原始的文件名
-                filename = secure_filename(file.filename)
-                unique_filename = str(uuid.uuid4()) + '_' + filename
-                filepath = os.path.join('uploads', unique_filename)
-                file.save(filepath)
-
-                # 处理过期时间
-                expiry_time = None
-                if expiry_type == 'hours' and expiry_hours:
-                    try:
-                        expiry_time = datetime.utcnow() + timedelta(hours=int(expiry_hours))
-                    except ValueError:
-                        skipped_files.append(f'文件 "{file.filename}" 的过期时间格式错误')
-                        continue
-                elif expiry_type == 'custom' and custom_expiry:
-                    try:
-                        expiry_time = datetime.strptime(custom_expiry, '%Y-%m-%d %H:%M')
-                    except ValueError:
-                        skipped_files.append(f'文件 "{file.filename}" 的自定义过期时间格式错误')
-                        continue
-
-                # 处理允许用户列表
-                allowed_users_json = None
-                if share_type == 'specified_users' and allowed_users:
-                    allowed_users_list = [u.strip() for u in allowed_users.split('\n') if u.strip()]
-                    allowed_users_json = json.dumps(allowed_users_list)
-
-                new_file = File(
-                    filename=unique_filename,
-                    original_filename=filename,
-                    raw_filename=raw_filename,
-                    filepath=filepath,
-                    user_id=current_user.id,
-                    is_public=(share_type == 'public'),
-                    share_type=share_type,
-                    allow_view=allow_view,
-                    allow_download=allow_download,
-                    allow_edit=allow_edit,
-                    password=password,
-                    expiry_time=expiry_time,
-                    allowed_users=allowed_users_json
-                )
-                db.session.add(new_file)
-                uploaded_files.append(filename)
-
-                current_files_count += 1
-                current_total_size += file_size
-
-        # 一次性提交所有文件
+        # 文件在解析请求体时直接写入存储，超过单文件大小限制时立即中止
+        uploads = StreamingUploads(get_storage(), current_user.max_file_size)
+        request.file_stream_factory = uploads
         try:
-            db.session.commit()
-            if uploaded_files:
-                flash(f'成功上传 {len(uploaded_files)} 个文件')
-            if skipped_files:
-                for msg in skipped_files:
-                    flash(msg)
-        except Exception as e:
-            db.session.rollback()
-            flash(f'上传失败: {str(e)}')
-
-        return redirect(url_for('main.index'))
+            return _save_uploaded_files()
+        except FileTooLarge as e:
+            flash(f'文件 "{e.filename}" 超过单文件大小限制 ({e.limit // (1024*1024)}MB)，上传已中止')
+            return redirect(request.url)
+        finally:
+            uploads.discard_all()
 
     # GET请求显示表单
     form = UploadForm()
     return render_template('files/upload.html', form=form, config=get_config_dict())
 
-@files_bp.route('/file/<file_id>')
-def view_file(file_id):
-    file = File.query.get_or_404(file_id)
+def _save_uploaded_files():
+    """为已经写入存储的表单文件创建记录"""
+    # 处理通过JavaScript发送的请求（没有CSRF token）
+    files = request.files.getlist('files')
+    if not files:
+        flash('请选择要上传的文件')
+        return redirect(request.url)
+
+    # 获取表单参数
+    share_type = request.form.get('share_type', 'link_only')
+    allow_view = request.form.get('allow_view', 'true').lower() == 'true'
+    allow_download = request.form.get('allow_download', 'true').lower() == 'true'
+    allow_edit = request.form.get('allow_edit', 'false').lower() == 'true'
+    password = request.form.get('password') or None
+    expiry_type = request.form.get('expiry_type', 'never')
+    expiry_hours = request.form.get('expiry_hours')
+    custom_expiry = request.form.get('custom_expiry')
+    allowed_users = request.form.get('allowed_users')
+
+    # 总量限制由 services.quota 原子地检查并计入用量
+    quota.ensure_usage(current_user.id)
+
+    uploaded_files = []
+    skipped_files = []
+
+    for file in files:
+        if file and file.filename:
+            streamed = file.stream
+            file_size = streamed.size
+
+            # 处理过期时间
+            expiry_time = None
+            if expiry_type == 'hours' and expiry_hours:
+                try:
+                    expiry_time = datetime.utcnow() + timedelta(hours=int(expiry_hours))
+                except ValueError:
+                    skipped_files.append(f'文件 "{file.filename}" 的过期时间格式错误')
+                    continue
+            elif expiry_type == 'custom' and custom_expiry:
+                try:
+                    expiry_time = datetime.strptime(custom_expiry, '%Y-%m-%d %H:%M')
+                except ValueError:
+                    skipped_files.append(f'文件 "{file.filename}" 的自定义过期时间格式错误')
+                    continue
 
+            # 处理允许用户列表
+            allowed_users_json = None
+            if share_type == 'specified_users' and allowed_users:
+                allowed_users_list = [u.strip() for u in allowed_users.split('\n') if u.strip()]
+                allowed_users_json = json.dumps(allowed_users_list)
+
+            # 先计入用量并提交，之后任何一步失败都退回
+            try:
+                quota.charge(current_user.id, file_size)
+                db.session.commit()
+            except QuotaExceeded as e:
+                db.session.rollback()
+                skipped_files.append(f'{e}，无法上传')
+                break
+            user_id = current_user.id
+
+            raw_filename = file.filename  # 完全原始的文件名
+            filename = secure_filename(file.filename)
+            storage = get_storage()
+            storage_key = streamed.key
+            unique_filename = storage_key.rsplit('/', 1)[-1]
+            filepath = storage.filepath_for(storage_key)
+            try:
+                streamed.commit()
+            except Exception as e:
+                quota.charge(user_id, -file_size, -1, enforce=False)
+                db.session.commit()
+                skipped_files.append(f'文件 "{file.filename}" 保存失败: {e}')
+                continue
+
+            new_file = File(
+                filename=unique_filename,
+                original_filename=filename,
+                raw_filename=raw_filename,
+                filepath=filepath,
+                file_size=file_size,
+                file_hash=streamed.sha256,
+                user_id=current_user.id,
+                is_public=(share_type == 'public'),
+                share_type=share_type,
+                allow_view=allow_view,
+                allow_download=allow_download,
+                allow_edit=allow_edit,
+                password=password,
+                expiry_time=expiry_time,
+                allowed_users=allowed_users_json
+            )
+            db.session.add(new_file)
+            stats.add_files([new_file])
+            bump_listing_version([current_user.id], public=new_file.is_public)
+            try:
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                storage.delete(storage_key)
+                quota.charge(user_id, -file_size, -1, enforce=False)
+                db.session.commit()
+                skipped_files.append(f'文件 "{file.filename}" 上传失败: {e}')
+                continue
+            uploaded_files.append(filename)
+
+    if uploaded_files:
+        metadata_extractor.wakeup()
+        flash(f'成功上传 {len(uploaded_files)} 个文件')
+    for msg in skipped_files:
+        flash(msg)
+
+    return redirect(url_for('main.index'))
+
+def _check_download_access(file, require_download=True):
+    """检查访问权限、过期时间和下载权限，不允许下载时返回跳转响应，否则返回 None；
+    require_download=False 时允许查看或下载其一即可"""
     # 检查权限
     can_access = False
 
@@ -164,11 +195,87 @@ def view_file(file_id):
         return redirect(url_for('main.index'))
 
     # 检查下载权限
-    if not file.allow_download:
+    if require_download and not file.allow_download:
         flash('此文件不允许下载')
         return redirect(url_for('main.index'))
+    if not (file.allow_view or file.allow_download):
+        flash('此文件不允许查看')
+        return redirect(url_for('main.index'))
 
-    return send_from_directory('uploads', file.filename, as_attachment=True, download_name=file.original_filename)
+    return None
+
+@files_bp.route('/file/<file_id>')
+def view_file(file_id):
+    file = File.query.get_or_404(file_id)
+
+    denied = _check_download_access(file)
+    if denied:
+        return denied
+
+    response = send_stored_file(file, download_name=file.original_filename, as_attachment=True)
+    served = response_bytes(response)
+    access_counter.record(file.id, 'download', served)
+    download_bytes.inc(served, kind='download')
+    return response
+
+@files_bp.route('/file/<file_id>/archive')
+def archive_listing(file_id):
+    """压缩包中的文件列表（JSON），只读取压缩包目录，结果按内容缓存"""
+    file = File.query.get_or_404(file_id)
+
+    # 允许查看或下载时都可以列出内容
+    denied = _check_download_access(file, require_download=False)
+    if denied:
+        return denied
+
+    try:
+        listing = archive_inspector.listing(file)
+    except ArchiveError as e:
+        return jsonify({'error': str(e)}), 415
+    except FileNotFoundError:
+        return jsonify({'error': '文件内容不存在'}), 404
+
+    response = jsonify({'format': listing['format'], 'truncated': listing['truncated'],
+                        'members': [{key: value for key, value in member.items() if key != 'offset'}
+                                    for member in listing['members']]})
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@files_bp.route('/file/<file_id>/archive/<int:index>')
+def download_archive_member(file_id, index):
+    """下载压缩包中的单个文件，流式读取该成员，不解压整个压缩包"""
+    file = File.query.get_or_404(file_id)
+
+    denied = _check_download_access(file)
+    if denied:
+        return denied
+
+    try:
+        response = archive_inspector.send_member(file, index)
+    except (ArchiveError, FileNotFoundError) as e:
+        flash(f'无法下载压缩包中的文件: {e}' if isinstance(e, ArchiveError) else '文件内容不存在')
+        return redirect(url_for('files.file_details', file_id=file.id))
+    served = response_bytes(response)
+    access_counter.record(file.id, 'download', served)
+    download_bytes.inc(served, kind='download')
+    return response
+
+@files_bp.route('/file/<file_id>/versions/<int:version>')
+def download_version(file_id, version):
+    """下载文件的某个版本，由该版本的数据块流式拼接"""
+    file = File.query.get_or_404(file_id)
+
+    denied = _check_download_access(file)
+    if denied:
+        return denied
+
+    file_version = FileVersion.query.filter_by(file_id=file.id, version=version).first_or_404()
+    name, ext = os.path.splitext(file.original_filename)
+    response = send_version(get_storage(), file, file_version, download_name=f'{name} (v{version}){ext}')
+    served = response_bytes(response)
+    access_counter.record(file.id, 'download', served)
+    download_bytes.inc(served, kind='download')
+    return response
 
 @files_bp.route('/preview/<file_id>')
 def preview_file(file_id):
@@ -262,7 +369,10 @@ def preview_file(file_id):
             abort(403)  # 对于非图片文件，仍然检查Accept头
 
     # 返回文件内容用于预览，设置安全头
-    response = send_from_directory('uploads', file.filename)
+    response = send_stored_file(file)
+    served = response_bytes(response)
+    access_counter.record(file.id, 'view', served)
+    download_bytes.inc(served, kind='view')
 
     # 根据文件类型设置不同的缓存策略
     _, ext = os.path.splitext(file.original_filename.lower())
@@ -279,6 +389,33 @@ def preview_file(file_id):
 
     return response
 
+@files_bp.route('/preview/<file_id>/lines')
+def preview_lines(file_id):
+    """文本文件按行分页预览：start/count 指定行范围，tail 返回最后若干行"""
+    file = File.query.get_or_404(file_id)
+
+    denied = _check_download_access(file, require_download=False)
+    if denied:
+        return denied
+
+    try:
+        tail = request.args.get('tail', type=int)
+        if tail:
+            page = text_preview.tail(file, tail)
+        else:
+            page = text_preview.read_lines(file, request.args.get('start', 1, type=int),
+                                           request.args.get('count', 200, type=int))
+    except NotTextError as e:
+        return jsonify({'error': str(e)}), 415
+    except FileNotFoundError:
+        return jsonify({'error': '文件内容不存在'}), 404
+
+    if page['start'] == 1:
+        access_counter.record(file.id, 'view')
+    response = jsonify(page)
+    response.headers['Cache-Control'] = 'private, no-store'
+    return response
+
 @files_bp.route('/share/<file_id>', methods=['GET', 'POST'])
 @login_required
 def share_file(file_id):
@@ -307,6 +444,7 @@ def share_file(file_id):
             allowed_users_json = json.dumps(allowed_users)
 
         # 更新文件设置
+        before = stats.entry(file)
         file.is_public = (form.share_type.data == 'public')
         file.share_type = form.share_type.data
         file.allow_view = form.allow_view.data
@@ -315,6 +453,8 @@ def share_file(file_id):
         file.password = form.password.data if form.password.data else None
         file.expiry_time = expiry_time
         file.allowed_users = allowed_users_json
+        stats.replace_file(before, file)
+        bump_listing_version([file.user_id], public=before.share_type == 'public' or file.is_public)
 
         db.session.commit()
         flash('分享设置已更新')
@@ -394,10 +534,7 @@ def file_details(file_id):
         return redirect(url_for('main.index'))
 
     # 获取文件大小
-    try:
-        file_size = os.path.getsize(file.filepath)
-    except:
-        file_size = 0
+    file_size = file.get_size()
 
     # 获取文件扩展名（优先使用raw_filename，如果没有扩展名则使用存储文件名）
     filename_for_ext = file.raw_filename or file.original_filename
@@ -414,7 +551,6 @@ def file_details(file_id):
     # 判断是否可以预览（只要有查看权限就可以预览）
     can_preview = False
     preview_type = None
-    preview_content = None
 
     # 在session中记录用户有权限预览的文件
     from flask import session
@@ -425,7 +561,12 @@ def file_details(file_id):
         'user_id': current_user.id if current_user.is_authenticated else None
     }
 
-    if ext in ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp']:
+    media_info = file.media_info
+    if media_info is not None:
+        # 元数据已提取时按文件头识别的真实类型预览，扩展名与内容不符的文件不会被当作图片、视频等
+        preview_type = PREVIEW_TYPES.get(media_info.mime_type) or ('text' if media_info.kind == 'text' else None)
+        can_preview = preview_type is not None
+    elif ext in ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp']:
         can_preview = True
         preview_type = 'image'
     elif ext in ['.mp4', '.avi', '.mov', '.wmv', '.flv', '.webm']:
@@ -437,23 +578,25 @@ def file_details(file_id):
     elif ext in ['.pdf']:
         can_preview = True
         preview_type = 'pdf'
-    elif ext in ['.txt', '.md', '.py', '.js', '.html', '.css', '.json', '.xml']:
-        # 只对小文件进行内容预览，避免大文件读取导致页面加载慢
-        if file_size <= 1024 * 1024:  # 1MB以下的文件才预览内容
-            can_preview = True
-            preview_type = 'text'
-            # 读取文本文件内容进行预览，减少读取量
-            try:
-                with open(file.filepath, 'r', encoding='utf-8', errors='ignore') as f:
-                    preview_content = f.read(2048)  # 只读取2KB
-            except:
-                preview_content = "无法读取文件内容"
-        else:
-            # 大文件不预览内容，但仍然标记为可预览（用于显示文件类型图标等）
-            can_preview = True
-            preview_type = 'text_large'
-            preview_content = f"文件较大 ({file_size // 1024}KB)，内容预览已跳过"
+    elif ext in TEXT_EXTENSIONS:
+        # 内容由页面按行分页加载（preview_lines），任意大小的文件都只读取显示的部分
+        can_preview = True
+        preview_type = 'text'
+
+    # 压缩包的文件列表由页面单独加载（archive_listing）
+    is_archive = archive_format(filename_for_ext) is not None
+
+    # 访问统计：已写入数据库的计数加上本进程中尚未刷新的部分
+    access_stats = {'downloads': file.download_count or 0, 'views': file.view_count or 0,
+                    'bytes': file.bytes_served or 0, 'last': file.last_accessed_at}
+    pending = access_counter.get_pending(file.id)
+    if pending:
+        access_stats['downloads'] += pending['downloads']
+        access_stats['views'] += pending['views']
+        access_stats['bytes'] += pending['bytes']
+        access_stats['last'] = pending['last']
 
     return render_template('files/file_details.html', file=file, file_size=file_size,
-                         can_preview=can_preview, preview_type=preview_type, preview_content=preview_content,
+                         can_preview=can_preview, preview_type=preview_type, is_archive=is_archive,
+                         access_stats=access_stats,
                          current_time=datetime.utcnow(), config=get_config_dict())
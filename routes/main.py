@@ -1,22 +1,25 @@
-from flask import Blueprint, render_template, redirect, url_for, flash, request, send_from_directory
+from flask import Blueprint, render_template, redirect, url_for, flash, request
 from flask_login import login_required, current_user
 from models import File
+from sqlalchemy.orm import selectinload
 from forms import ProfileForm
 from utils import get_config_dict
-from datetime import datetime
+from services.listing_cache import listing_cache
+from services.public_listing import public_listing
+from services.assets import assets
 
 main_bp = Blueprint('main', __name__)
 
 @main_bp.route('/')
 def index():
-    if current_user.is_authenticated:
-        files = File.query.filter_by(user_id=current_user.id).all()
-    else:
-        # 过滤过期的公开文件
-        files = File.query.filter_by(is_public=True).filter(
-            (File.expiry_time.is_(None)) | (File.expiry_time > datetime.utcnow())
-        ).all()
-    return render_template('index.html', files=files, config=get_config_dict())
+    if not current_user.is_authenticated:
+        # 匿名访客看到的公开文件列表对所有人相同，直接使用快照
+        return public_listing.response()
+    # 列表未变化时直接使用缓存，不查询文件
+    listing = listing_cache.render_user_listing(
+        current_user, lambda: File.query.filter_by(user_id=current_user.id).options(
+            selectinload(File.media_info)).all())
+    return render_template('index.html', listing=listing, config=get_config_dict())
 
 @main_bp.route('/profile', methods=['GET', 'POST'])
 @login_required
@@ -60,4 +63,5 @@ def set_language(lang):
 
 @main_bp.route("/bg.jpeg")
 def bg_jpeg():
-    return send_from_directory('static', 'bg.jpeg')
+    # 旧地址，转到可以永久缓存的带哈希地址
+    return redirect(assets.url('bg.jpeg'))
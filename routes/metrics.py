@@ -0,0 +1,36 @@
+from flask import Blueprint, Response, abort, current_app, request
+import hmac
+
+from models import UploadTask, UnlinkTask
+from services import stats
+from services.metrics import metrics_exporter, render
+
+# 指标蓝图
+metrics_bp = Blueprint('metrics', __name__)
+
+@metrics_bp.route('/metrics')
+def metrics():
+    """Prometheus 指标；配置了 METRICS_TOKEN 时需要 Bearer 令牌，否则只允许本机访问"""
+    if not current_app.config['METRICS_ENABLED']:
+        abort(404)
+
+    token = current_app.config['METRICS_TOKEN']
+    if token:
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+            abort(403)
+    elif request.remote_addr not in ('127.0.0.1', '::1'):
+        abort(403)
+
+    # 数据库中的瞬时值在抓取时查询；文件数和存储量读取统计汇总，不扫描 File 表
+    gauges = {
+        'upload_tasks_active': ('进行中的分块上传任务数', UploadTask.query.filter_by(status='uploading').count()),
+        'unlink_queue_pending': ('待删除的存储文件数', UnlinkTask.query.count()),
+    }
+    totals = stats.storage_totals()
+    if totals is not None:  # 汇总尚未建立时不输出，避免报出错误的数值
+        files_total, logical_bytes, stored_bytes = totals
+        gauges['files_total'] = ('文件记录数', files_total)
+        gauges['storage_logical_bytes'] = ('文件原始大小总和', logical_bytes)
+        gauges['storage_used_bytes'] = ('文件在存储中实际占用的字节数（压缩后）', stored_bytes)
+
+    return Response(render(metrics_exporter, gauges), mimetype='text/plain; version=0.0.4; charset=utf-8')
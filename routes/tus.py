@@ -0,0 +1,242 @@
+from flask import Blueprint, Response, current_app, jsonify, request, url_for
+from flask_login import login_required, current_user
+from werkzeug.http import http_date
+from models import UploadTask, db
+from routes.api import file_from_task, share_options
+from storage import get_storage
+from services import quota, stats, tus
+from services.quota import QuotaExceeded
+from services.tus import TusError
+from services.listing_cache import bump_listing_version
+from services.metadata import metadata_extractor
+from datetime import datetime, timedelta
+import hashlib
+import json
+import logging
+
+# tus 可续传上传蓝图
+tus_bp = Blueprint('tus', __name__)
+
+# 元数据中的布尔选项以字符串传入
+_BOOLEAN_OPTIONS = ('allow_view', 'allow_download', 'allow_edit')
+
+
+def _error(status, message):
+    return jsonify({'error': message}), status
+
+
+@tus_bp.before_request
+def check_version():
+    """除 OPTIONS 外的请求必须声明支持的协议版本"""
+    if request.method != 'OPTIONS' and request.headers.get('Tus-Resumable') != tus.TUS_VERSION:
+        response = Response(status=412)
+        response.headers['Tus-Version'] = tus.TUS_VERSION
+        return response
+
+
+@tus_bp.after_request
+def add_tus_headers(response):
+    response.headers['Tus-Resumable'] = tus.TUS_VERSION
+    return response
+
+
+def _expires_at(task):
+    """没有新数据时任务被过期清理的时间"""
+    expires = (task.updated_at or task.created_at) + timedelta(hours=current_app.config['UPLOAD_TASK_TTL_HOURS'])
+    if task.expired_at:
+        expires = min(expires, task.expired_at)
+    return expires
+
+
+def _get_task(task_id):
+    return UploadTask.query.filter(
+        UploadTask.id == task_id,
+        UploadTask.user_id == current_user.id,
+        UploadTask.upload_offset.isnot(None)
+    ).first()
+
+
+def _complete(task, file_hash):
+    """上传完成：暂存文件移入存储并创建文件记录，任务已被终止或过期时返回 False"""
+    storage = get_storage()
+    size = storage.complete_append(task.storage_key, task.storage_upload_id)
+    task.file_hash = file_hash
+    new_file = file_from_task(task, size)
+    if not quota.finish_task(task, 'completed'):
+        db.session.rollback()
+        storage.delete(task.storage_key)
+        return False
+    db.session.add(new_file)
+    stats.add_files([new_file])
+    bump_listing_version([task.user_id], public=new_file.is_public)
+    db.session.commit()
+    metadata_extractor.wakeup()
+    return True
+
+
+@tus_bp.route('/', methods=['OPTIONS'])
+@tus_bp.route('/<task_id>', methods=['OPTIONS'])
+def options(task_id=None):
+    """服务端支持的协议版本和扩展"""
+    response = Response(status=204)
+    response.headers['Tus-Version'] = tus.TUS_VERSION
+    response.headers['Tus-Extension'] = ','.join(tus.TUS_EXTENSIONS)
+    response.headers['Tus-Checksum-Algorithm'] = ','.join(tus.CHECKSUM_ALGORITHMS)
+    if current_user.is_authenticated:
+        response.headers['Tus-Max-Size'] = str(current_user.max_file_size)
+    return response
+
+
+@tus_bp.route('/', methods=['POST'])
+@login_required
+def create_upload():
+    """创建上传（creation 扩展），文件名和分享选项放在 Upload-Metadata 中"""
+    try:
+        if 'Upload-Defer-Length' in request.headers:
+            return _error(400, '不支持延迟指定上传大小')
+        try:
+            file_size = int(request.headers['Upload-Length'])
+        except (KeyError, ValueError):
+            return _error(400, '缺少或无效的 Upload-Length')
+        if file_size < 0:
+            return _error(400, '缺少或无效的 Upload-Length')
+        if file_size > current_user.max_file_size:
+            return _error(413, f'文件大小超过限制 ({current_user.max_file_size // (1024*1024)}MB)')
+
+        try:
+            metadata = tus.parse_metadata(request.headers.get('Upload-Metadata'))
+        except TusError as e:
+            return _error(e.status, str(e))
+        for name in _BOOLEAN_OPTIONS:
+            if name in metadata:
+                metadata[name] = metadata[name].lower() in ('1', 'true', 'yes', 'on')
+        file_name = metadata.get('filename') or metadata.get('name') or 'upload'
+        content_type = metadata.get('filetype') or metadata.get('type') or 'application/octet-stream'
+
+        storage = get_storage()
+        new_task = UploadTask(
+            user_id=current_user.id,
+            file_hash=metadata.get('hash', ''),
+            file_name=file_name,
+            file_size=file_size,
+            content_type=content_type,
+            chunk_size=0,
+            chunks_count=0,
+            upload_offset=0,
+            share_options=json.dumps(share_options(metadata))
+        )
+        new_task.storage_key = storage.new_key(file_name)
+        new_task.storage_upload_id = storage.begin_append(new_task.storage_key)
+
+        # 与分块上传相同，预留配额和任务在同一事务中提交
+        quota.ensure_usage(current_user.id)
+        try:
+            quota.reserve(current_user.id, file_size)
+        except QuotaExceeded as e:
+            db.session.rollback()
+            storage.abort_append(new_task.storage_key, new_task.storage_upload_id)
+            return _error(403, str(e))
+        db.session.add(new_task)
+        db.session.commit()
+
+        if file_size == 0:
+            _complete(new_task, hashlib.sha256().hexdigest())
+
+        response = Response(status=201)
+        response.headers['Location'] = url_for('tus.upload_offset', task_id=new_task.id, _external=True)
+        response.headers['Upload-Expires'] = http_date(_expires_at(new_task))
+        return response
+
+    except Exception as e:
+        logging.error(f"创建 tus 上传失败: {str(e)}", exc_info=True)
+        return _error(500, '服务器内部错误，请稍后重试')
+
+
+@tus_bp.route('/<task_id>', methods=['HEAD'])
+@login_required
+def upload_offset(task_id):
+    """查询已接收的字节数，客户端据此续传"""
+    task = _get_task(task_id)
+    if not task:
+        return Response(status=404)
+    if task.status == 'completed':
+        offset = task.file_size
+    elif task.status == 'uploading':
+        try:
+            offset = get_storage().appended_size(task.storage_key, task.storage_upload_id)
+        except FileNotFoundError:
+            return Response(status=410)
+    else:
+        return Response(status=410)
+
+    response = Response(status=200)
+    response.headers['Upload-Offset'] = str(offset)
+    response.headers['Upload-Length'] = str(task.file_size)
+    response.headers['Cache-Control'] = 'no-store'
+    if task.status == 'uploading':
+        response.headers['Upload-Expires'] = http_date(_expires_at(task))
+    return response
+
+
+@tus_bp.route('/<task_id>', methods=['PATCH'])
+@login_required
+def append_data(task_id):
+    """从 Upload-Offset 处追加数据，收到全部数据后创建文件"""
+    try:
+        task = _get_task(task_id)
+        if not task:
+            return _error(404, '上传任务不存在')
+        if task.status != 'uploading':
+            return _error(410, '上传任务已完成或失败')
+        if request.mimetype != 'application/offset+octet-stream':
+            return _error(415, 'Content-Type 必须为 application/offset+octet-stream')
+        try:
+            offset = int(request.headers['Upload-Offset'])
+        except (KeyError, ValueError):
+            return _error(400, '缺少或无效的 Upload-Offset')
+
+        try:
+            checksum = request.headers.get('Upload-Checksum')
+            if checksum is not None:
+                checksum = tus.parse_checksum(checksum)
+            new_offset, file_hash = tus.append(get_storage(), task, offset, request.stream,
+                                               request.content_length, checksum)
+        except TusError as e:
+            return _error(e.status, str(e))
+
+        # 只记录进度和活动时间，过期清理据此判断上传是否仍在进行
+        result = db.session.execute(db.update(UploadTask).where(
+            UploadTask.id == task.id, UploadTask.status == 'uploading'
+        ).values(upload_offset=new_offset, updated_at=datetime.utcnow()).execution_options(synchronize_session=False))
+        db.session.commit()
+        if result.rowcount != 1:
+            return _error(410, '上传任务已终止或过期')
+
+        if new_offset == task.file_size and not _complete(task, file_hash):
+            return _error(410, '上传任务已终止或过期')
+
+        db.session.refresh(task)
+        response = Response(status=204)
+        response.headers['Upload-Offset'] = str(new_offset)
+        if task.status == 'uploading':
+            response.headers['Upload-Expires'] = http_date(_expires_at(task))
+        return response
+
+    except Exception as e:
+        logging.error(f"tus 追加数据失败: {str(e)}", exc_info=True)
+        return _error(500, '服务器内部错误，请稍后重试')
+
+
+@tus_bp.route('/<task_id>', methods=['DELETE'])
+@login_required
+def terminate_upload(task_id):
+    """终止上传（termination 扩展），释放预留配额并删除已接收的数据"""
+    task = _get_task(task_id)
+    if not task:
+        return _error(404, '上传任务不存在')
+    if not quota.finish_task(task, 'cancelled'):
+        db.session.rollback()
+        return _error(410, '上传任务已完成或失败')
+    db.session.commit()
+    get_storage().abort_append(task.storage_key, task.storage_upload_id)
+    return Response(status=204)
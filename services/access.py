@@ -0,0 +1,130 @@
+"""
+文件访问计数
+下载和预览只在进程内存中累加，由后台线程定期用一条批量 UPDATE 写回 File 表，
+请求路径上不产生数据库写入
+"""
+
+import atexit
+import logging
+import threading
+from datetime import datetime
+
+from models import File, db
+from services import stats
+from services.background import BackgroundWorker
+
+logger = logging.getLogger(__name__)
+
+_table = File.__table__
+
+
+class AccessCounter(BackgroundWorker):
+    """按文件缓冲访问计数，每个进程各自定期刷新"""
+
+    name = 'access-counter'
+    enabled_config = ('ACCESS_COUNTER_ENABLED', True)
+    interval_config = ('ACCESS_COUNTER_INTERVAL', 30)  # 秒
+    single_process = False
+    default_metrics = {
+        'flushes_total': 0,
+        'rows_flushed_total': 0,
+        'flush_errors_total': 0,
+        'last_flush_at': None,
+    }
+
+    def __init__(self, app=None):
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        super().__init__(app)
+
+    def init_app(self, app):
+        super().init_app(app)
+        # 进程退出时写回尚未刷新的计数
+        atexit.register(self.flush)
+
+    def run_once(self):
+        self.flush()
+
+    def record(self, file_id, kind, bytes_served=0):
+        """记录一次访问，kind 为 'download' 或 'view'"""
+        now = datetime.utcnow()
+        with self._pending_lock:
+            entry = self._pending.get(file_id)
+            if entry is None:
+                entry = self._pending[file_id] = {'downloads': 0, 'views': 0, 'bytes': 0, 'last': now}
+            entry['downloads' if kind == 'download' else 'views'] += 1
+            entry['bytes'] += bytes_served
+            entry['last'] = now
+
+    def get_pending(self, file_id):
+        """本进程中尚未写回的计数"""
+        with self._pending_lock:
+            entry = self._pending.get(file_id)
+            return dict(entry) if entry else None
+
+    def flush(self):
+        """把缓冲的计数写回数据库，返回写入的文件数"""
+        if self.app is None:
+            return 0
+        with self._flush_lock:
+            with self._pending_lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return 0
+
+            params = [
+                {'b_id': file_id, 'b_downloads': entry['downloads'], 'b_views': entry['views'],
+                 'b_bytes': entry['bytes'], 'b_last': entry['last']}
+                for file_id, entry in pending.items()
+            ]
+            last = db.bindparam('b_last')
+            # 已被删除的文件匹配不到行，其计数直接丢弃
+            statement = db.update(_table).where(_table.c.id == db.bindparam('b_id')).values(
+                download_count=db.func.coalesce(_table.c.download_count, 0) + db.bindparam('b_downloads'),
+                view_count=db.func.coalesce(_table.c.view_count, 0) + db.bindparam('b_views'),
+                bytes_served=db.func.coalesce(_table.c.bytes_served, 0) + db.bindparam('b_bytes'),
+                last_accessed_at=db.case((_table.c.last_accessed_at > last, _table.c.last_accessed_at), else_=last),
+            )
+            with self.app.app_context():
+                try:
+                    db.session.execute(statement, params)
+                    stats.record_access(sum(entry['downloads'] for entry in pending.values()),
+                                        sum(entry['views'] for entry in pending.values()),
+                                        sum(entry['bytes'] for entry in pending.values()))
+                    db.session.commit()
+                except Exception as e:
+                    db.session.rollback()
+                    self._restore(pending)
+                    self._incr_metrics(flush_errors_total=1)
+                    logger.warning(f"写入访问计数失败，将在下次重试: {e}")
+                    return 0
+                finally:
+                    db.session.remove()
+
+            self._incr_metrics(flushes_total=1, rows_flushed_total=len(params))
+            self._update_metrics(last_flush_at=datetime.utcnow().isoformat())
+            return len(params)
+
+    def _restore(self, pending):
+        """写入失败时把计数合并回缓冲区"""
+        with self._pending_lock:
+            for file_id, entry in pending.items():
+                current = self._pending.get(file_id)
+                if current is None:
+                    self._pending[file_id] = entry
+                    continue
+                current['downloads'] += entry['downloads']
+                current['views'] += entry['views']
+                current['bytes'] += entry['bytes']
+                current['last'] = max(current['last'], entry['last'])
+
+
+def response_bytes(response):
+    """响应实际要发送的正文字节数，重定向和 304 等不计"""
+    if response.status_code in (200, 206) and response.content_length:
+        return response.content_length
+    return 0
+
+
+access_counter = AccessCounter()
@@ -0,0 +1,206 @@
+"""
+压缩包内容查看
+列出 zip / tar 压缩包中的文件，并单独下载其中一个文件，不解压整个压缩包到磁盘：
+zip 只读取末尾的中央目录，单个成员按其本地头定位读取；
+未压缩的 tar 只读取每个成员的头部并跳过数据，成员数据按记录的偏移直接读取；
+tar.gz 等压缩的 tar 无法定位，列目录和取出成员都需要顺序解压到该成员为止。
+目录按 File.content_key 缓存在 instance/archive_index，同一内容只列一次
+"""
+
+import json
+import logging
+import mimetypes
+import os
+import posixpath
+import tarfile
+import tempfile
+import zipfile
+from contextlib import closing
+from datetime import datetime
+
+from flask import Response, request, stream_with_context
+
+from services.background import StripedLock
+from services.compression import iter_file_range, open_file, open_seekable
+from storage.base import CHUNK_SIZE, content_disposition
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+TAR_STREAM_SUFFIXES = ('.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+
+
+class ArchiveError(Exception):
+    """文件不是支持的压缩包，或成员无法读取"""
+
+
+def archive_format(filename):
+    """按文件名判断压缩包格式：'zip'、'tar'（可定位）、'tar_stream'（需顺序解压），其他返回 None"""
+    name = (filename or '').lower()
+    if name.endswith('.zip'):
+        return 'zip'
+    if name.endswith('.tar'):
+        return 'tar'
+    if name.endswith(TAR_STREAM_SUFFIXES):
+        return 'tar_stream'
+    return None
+
+
+def _zip_name(info):
+    """没有 UTF-8 标记的文件名按 GBK 解码（Windows 中文系统生成的 zip）"""
+    if info.flag_bits & 0x800:
+        return info.filename
+    try:
+        return info.filename.encode('cp437').decode('gbk')
+    except (UnicodeEncodeError, UnicodeDecodeError):
+        return info.filename
+
+
+class ArchiveInspector:
+    """列出压缩包内容并取出单个成员，目录缓存在实例目录中"""
+
+    def __init__(self, app=None):
+        self.directory = None
+        self.max_members = 10000
+        self._lock = StripedLock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('ARCHIVE_MAX_MEMBERS', 10000)
+        self.directory = os.path.join(app.instance_path, 'archive_index')
+        self.max_members = app.config['ARCHIVE_MAX_MEMBERS']
+        app.extensions['archive_inspector'] = self
+
+    def _path(self, file):
+        key = file.content_key
+        return os.path.join(self.directory, key[:2], f'{key}.json')
+
+    def listing(self, file):
+        """压缩包的成员列表：{'format', 'members', 'truncated'}，每个成员带 index，按 index 取出"""
+        kind = archive_format(file.raw_filename or file.original_filename)
+        if kind is None:
+            raise ArchiveError('不是支持的压缩包格式')
+        path = self._path(file)
+        with self._lock(path):
+            try:
+                with open(path, encoding='utf-8') as f:
+                    listing = json.load(f)
+                if (listing.get('version') == FORMAT_VERSION and listing.get('format') == kind
+                        and listing.get('size') == file.file_size):
+                    return listing
+            except FileNotFoundError:
+                pass
+            except ValueError as e:
+                logger.warning(f"压缩包目录缓存 {path} 无效，重新读取: {e}")
+
+            members, truncated = self._read_listing(file, kind)
+            listing = {'version': FORMAT_VERSION, 'format': kind, 'size': file.file_size,
+                       'members': members, 'truncated': truncated}
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    json.dump(listing, f, ensure_ascii=False)
+                os.replace(tmp, path)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+            return listing
+
+    def _read_listing(self, file, kind):
+        members = []
+        try:
+            if kind == 'zip':
+                with closing(open_seekable(file)) as stream, zipfile.ZipFile(stream) as archive:
+                    for index, info in enumerate(archive.infolist()):
+                        if index >= self.max_members:
+                            return members, True
+                        members.append({
+                            'index': index,
+                            'name': _zip_name(info),
+                            'size': info.file_size,
+                            'compressed_size': info.compress_size,
+                            'mtime': datetime(*info.date_time).isoformat(),
+                            'is_dir': info.is_dir(),
+                            'readable': not info.is_dir() and not info.flag_bits & 0x1,
+                        })
+                return members, False
+
+            # 可定位的 tar 跳过成员数据时直接 seek，只读取头部；
+            # 冷数据压缩后的 tar 无法定位，和 tar.gz 一样顺序读取一遍
+            seekable = kind == 'tar' and not file.is_compressed
+            stream = open_seekable(file) if seekable else open_file(file)
+            mode = 'r:' if seekable else 'r|*'
+            with closing(stream), tarfile.open(fileobj=stream, mode=mode) as archive:
+                for index, info in enumerate(archive):
+                    if index >= self.max_members:
+                        return members, True
+                    members.append({
+                        'index': index,
+                        'name': info.name,
+                        'size': info.size,
+                        'compressed_size': None,
+                        'mtime': datetime.utcfromtimestamp(info.mtime).isoformat(),
+                        'is_dir': info.isdir(),
+                        'readable': info.isfile(),
+                        'offset': info.offset_data if kind == 'tar' else None,
+                    })
+            return members, False
+        except (zipfile.BadZipFile, tarfile.TarError, EOFError, OSError) as e:
+            if isinstance(e, FileNotFoundError):
+                raise
+            raise ArchiveError(f'无法读取压缩包: {e}')
+
+    def member(self, file, index):
+        """目录中第 index 个成员的信息，不存在或不是普通文件时抛出 ArchiveError"""
+        listing = self.listing(file)
+        if not 0 <= index < len(listing['members']):
+            raise ArchiveError('压缩包中没有该文件')
+        member = listing['members'][index]
+        if not member['readable']:
+            raise ArchiveError('该项不是可读取的文件')
+        return listing['format'], member
+
+    def _iter_member(self, file, kind, member):
+        """按块产出成员的解压后内容"""
+        if kind == 'tar':
+            yield from iter_file_range(file, member['offset'], member['offset'] + member['size'])
+            return
+        if kind == 'zip':
+            with closing(open_seekable(file)) as stream, zipfile.ZipFile(stream) as archive:
+                with archive.open(archive.infolist()[member['index']]) as source:
+                    for data in iter(lambda: source.read(CHUNK_SIZE), b''):
+                        yield data
+            return
+        with closing(open_file(file)) as stream, tarfile.open(fileobj=stream, mode='r|*') as archive:
+            for index, info in enumerate(archive):
+                if index == member['index']:
+                    source = archive.extractfile(info)
+                    for data in iter(lambda: source.read(CHUNK_SIZE), b''):
+                        yield data
+                    return
+
+    def send_member(self, file, index):
+        """单个成员的下载响应，内容在发送时流式读取"""
+        kind, member = self.member(file, index)
+        download_name = posixpath.basename(member['name'].rstrip('/')) or 'download'
+        etag = f"{file.file_hash.lower()}-{index}" if file.file_hash else None
+        mimetype = mimetypes.guess_type(download_name)[0] or 'application/octet-stream'
+
+        if etag and request.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+
+        # 读取成员需要访问存储，生成器在响应发送时执行，保留请求上下文
+        response = Response(stream_with_context(self._iter_member(file, kind, member)), mimetype=mimetype,
+                            direct_passthrough=True)
+        response.content_length = member['size']
+        response.headers['Content-Disposition'] = content_disposition(download_name)
+        if etag:
+            response.set_etag(etag)
+        return response
+
+
+archive_inspector = ArchiveInspector()
@@ -0,0 +1,239 @@
+"""
+静态资源
+static/ 中的文件以内容哈希命名（style.css → style.3f2a9c1b04de.css），通过 /assets/ 提供，
+响应带 Cache-Control: immutable，浏览器在内容变化（文件名随之变化）之前不会重新请求。
+可压缩的文件预先生成 gzip 和 brotli（需要安装 brotli）版本，按 Accept-Encoding 选择；
+后台设置的背景图片如果是本地文件，另生成几种宽度的缩小版本（需要安装 Pillow），页面按窗口宽度选择。
+生成的文件保存在 instance/assets，以内容哈希命名，多个进程和重启之间共用
+"""
+
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import tempfile
+import threading
+from urllib.parse import urlsplit
+
+from flask import abort, redirect, request, send_file, url_for
+from werkzeug.security import safe_join
+
+from services.compression import COMPRESSED_EXTENSIONS
+
+try:
+    import brotli
+except ImportError:  # brotli 为可选依赖
+    brotli = None
+
+try:
+    from PIL import Image
+except ImportError:  # 图片缩放为可选依赖
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# 编码按优先顺序排列
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+# 可以缩放的背景图片格式
+RESIZABLE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp'}
+
+
+class Asset:
+    """一个以内容哈希命名的静态资源及其预压缩版本"""
+
+    def __init__(self, name, path, digest):
+        self.name = name
+        self.path = path
+        self.digest = digest
+        stem, ext = os.path.splitext(name)
+        self.url_name = f'{stem}.{digest}{ext}'
+        self.mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        self.encodings = {}  # 编码 -> 预压缩文件路径
+        self.variants = None  # [(宽度, Asset)]，背景图片首次使用时生成
+
+
+def _file_digest(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(block)
+    return sha.hexdigest()[:12]
+
+
+def _write_atomic(path, data):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+class AssetPipeline:
+    """静态资源的指纹、预压缩和响应式图片"""
+
+    def __init__(self, app=None):
+        self.static_folder = None
+        self.directory = None
+        self.widths = ()
+        self.quality = 82
+        self._assets = None  # 原文件名 -> Asset
+        self._by_url = {}  # 带哈希的文件名 -> Asset
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('ASSET_IMAGE_WIDTHS', (640, 1280, 1920, 2560))
+        app.config.setdefault('ASSET_IMAGE_QUALITY', 82)
+        self.static_folder = app.static_folder
+        self.directory = os.path.join(app.instance_path, 'assets')
+        self.widths = tuple(sorted(app.config['ASSET_IMAGE_WIDTHS']))
+        self.quality = app.config['ASSET_IMAGE_QUALITY']
+        app.add_template_global(self.url, 'asset_url')
+        app.add_template_global(self.background_variants, 'background_variants')
+        app.extensions['assets'] = self
+
+    def _build(self):
+        """扫描 static/，计算哈希并生成缺少的预压缩文件"""
+        os.makedirs(self.directory, exist_ok=True)
+        assets = {}
+        for root, _, files in os.walk(self.static_folder):
+            for filename in files:
+                path = os.path.join(root, filename)
+                name = os.path.relpath(path, self.static_folder).replace(os.sep, '/')
+                asset = Asset(name, path, _file_digest(path))
+                if os.path.splitext(name)[1].lower() not in COMPRESSED_EXTENSIONS:
+                    self._precompress(asset)
+                assets[name] = asset
+        self._by_url = {asset.url_name: asset for asset in assets.values()}
+        self._assets = assets
+
+    def _precompress(self, asset):
+        data = None
+        flat_name = asset.url_name.replace('/', '_')
+        for encoding, suffix in ENCODINGS:
+            if encoding == 'br' and brotli is None:
+                continue
+            target = os.path.join(self.directory, flat_name + suffix)
+            if not os.path.exists(target):
+                if data is None:
+                    with open(asset.path, 'rb') as f:
+                        data = f.read()
+                compressed = brotli.compress(data) if encoding == 'br' else gzip.compress(data, 9, mtime=0)
+                if len(compressed) >= len(data):
+                    continue
+                _write_atomic(target, compressed)
+            asset.encodings[encoding] = target
+
+    def _ensure_built(self):
+        if self._assets is None:
+            with self._lock:
+                if self._assets is None:
+                    self._build()
+        return self._assets
+
+    def url(self, name):
+        """static/ 中文件的带哈希地址，文件不存在时退回普通的 static 地址"""
+        asset = self._ensure_built().get(name)
+        if asset is None:
+            return url_for('static', filename=name)
+        return url_for('assets.asset', name=asset.url_name)
+
+    def _local_asset(self, url):
+        """后台配置的图片地址对应的本地静态文件"""
+        path = urlsplit(url).path
+        if path == '/bg.jpeg':
+            name = 'bg.jpeg'
+        elif path.startswith('/static/'):
+            name = path[len('/static/'):]
+        else:
+            return None
+        if safe_join(self.static_folder, name) is None:
+            return None
+        return self._ensure_built().get(name)
+
+    def _resize(self, asset):
+        """生成比原图窄的各宽度版本"""
+        variants = []
+        try:
+            with Image.open(asset.path) as image:
+                image.load()
+                width, height = image.size
+                stem, ext = os.path.splitext(asset.url_name.replace('/', '_'))
+                for target_width in self.widths:
+                    if target_width >= width:
+                        break
+                    target = os.path.join(self.directory, f'{stem}.{target_width}w{ext}')
+                    if not os.path.exists(target):
+                        resized = image.resize((target_width, max(1, round(height * target_width / width))),
+                                               Image.LANCZOS)
+                        if ext.lower() in ('.jpg', '.jpeg') and resized.mode != 'RGB':
+                            resized = resized.convert('RGB')
+                        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.tmp-', suffix=ext)
+                        os.close(fd)
+                        try:
+                            resized.save(tmp, quality=self.quality, optimize=True, progressive=True)
+                            os.replace(tmp, target)
+                        except BaseException:
+                            os.unlink(tmp)
+                            raise
+                    variant = Asset(asset.name, target, asset.digest)
+                    variant.url_name = os.path.basename(target)
+                    variants.append((target_width, variant))
+        except OSError as e:
+            logger.warning(f"生成 {asset.name} 的缩小版本失败: {e}")
+            return []
+        return variants
+
+    def background_variants(self, url):
+        """背景图片的各宽度版本 [(宽度, 地址)]，按宽度递增，最后一项是原图（宽度为 None）"""
+        if not url:
+            return []
+        asset = self._local_asset(url)
+        if asset is None:
+            return [(None, url)]
+        if asset.variants is None:
+            variants = []
+            if Image is not None and os.path.splitext(asset.name)[1].lower() in RESIZABLE_EXTENSIONS:
+                variants = self._resize(asset)
+            with self._lock:
+                for _, variant in variants:
+                    self._by_url[variant.url_name] = variant
+                asset.variants = variants
+        return ([(width, url_for('assets.asset', name=variant.url_name)) for width, variant in asset.variants]
+                + [(None, url_for('assets.asset', name=asset.url_name))])
+
+    def send(self, name):
+        """返回带哈希的资源；哈希已过期（文件已更新）时重定向到当前版本"""
+        assets = self._ensure_built()
+        asset = self._by_url.get(name)
+        if asset is None:
+            stem, ext = os.path.splitext(name)
+            current = assets.get(stem.rpartition('.')[0] + ext)
+            if current is None:
+                abort(404)
+            return redirect(url_for('assets.asset', name=current.url_name))
+
+        path, encoding = asset.path, None
+        accepted = request.accept_encodings
+        for candidate, _ in ENCODINGS:
+            if candidate in asset.encodings and accepted[candidate]:
+                path, encoding = asset.encodings[candidate], candidate
+                break
+        response = send_file(path, mimetype=asset.mimetype, conditional=True,
+                             etag=f'{asset.url_name}-{encoding or "identity"}', max_age=IMMUTABLE_MAX_AGE)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        if asset.encodings:
+            response.vary.add('Accept-Encoding')
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+
+
+assets = AssetPipeline()
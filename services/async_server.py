@@ -0,0 +1,232 @@
+"""
+异步服务模式（ASGI）
+同步部署中每个下载占用一个工作线程直到传输结束，大量慢速客户端会耗尽线程。
+这里把 Flask 应用包装成 ASGI 应用：视图仍在线程池中执行，但响应体按块在线程池中读取、
+在事件循环中发送，等待客户端接收时不占用线程。每个连接只占一个协程和一个缓冲块，
+send() 由 ASGI 服务器做流量控制（客户端接收慢时挂起），内存占用与并发数成正比。
+请求体同样按需从 receive() 读取，分块上传不会整体缓存在内存中。
+
+用法（需要安装 uvicorn 等 ASGI 服务器）:
+    uvicorn asgi:application --workers 4
+"""
+
+import asyncio
+import contextvars
+import logging
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.wsgi import FileWrapper
+
+logger = logging.getLogger(__name__)
+
+_END = object()
+
+
+class _InputStream:
+    """wsgi.input：在工作线程中读取，按需从事件循环中的 receive() 取下一段请求体"""
+
+    def __init__(self, receive, loop):
+        self._receive = receive
+        self._loop = loop
+        self._buffer = bytearray()
+        self._more = True
+        self.disconnected = False
+
+    def _fill(self):
+        message = asyncio.run_coroutine_threadsafe(self._receive(), self._loop).result()
+        if message['type'] == 'http.disconnect':
+            self._more = False
+            self.disconnected = True
+            return
+        self._buffer += message.get('body', b'')
+        self._more = message.get('more_body', False)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            while self._more:
+                self._fill()
+            size = len(self._buffer)
+        while len(self._buffer) < size and self._more:
+            self._fill()
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def readline(self, size=-1):
+        while b'\n' not in self._buffer and self._more and (size < 0 or len(self._buffer) < size):
+            self._fill()
+        end = self._buffer.find(b'\n') + 1 or len(self._buffer)
+        if size >= 0:
+            end = min(end, size)
+        return self.read(end)
+
+    def readlines(self, hint=-1):
+        return list(iter(self.readline, b''))
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+
+class AsyncServer:
+    """把 WSGI 应用包装为 ASGI 应用"""
+
+    def __init__(self, wsgi_app, buffer_size=256 * 1024, threads=32):
+        self.wsgi_app = wsgi_app
+        self.buffer_size = buffer_size
+        self.threads = threads
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    @classmethod
+    def from_app(cls, app):
+        app.config.setdefault('ASYNC_BUFFER_SIZE', 256 * 1024)
+        app.config.setdefault('ASYNC_THREADS', 32)
+        return cls(app, buffer_size=app.config['ASYNC_BUFFER_SIZE'], threads=app.config['ASYNC_THREADS'])
+
+    @property
+    def executor(self):
+        # 在 fork 出的工作进程中首次使用时才创建
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='asgi')
+        return self._executor
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http':
+            await self._handle_http(scope, receive, send)
+        elif scope['type'] == 'lifespan':
+            await self._handle_lifespan(receive, send)
+        # 不支持 websocket，直接返回即由服务器关闭连接
+
+    async def _handle_lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self._executor is not None:
+                    self._executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def _file_wrapper(self, file, buffer_size=None):
+        # 忽略调用方给出的块大小（werkzeug 默认 8KB），使用配置的缓冲区大小
+        return FileWrapper(file, self.buffer_size)
+
+    def _environ(self, scope, body):
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        path = scope.get('root_path', '') + scope['path']
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'RAW_URI': path,
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1] or 80),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'REMOTE_ADDR': client[0],
+            'REMOTE_PORT': str(client[1]),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.input_terminated': True,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+            # send_file 返回的文件按配置的缓冲区大小分块读取
+            'wsgi.file_wrapper': self._file_wrapper,
+        }
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                name = 'HTTP_' + name
+            environ[name] = f'{environ[name]},{value}' if name in environ else value
+        return environ
+
+    async def _handle_http(self, scope, receive, send):
+        loop = asyncio.get_running_loop()
+        body = _InputStream(receive, loop)
+        environ = self._environ(scope, body)
+        # 视图和之后每次读取响应体都在同一个 contextvars 上下文中执行，即使分布在不同线程
+        context = contextvars.copy_context()
+        started = {}
+        written = []
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and started.get('sent'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                  for name, value in headers]
+            return written.append
+
+        def call_app():
+            iterable = self.wsgi_app(environ, start_response)
+            return iterable, iter(iterable)
+
+        def next_chunk(iterator):
+            return next(iterator, _END)
+
+        def run(fn, *args):
+            return loop.run_in_executor(self.executor, context.run, fn, *args)
+
+        try:
+            iterable, iterator = await run(call_app)
+        except Exception:
+            logger.error('处理请求失败', exc_info=True)
+            await send({'type': 'http.response.start', 'status': 500,
+                        'headers': [(b'content-type', b'text/plain; charset=utf-8')]})
+            await send({'type': 'http.response.body', 'body': b'Internal Server Error'})
+            return
+
+        disconnected = asyncio.Event()
+        watcher = None
+        try:
+            # 取第一块后才发送响应头，生成器类响应体可能在此之前调用 start_response
+            chunk = await run(next_chunk, iterator)
+            await send({'type': 'http.response.start', 'status': started['status'],
+                        'headers': started['headers']})
+            started['sent'] = True
+            for data in written:
+                await send({'type': 'http.response.body', 'body': data, 'more_body': True})
+
+            if not body.disconnected:
+                watcher = loop.create_task(self._watch_disconnect(body, receive, disconnected))
+            while chunk is not _END and not disconnected.is_set():
+                if chunk:
+                    # 客户端接收慢时 send() 挂起，此时不占用线程
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                chunk = await run(next_chunk, iterator)
+            if not disconnected.is_set():
+                await send({'type': 'http.response.body', 'body': b''})
+        except OSError:
+            pass  # 客户端断开
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+            close = getattr(iterable, 'close', None)
+            if close is not None:
+                try:
+                    await run(close)
+                except Exception:
+                    logger.warning('关闭响应失败', exc_info=True)
+
+    async def _watch_disconnect(self, body, receive, disconnected):
+        # 视图没有读完的请求体在这里丢弃，直到收到断开消息
+        while not body.disconnected:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                break
+        disconnected.set()
+
+
+def create_asgi_app(app):
+    """返回包装了 Flask 应用的 ASGI 应用"""
+    return AsyncServer.from_app(app)
@@ -0,0 +1,142 @@
+"""
+进程内后台任务基础设施
+子类实现 run_once()，由守护线程按固定间隔调用
+"""
+
+import logging
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows 下没有 fcntl，退化为不加跨进程锁
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundWorker:
+    """按间隔运行的后台线程，多进程部署时通过文件锁保证同一时刻只有一个进程执行"""
+
+    name = 'background-worker'
+    # 子类覆盖：(配置键, 默认值)
+    enabled_config = None
+    interval_config = None
+    default_metrics = {}
+    # 为 False 时每个进程都执行，用于处理进程内数据（如访问计数缓冲）
+    single_process = True
+
+    def __init__(self, app=None):
+        self.app = None
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+        self._metrics_lock = threading.Lock()
+        self.metrics = dict(self.default_metrics)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault(*self.enabled_config)
+        app.config.setdefault(*self.interval_config)
+        self.app = app
+        app.extensions[self.name] = self
+
+        if app.config[self.enabled_config[0]]:
+            # 在第一个请求时启动，保证 gunicorn 等 fork 后的工作进程各自拥有线程
+            app.before_request(self._ensure_started)
+
+    def _ensure_started(self):
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+            self._on_started()
+
+    def _on_started(self):
+        """本进程开始处理请求、线程已启动后调用一次，子类可覆盖"""
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+
+    def wakeup(self):
+        """提前触发下一轮执行"""
+        self._wakeup.set()
+
+    def _run(self):
+        interval = self.app.config[self.interval_config[0]]
+        while True:
+            self._wakeup.wait(interval)
+            self._wakeup.clear()
+            if self._stop.is_set():
+                break
+            try:
+                if not self.single_process:
+                    self.run_once()
+                    continue
+                with FileLock(os.path.join(self.app.instance_path, f'{self.name}.lock')) as acquired:
+                    if acquired:
+                        self.run_once()
+            except Exception as e:
+                logger.error(f"后台任务 {self.name} 执行失败: {str(e)}", exc_info=True)
+
+    def run_once(self):
+        raise NotImplementedError
+
+    def _update_metrics(self, **values):
+        with self._metrics_lock:
+            self.metrics.update(values)
+
+    def _incr_metrics(self, **deltas):
+        with self._metrics_lock:
+            for key, delta in deltas.items():
+                self.metrics[key] += delta
+
+    def get_metrics(self):
+        with self._metrics_lock:
+            return dict(self.metrics)
+
+
+class StripedLock:
+    """按键分到固定数量的锁上，调用返回 key 对应的锁；锁的数量不随键的数量增长"""
+
+    def __init__(self, stripes=64):
+        self._locks = [threading.Lock() for _ in range(stripes)]
+
+    def __call__(self, key):
+        return self._locks[hash(key) % len(self._locks)]
+
+
+class FileLock:
+    """基于 fcntl 的非阻塞文件锁，获取失败时 __enter__ 返回 False"""
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+
+    def __enter__(self):
+        if fcntl is None:
+            return True
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(self._fd)
+            self._fd = None
+            return False
+        return True
+
+    def __exit__(self, *exc):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
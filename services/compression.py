@@ -0,0 +1,414 @@
+"""
+冷数据压缩
+长时间未被访问的文件在后台重新压缩存储（优先 zstd，未安装 zstandard 时使用 gzip），
+读取时透明解压；客户端支持同一编码时直接返回压缩后的字节
+"""
+
+import gzip
+import io
+import logging
+import mimetypes
+import os
+import threading
+import zlib
+from contextlib import closing
+from datetime import datetime, timedelta
+
+from flask import Response, request
+
+from models import File, db
+from services import stats
+from services.background import BackgroundWorker
+from services.deletion import enqueue_unlink
+from storage import get_storage
+from storage.base import CHUNK_SIZE, content_disposition
+
+try:
+    import zstandard
+except ImportError:  # zstd 为可选依赖
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# 本身已经压缩过的格式，再压缩收益很小
+COMPRESSED_EXTENSIONS = {
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.rar', '.zst', '.lz4', '.br',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.avif',
+    '.mp3', '.aac', '.ogg', '.flac', '.m4a', '.opus',
+    '.mp4', '.mkv', '.avi', '.mov', '.wmv', '.flv', '.webm',
+    '.pdf', '.docx', '.xlsx', '.pptx', '.odt', '.ods', '.odp', '.epub', '.jar', '.apk',
+}
+
+CODEC_SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+# 非本地存储上随机读取时每次请求的字节数
+SEEKABLE_READ_AHEAD = 64 * 1024
+
+
+def available_codec(preferred='zstd'):
+    if preferred == 'zstd' and zstandard is not None:
+        return 'zstd'
+    return 'gzip'
+
+
+class _GzipCompressReader:
+    """读取时把 source 压缩为 gzip 格式的流"""
+
+    def __init__(self, source, level):
+        self.source = source
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits=31 输出 gzip 格式
+        self.buffer = b''
+        self.eof = False
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            data = self.source.read(CHUNK_SIZE)
+            if data:
+                self.buffer += self.compressor.compress(data)
+            else:
+                self.buffer += self.compressor.flush()
+                self.eof = True
+        if size < 0:
+            data, self.buffer = self.buffer, b''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        self.source.close()
+
+
+def compressing_reader(source, codec, level=None):
+    """返回读取时即压缩 source 内容的流"""
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=level or 3).stream_reader(source, closefd=True)
+    return _GzipCompressReader(source, level or 6)
+
+
+def decompressing_reader(source, codec):
+    """返回读取时即解压 source 内容的流"""
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('读取 zstd 压缩的文件需要安装 zstandard')
+        return zstandard.ZstdDecompressor().stream_reader(source, closefd=True)
+    # GzipFile 只调用 source.read()，不需要 source 可随机访问
+    return _ClosingGzipFile(source)
+
+
+class _ClosingGzipFile(gzip.GzipFile):
+    """关闭时同时关闭底层流"""
+
+    def __init__(self, source):
+        super().__init__(fileobj=source, mode='rb')
+        self._source = source
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self._source.close()
+
+
+def open_file(file):
+    """以二进制流打开文件的原始内容，压缩存储的文件会透明解压"""
+    stream = get_storage().open(file.storage_key)
+    if file.is_compressed:
+        return decompressing_reader(stream, file.codec)
+    return stream
+
+
+def _iter_decompressed(stream, start, end):
+    with closing(stream):
+        # 压缩流无法随机访问，Range 请求通过解压后丢弃前面的数据实现
+        skip = start
+        while skip > 0:
+            data = stream.read(min(CHUNK_SIZE, skip))
+            if not data:
+                return
+            skip -= len(data)
+        remaining = end - start
+        while remaining > 0:
+            data = stream.read(min(CHUNK_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+
+def iter_file_range(file, start=0, end=None):
+    """按块产出文件原始内容 [start, end) 范围的字节；未压缩的文件直接定位读取"""
+    if file.is_compressed:
+        return _iter_decompressed(open_file(file), start, float('inf') if end is None else end)
+    return get_storage().iter_range(file.storage_key, start, end)
+
+
+class RangeReader(io.RawIOBase):
+    """按字节范围读取存储对象的可定位文件对象，供需要随机读取的解析器（zipfile 等）使用。
+    压缩存储的文件保持一个只向前的解压流，向后定位时才重新从头解压"""
+
+    def __init__(self, file):
+        self.file = file
+        self.size = file.get_size()
+        self.position = 0
+        self._stream = None
+        self._stream_position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(0, offset)
+        return self.position
+
+    def _read_decompressed(self, buffer, end):
+        if self._stream is None or self._stream_position > self.position:
+            if self._stream is not None:
+                self._stream.close()
+            self._stream = open_file(self.file)
+            self._stream_position = 0
+        while self._stream_position < self.position:
+            data = self._stream.read(min(CHUNK_SIZE, self.position - self._stream_position))
+            if not data:
+                return 0
+            self._stream_position += len(data)
+        view = memoryview(buffer)[:end - self.position]
+        length = 0
+        while length < len(view):
+            data = self._stream.read(len(view) - length)
+            if not data:
+                break
+            view[length:length + len(data)] = data
+            length += len(data)
+        self._stream_position += length
+        self.position += length
+        return length
+
+    def readinto(self, buffer):
+        end = min(self.size, self.position + len(buffer))
+        if end <= self.position:
+            return 0
+        if self.file.is_compressed:
+            return self._read_decompressed(buffer, end)
+        length = 0
+        for data in iter_file_range(self.file, self.position, end):
+            buffer[length:length + len(data)] = data
+            length += len(data)
+        self.position += length
+        return length
+
+    def close(self):
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+        super().close()
+
+
+def open_seekable(file):
+    """以可定位的方式打开文件内容：本地未压缩的文件直接打开，否则按范围读取"""
+    if not file.is_compressed:
+        path = get_storage().local_path(file.storage_key)
+        if path:
+            return open(path, 'rb')
+    return io.BufferedReader(RangeReader(file), buffer_size=SEEKABLE_READ_AHEAD)
+
+
+def _accepts_encoding(codec):
+    token = 'zstd' if codec == 'zstd' else 'gzip'
+    return token in request.accept_encodings
+
+
+def send_stored_file(file, download_name=None, as_attachment=False):
+    """返回文件内容的响应，压缩存储的文件按客户端能力直接透传或流式解压"""
+    storage = get_storage()
+    # 已知内容哈希时用它作为强 ETag，与存储位置、修改时间无关
+    etag = file.file_hash.lower() if file.file_hash else None
+    if not file.is_compressed:
+        return storage.send(file.storage_key, download_name=download_name, as_attachment=as_attachment, etag=etag)
+
+    passthrough = not request.range and _accepts_encoding(file.codec)
+    if etag:
+        # 透传压缩数据时响应体不同，使用不同的 ETag
+        if passthrough:
+            etag = f'{etag}-{file.codec}'
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            response.vary.add('Accept-Encoding')
+            return response
+
+    mimetype = mimetypes.guess_type(file.original_filename)[0] or 'application/octet-stream'
+    if passthrough:
+        response = Response(storage.iter_range(file.storage_key), mimetype=mimetype, direct_passthrough=True)
+        response.headers['Content-Encoding'] = 'zstd' if file.codec == 'zstd' else 'gzip'
+        if file.compressed_size is not None:
+            response.content_length = file.compressed_size
+    else:
+        size = file.get_size()
+        start, end, status = 0, size, 200
+        if request.range and request.range.units == 'bytes':
+            byte_range = request.range.range_for_length(size)
+            if byte_range is None:
+                response = Response(status=416)
+                response.headers['Content-Range'] = f'bytes */{size}'
+                return response
+            start, end = byte_range
+            status = 206
+        # 在请求上下文内打开文件，生成器在响应发送时才执行
+        response = Response(_iter_decompressed(open_file(file), start, end), status=status, mimetype=mimetype,
+                            direct_passthrough=True)
+        response.content_length = end - start
+        response.headers['Accept-Ranges'] = 'bytes'
+        if status == 206:
+            response.headers['Content-Range'] = f'bytes {start}-{end - 1}/{size}'
+
+    response.vary.add('Accept-Encoding')
+    if etag:
+        response.set_etag(etag)
+    if download_name:
+        response.headers['Content-Disposition'] = content_disposition(download_name, as_attachment)
+    return response
+
+
+class ColdTier(BackgroundWorker):
+    """后台把冷文件压缩存储"""
+
+    name = 'cold-tier'
+    enabled_config = ('COLD_TIER_ENABLED', True)
+    interval_config = ('COLD_TIER_INTERVAL', 3600)  # 秒
+    default_metrics = {
+        'files_compressed_total': 0,
+        'files_skipped_total': 0,
+        'bytes_saved_total': 0,
+        'last_run_at': None,
+    }
+
+    def __init__(self, app=None):
+        self._run_lock = threading.Lock()
+        super().__init__(app)
+
+    def init_app(self, app):
+        app.config.setdefault('COLD_TIER_AFTER_DAYS', 7)  # 多少天未访问视为冷数据
+        app.config.setdefault('COLD_TIER_CODEC', 'zstd')
+        app.config.setdefault('COLD_TIER_MIN_SIZE', 4096)  # 小文件压缩收益太小
+        app.config.setdefault('COLD_TIER_MIN_SAVING', 0.1)  # 至少节省 10% 才保留压缩结果
+        app.config.setdefault('COLD_TIER_BATCH_SIZE', 100)
+        super().init_app(app)
+
+    def run_once(self):
+        self.compress_cold_files()
+
+    def compress_cold_files(self, now=None, max_files=None, on_file=None):
+        """压缩所有已变冷的文件，返回 (压缩数, 跳过数, 节省字节数)"""
+        with self._run_lock:
+            with self.app.app_context():
+                try:
+                    return self._compress_cold_files(now or datetime.utcnow(), max_files, on_file)
+                finally:
+                    db.session.remove()
+
+    def _compress_cold_files(self, now, max_files, on_file):
+        config = self.app.config
+        cutoff = now - timedelta(days=config['COLD_TIER_AFTER_DAYS'])
+        codec = available_codec(config['COLD_TIER_CODEC'])
+        storage = get_storage(self.app)
+        compressed = skipped = saved = 0
+        last_id = ''
+
+        while max_files is None or compressed + skipped < max_files:
+            files = File.query.filter(
+                File.id > last_id,
+                File.codec.is_(None),
+                File.storage_issue.is_(None),
+                db.func.coalesce(File.last_accessed_at, File.upload_time) < cutoff
+            ).order_by(File.id).limit(config['COLD_TIER_BATCH_SIZE']).all()
+            if not files:
+                break
+            last_id = files[-1].id
+
+            for file in files:
+                _, ext = os.path.splitext((file.raw_filename or file.original_filename).lower())
+                if ext in COMPRESSED_EXTENSIONS or file.get_size() < config['COLD_TIER_MIN_SIZE']:
+                    self._update_if_unchanged(file.id, file.filepath, codec='identity')
+                    db.session.commit()
+                    skipped += 1
+                    continue
+                try:
+                    result = self._compress(storage, file, codec, config['COLD_TIER_MIN_SAVING'])
+                except Exception as e:
+                    db.session.rollback()
+                    logger.warning(f"压缩冷文件失败: {file.filepath}, 错误: {e}")
+                    continue
+                if result is None:
+                    skipped += 1
+                else:
+                    compressed += 1
+                    saved += result
+                if on_file:
+                    on_file(file, result)
+
+        self._incr_metrics(files_compressed_total=compressed, files_skipped_total=skipped, bytes_saved_total=saved)
+        self._update_metrics(last_run_at=now.isoformat())
+        return compressed, skipped, saved
+
+    @staticmethod
+    def _update_if_unchanged(file_id, old_filepath, **values):
+        """只在文件仍指向 old_filepath 且未压缩时更新，返回是否更新；压缩期间保存了新版本等情况下不覆盖"""
+        result = db.session.execute(db.update(File).where(
+            File.id == file_id, File.filepath == old_filepath, File.codec.is_(None)
+        ).values(**values).execution_options(synchronize_session=False))
+        return result.rowcount == 1
+
+    def _compress(self, storage, file, codec, min_saving):
+        """压缩单个文件，返回节省的字节数；压缩收益不足或压缩期间文件内容被替换时返回 None"""
+        file_id, old_filepath, before = file.id, file.filepath, stats.entry(file)
+        old_key = file.storage_key
+        new_key = old_key + CODEC_SUFFIXES[codec]
+        original_size = storage.size(old_key)
+        # 压缩可能耗时很久，期间不占用读事务
+        db.session.rollback()
+        with closing(storage.open(old_key)) as source:
+            stored_size = storage.save(new_key, compressing_reader(source, codec))
+
+        if stored_size > original_size * (1 - min_saving):
+            storage.delete(new_key)
+            self._update_if_unchanged(file_id, old_filepath, codec='identity')
+            db.session.commit()
+            return None
+
+        values = {'filepath': storage.filepath_for(new_key), 'codec': codec, 'compressed_size': stored_size}
+        if not before.file_size:
+            values['file_size'] = original_size
+        try:
+            if not self._update_if_unchanged(file_id, old_filepath, **values):
+                db.session.rollback()
+                storage.delete(new_key)
+                return None
+            stats.replace_file(before, before._replace(file_size=values.get('file_size', before.file_size),
+                                                       compressed_size=stored_size))
+            # 旧文件延迟删除，让正在进行的下载读完
+            enqueue_unlink([_PendingUnlink(file_id, old_filepath, original_size)], delay=600)
+            db.session.commit()
+        except BaseException:
+            db.session.rollback()
+            storage.delete(new_key)
+            raise
+        return original_size - stored_size
+
+
+class _PendingUnlink:
+    def __init__(self, id, filepath, file_size):
+        self.id = id
+        self.filepath = filepath
+        self.file_size = file_size
+
+
+cold_tier = ColdTier()
@@ -0,0 +1,180 @@
+"""
+批量删除服务
+文件记录按批次用 DELETE ... WHERE id IN (...) 删除，同一事务内把文件路径写入 UnlinkTask 队列，
+由后台线程异步删除存储中的文件；删除失败按指数退避重试，进程崩溃后队列仍在数据库中
+"""
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from models import File, UnlinkTask, db
+from services import quota, stats
+from services.background import BackgroundWorker
+from services.listing_cache import bump_listing_version
+from storage import get_storage
+
+logger = logging.getLogger(__name__)
+
+
+def delete_files(file_ids=None, user_id=None, batch_size=1000, on_batch=None):
+    """删除指定ID或指定用户的全部文件记录，存储中的文件交给删除队列处理，返回删除统计"""
+    if file_ids is None and user_id is None:
+        raise ValueError('必须指定 file_ids 或 user_id')
+    from services.versions import purge_versions  # versions 依赖本模块的 enqueue_unlink
+    from services import metadata  # 同上，metadata 经由 compression 依赖本模块
+    storage = get_storage()
+
+    result = {'files': 0, 'bytes': 0, 'batches': 0}
+    pending_ids = list(dict.fromkeys(file_ids)) if file_ids is not None else None
+
+    while True:
+        query = db.session.query(File.id, File.filepath, File.file_size, File.user_id,
+                                 File.original_filename, File.share_type, File.upload_time,
+                                 File.compressed_size)
+        if pending_ids is not None:
+            if not pending_ids:
+                break
+            batch_ids, pending_ids = pending_ids[:batch_size], pending_ids[batch_size:]
+            rows = query.filter(File.id.in_(batch_ids)).all()
+            if not rows:
+                continue
+        else:
+            rows = query.filter(File.user_id == user_id).limit(batch_size).all()
+            if not rows:
+                break
+
+        enqueue_unlink(rows)
+        purge_versions(storage, [row.id for row in rows])
+        metadata.remove(row.id for row in rows)
+        db.session.execute(db.delete(File).where(File.id.in_([row.id for row in rows])))
+        quota.uncharge(rows)
+        stats.remove_files(rows)
+        bump_listing_version((row.user_id for row in rows), public=any(row.share_type == 'public' for row in rows))
+        db.session.commit()
+
+        result['files'] += len(rows)
+        result['bytes'] += sum(row.file_size or 0 for row in rows)
+        result['batches'] += 1
+        if on_batch:
+            on_batch(result)
+
+    if result['files']:
+        unlink_queue.wakeup()
+    return result
+
+
+def enqueue_unlink(rows, delay=0):
+    """把 (id, filepath, file_size) 记录加入删除队列，不提交事务；delay 秒后才会真正删除"""
+    now = datetime.utcnow()
+    db.session.execute(db.insert(UnlinkTask), [
+        {'filepath': row.filepath, 'file_id': row.id, 'file_size': row.file_size,
+         'attempts': 0, 'next_attempt_at': now + timedelta(seconds=delay), 'created_at': now}
+        for row in rows
+    ])
+
+
+def _unlink(storage, filepath):
+    """删除单个文件，返回错误信息，成功时返回 None"""
+    try:
+        storage.delete(storage.key_from_filepath(filepath))
+    except Exception as e:
+        return str(e)
+    return None
+
+
+class UnlinkQueue(BackgroundWorker):
+    """后台消费 UnlinkTask 队列，删除存储中的文件"""
+
+    name = 'unlink-queue'
+    enabled_config = ('UNLINK_QUEUE_ENABLED', True)
+    interval_config = ('UNLINK_QUEUE_INTERVAL', 5)  # 秒
+    default_metrics = {
+        'unlinked_total': 0,
+        'retries_total': 0,
+        'last_run_at': None,
+    }
+
+    def __init__(self, app=None):
+        self._drain_lock = threading.Lock()
+        super().__init__(app)
+
+    def init_app(self, app):
+        app.config.setdefault('UNLINK_QUEUE_BATCH_SIZE', 500)
+        app.config.setdefault('UNLINK_QUEUE_WORKERS', 4)
+        app.config.setdefault('UNLINK_QUEUE_MAX_ATTEMPTS', 10)
+        super().init_app(app)
+
+    def run_once(self):
+        self.drain()
+
+    def drain(self, on_batch=None):
+        """处理所有到期的删除任务，返回 (成功数, 失败数)"""
+        with self._drain_lock:
+            with self.app.app_context():
+                try:
+                    return self._drain(on_batch)
+                finally:
+                    db.session.remove()
+
+    def _drain(self, on_batch):
+        batch_size = self.app.config['UNLINK_QUEUE_BATCH_SIZE']
+        max_attempts = self.app.config['UNLINK_QUEUE_MAX_ATTEMPTS']
+        done_total = failed_total = 0
+        started = datetime.utcnow()
+        storage = get_storage(self.app)
+
+        with ThreadPoolExecutor(max_workers=self.app.config['UNLINK_QUEUE_WORKERS']) as pool:
+            while True:
+                # 只取本轮开始前到期的任务，失败后推迟的任务留到下一轮
+                tasks = UnlinkTask.query.filter(
+                    UnlinkTask.next_attempt_at <= started,
+                    UnlinkTask.attempts < max_attempts
+                ).order_by(UnlinkTask.id).limit(batch_size).all()
+                if not tasks:
+                    break
+
+                errors = list(pool.map(lambda task: _unlink(storage, task.filepath), tasks))
+                done_ids = []
+                now = datetime.utcnow()
+                for task, error in zip(tasks, errors):
+                    if error is None:
+                        done_ids.append(task.id)
+                        continue
+                    task.attempts += 1
+                    task.last_error = error
+                    # 指数退避：30秒、1分钟、2分钟……最长1小时
+                    task.next_attempt_at = now + timedelta(seconds=min(30 * 2 ** (task.attempts - 1), 3600))
+                    logger.warning(f"删除文件失败（第 {task.attempts} 次）: {task.filepath}, 错误: {error}")
+
+                if done_ids:
+                    db.session.execute(db.delete(UnlinkTask).where(UnlinkTask.id.in_(done_ids)))
+                db.session.commit()
+
+                done_total += len(done_ids)
+                failed_total += len(tasks) - len(done_ids)
+                self._incr_metrics(unlinked_total=len(done_ids), retries_total=len(tasks) - len(done_ids))
+                if on_batch:
+                    on_batch(done_total, failed_total)
+
+        self._update_metrics(last_run_at=started.isoformat())
+        return done_total, failed_total
+
+    def get_status(self):
+        """返回队列进度，供管理页面和命令行展示"""
+        max_attempts = self.app.config['UNLINK_QUEUE_MAX_ATTEMPTS']
+        pending = db.session.query(
+            db.func.count(UnlinkTask.id), db.func.coalesce(db.func.sum(UnlinkTask.file_size), 0)
+        ).filter(UnlinkTask.attempts < max_attempts).one()
+        dead = UnlinkTask.query.filter(UnlinkTask.attempts >= max_attempts).count()
+        status = self.get_metrics()
+        status.update({
+            'pending': pending[0],
+            'pending_bytes': pending[1],
+            'dead': dead,
+        })
+        return status
+
+
+unlink_queue = UnlinkQueue()
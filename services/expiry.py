@@ -0,0 +1,148 @@
+"""
+过期文件清理服务
+按 File.expiry_time 索引分批扫描过期文件，在线程池中删除存储中的文件，每批提交一次
+"""
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from models import File, db
+from services import metadata, quota, stats
+from services.background import BackgroundWorker
+from services.listing_cache import bump_listing_version
+from services.versions import purge_versions
+from storage import get_storage
+
+logger = logging.getLogger(__name__)
+
+
+def _unlink(storage, filepath, recorded_size):
+    """删除单个文件，返回 (是否成功, 释放字节数)"""
+    key = storage.key_from_filepath(filepath)
+    try:
+        size = storage.size(key)
+    except FileNotFoundError:
+        # 文件已不存在，视为已清理
+        return True, 0
+    except Exception:
+        size = recorded_size or 0
+    try:
+        storage.delete(key)
+    except Exception as e:
+        logger.warning(f"删除过期文件失败: {filepath}, 错误: {e}")
+        return False, 0
+    return True, size
+
+
+class ExpirySweeper(BackgroundWorker):
+    """进程内定时运行的过期文件清理器"""
+
+    name = 'expiry-sweeper'
+    enabled_config = ('EXPIRY_SWEEPER_ENABLED', True)
+    interval_config = ('EXPIRY_SWEEP_INTERVAL', 60)  # 秒
+    default_metrics = {
+        'runs_total': 0,
+        'batches_total': 0,
+        'files_expired_total': 0,
+        'bytes_reclaimed_total': 0,
+        'unlink_errors_total': 0,
+        'last_run_at': None,
+        'last_run_duration_seconds': 0.0,
+        'lag_seconds': 0.0,
+        'backlog': 0,
+    }
+
+    def __init__(self, app=None):
+        self._sweep_lock = threading.Lock()
+        super().__init__(app)
+
+    def init_app(self, app):
+        app.config.setdefault('EXPIRY_SWEEP_BATCH_SIZE', 500)
+        app.config.setdefault('EXPIRY_SWEEP_WORKERS', 4)
+        super().init_app(app)
+
+    def run_once(self):
+        self.sweep()
+
+    def sweep(self, now=None, max_batches=None, on_batch=None):
+        """清理截至 now 已过期的文件，返回本次清理的统计信息"""
+        with self._sweep_lock:
+            with self.app.app_context():
+                try:
+                    return self._sweep(now or datetime.utcnow(), max_batches, on_batch)
+                finally:
+                    db.session.remove()
+
+    def _sweep(self, now, max_batches, on_batch):
+        batch_size = self.app.config['EXPIRY_SWEEP_BATCH_SIZE']
+        started = time.monotonic()
+        result = {'files': 0, 'bytes': 0, 'errors': 0, 'batches': 0}
+        failed_ids = set()
+        storage = get_storage(self.app)
+
+        oldest = db.session.query(db.func.min(File.expiry_time)).filter(
+            File.expiry_time < now
+        ).scalar()
+        self._update_metrics(lag_seconds=(now - oldest).total_seconds() if oldest else 0.0)
+
+        with ThreadPoolExecutor(max_workers=self.app.config['EXPIRY_SWEEP_WORKERS']) as pool:
+            while max_batches is None or result['batches'] < max_batches:
+                query = db.session.query(File.id, File.filepath, File.file_size, File.user_id,
+                                         File.original_filename, File.share_type, File.upload_time,
+                                         File.compressed_size).filter(
+                    File.expiry_time < now
+                )
+                if failed_ids:
+                    query = query.filter(~File.id.in_(failed_ids))
+                rows = query.order_by(File.expiry_time).limit(batch_size).all()
+                if not rows:
+                    break
+
+                outcomes = pool.map(lambda row: _unlink(storage, row.filepath, row.file_size), rows)
+                done_rows = []
+                batch_bytes = 0
+                for row, (ok, freed) in zip(rows, outcomes):
+                    if ok:
+                        done_rows.append(row)
+                        batch_bytes += freed
+                    else:
+                        failed_ids.add(row.id)
+                done_ids = [row.id for row in done_rows]
+
+                if done_ids:
+                    purge_versions(storage, done_ids)
+                    metadata.remove(done_ids)
+                    File.query.filter(File.id.in_(done_ids)).delete(synchronize_session=False)
+                    quota.uncharge(done_rows)
+                    stats.remove_files(done_rows)
+                    bump_listing_version((row.user_id for row in done_rows),
+                                         public=any(row.share_type == 'public' for row in done_rows))
+                db.session.commit()
+
+                batch_errors = len(rows) - len(done_ids)
+                result['files'] += len(done_ids)
+                result['bytes'] += batch_bytes
+                result['errors'] += batch_errors
+                result['batches'] += 1
+                self._incr_metrics(batches_total=1, files_expired_total=len(done_ids),
+                                   bytes_reclaimed_total=batch_bytes, unlink_errors_total=batch_errors)
+                if on_batch:
+                    on_batch(result)
+
+        backlog_query = db.session.query(File.expiry_time).filter(File.expiry_time < now)
+        backlog = backlog_query.count()
+        oldest = backlog_query.order_by(File.expiry_time).limit(1).scalar()
+        self._incr_metrics(runs_total=1)
+        self._update_metrics(
+            last_run_at=now.isoformat(),
+            last_run_duration_seconds=round(time.monotonic() - started, 3),
+            lag_seconds=(datetime.utcnow() - oldest).total_seconds() if oldest else 0.0,
+            backlog=backlog,
+        )
+        return result
+
+
+expiry_sweeper = ExpirySweeper()
@@ -0,0 +1,105 @@
+"""
+表单上传直接写入存储
+默认情况下 Werkzeug 先把每个文件缓存到临时文件，视图再复制一次到存储，磁盘读写和占用空间都翻倍。
+视图在读取 request.files 之前设置 request.file_stream_factory 后，
+multipart 解析器会把每个文件部分直接写入存储中的最终位置（本地磁盘为同目录临时文件，提交时改名），
+同时计算 SHA-256，并在累计字节数超过单文件大小限制时立即中止，不必等整个请求上传完
+"""
+
+import hashlib
+import io
+
+from flask import Request
+
+
+class FileTooLarge(Exception):
+    """表单中的文件超过单文件大小限制"""
+
+    def __init__(self, filename, limit):
+        super().__init__(f'文件 "{filename}" 超过单文件大小限制')
+        self.filename = filename
+        self.limit = limit
+
+
+class StreamingUploadRequest(Request):
+    """设置了 file_stream_factory 的请求，文件部分交给它处理"""
+
+    file_stream_factory = None
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.file_stream_factory is not None:
+            return self.file_stream_factory(total_content_length, content_type, filename, content_length)
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
+
+class StreamedFile:
+    """一个文件部分的写入目标，解析完成后作为 FileStorage.stream 交给视图"""
+
+    def __init__(self, storage, filename, max_size):
+        self.filename = filename
+        self.key = storage.new_key(filename)
+        self.max_size = max_size
+        self.size = 0
+        self.committed = False
+        self._digest = hashlib.sha256()
+        self._writer = storage.writer(self.key)
+        self._closed = False
+
+    def write(self, data):
+        self.size += len(data)
+        if self.max_size is not None and self.size > self.max_size:
+            raise FileTooLarge(self.filename, self.max_size)
+        self._digest.update(data)
+        return self._writer.write(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        # 解析器写完后会 seek(0)；内容已在存储中，不支持再读取
+        return 0
+
+    def tell(self):
+        return self.size
+
+    def read(self, size=-1):
+        raise io.UnsupportedOperation('文件内容已直接写入存储')
+
+    @property
+    def sha256(self):
+        return self._digest.hexdigest()
+
+    def commit(self):
+        self._writer.commit()
+        self.committed = True
+        self._closed = True
+
+    def discard(self):
+        if not self._closed:
+            self._closed = True
+            self._writer.abort()
+
+    def close(self):
+        # FileStorage.close() 或请求结束时调用，未提交的内容一律丢弃
+        self.discard()
+
+
+class StreamingUploads:
+    """一次请求中所有文件部分的工厂，记录创建过的 StreamedFile 以便出错时清理"""
+
+    def __init__(self, storage, max_file_size=None):
+        self.storage = storage
+        self.max_file_size = max_file_size
+        self.files = []
+
+    def __call__(self, total_content_length, content_type, filename=None, content_length=None):
+        if not filename:
+            # 未选择文件的空文件域
+            return io.BytesIO()
+        if self.max_file_size is not None and content_length and content_length > self.max_file_size:
+            raise FileTooLarge(filename, self.max_file_size)
+        streamed = StreamedFile(self.storage, filename, self.max_file_size)
+        self.files.append(streamed)
+        return streamed
+
+    def discard_all(self):
+        """丢弃所有尚未提交的文件"""
+        for streamed in self.files:
+            streamed.discard()
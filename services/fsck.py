@@ -0,0 +1,196 @@
+"""
+存储一致性检查
+对比存储后端中的对象与 File.filepath，报告孤立文件、缺失文件以及大小/哈希不一致的记录。
+存储一侧由后端并行遍历（本地磁盘为线程池 os.scandir），数据库一侧用 yield_per 流式读取，
+两侧都按批处理，内存占用与文件总数无关
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from datetime import datetime
+
+from models import File, UnlinkTask, UploadTask, db
+from services.compression import decompressing_reader
+from services.hashing import hash_stream, hasher
+
+QUARANTINE_DIR = '.quarantine'
+
+
+def _batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _local_path(storage, row):
+    """未压缩且在本地磁盘上的文件路径，其他返回 None"""
+    if row.codec not in (None, 'identity'):
+        return None
+    return storage.local_path(storage.key_from_filepath(row.filepath))
+
+
+def _check_row(storage, row, verify_hash):
+    """检查单条记录对应的文件，返回问题类型或 None；本地未压缩文件的哈希由调用方用 hash_files 批量校验"""
+    key = storage.key_from_filepath(row.filepath)
+    try:
+        size = storage.size(key)
+    except FileNotFoundError:
+        return 'missing'
+    compressed = row.codec not in (None, 'identity')
+    expected_size = row.compressed_size if compressed else row.file_size
+    if expected_size is not None and size != expected_size:
+        return 'size_mismatch'
+    if verify_hash and row.file_hash and _local_path(storage, row) is None:
+        try:
+            stream = storage.open(key)
+            if compressed:
+                stream = decompressing_reader(stream, row.codec)
+            with closing(stream) as f:
+                digest = hash_stream(f)['sha256']
+        except FileNotFoundError:
+            return 'missing'
+        if digest != row.file_hash.lower():
+            return 'hash_mismatch'
+    return None
+
+
+def _check_hashes(storage, rows, workers, hash_cache):
+    """在线程池中校验本地未压缩文件的哈希，返回 {记录ID: 问题类型}"""
+    paths = {}
+    for row in rows:
+        path = _local_path(storage, row)
+        if path is not None:
+            paths[path] = row
+    issues = {}
+    for path, result in hasher.hash_files(list(paths), use_cache=hash_cache, workers=workers):
+        row = paths[path]
+        if isinstance(result, FileNotFoundError):
+            issues[row.id] = 'missing'
+        elif isinstance(result, Exception):
+            raise result
+        elif result['sha256'] != row.file_hash.lower():
+            issues[row.id] = 'hash_mismatch'
+    return issues
+
+
+def _known_paths(paths):
+    """paths 中已有文件记录或已在删除队列中（如压缩后延迟删除的原文件）的路径"""
+    known = {
+        filepath for (filepath,) in
+        db.session.query(File.filepath).filter(File.filepath.in_(list(paths)))
+    }
+    known.update(
+        filepath for (filepath,) in
+        db.session.query(UnlinkTask.filepath).filter(UnlinkTask.filepath.in_(list(paths)))
+    )
+    return known
+
+
+def _is_recent(storage, key, cutoff):
+    try:
+        return storage.modified_time(key) >= cutoff
+    except FileNotFoundError:
+        return True  # 已被移走或删除，不再处理
+
+
+def run_fsck(storage, repair=False, verify_hash=False, workers=8, batch_size=1000, on_issue=None, hash_cache=True,
+             grace_seconds=3600):
+    """执行一致性检查，返回各类问题的计数；repair=True 时隔离孤立文件、清理残留分块并标记问题记录。
+    hash_cache=False 时忽略哈希缓存，重新读取每个文件（可发现元数据未变化的静默损坏）。
+    上传和新版本在提交数据库前就把文件放到最终位置，grace_seconds 内修改过的文件不算孤立，
+    隔离前还会再查一次数据库"""
+    summary = {'disk_files': 0, 'db_rows': 0, 'orphan': 0, 'orphan_temp': 0, 'recent': 0,
+               'missing': 0, 'size_mismatch': 0, 'hash_mismatch': 0, 'cleared': 0}
+    cutoff = time.time() - grace_seconds
+    quarantine_prefix = f"{QUARANTINE_DIR}/{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}/"
+
+    def report(kind, path, file_id=None):
+        summary[kind] += 1
+        if on_issue:
+            on_issue(kind, path, file_id)
+
+    # 第一遍：存储 -> 数据库，找出孤立文件
+    for batch in _batched(storage.iter_keys(workers), batch_size):
+        summary['disk_files'] += len(batch)
+        paths = {storage.filepath_for(key): key for key, _ in batch}
+        known = _known_paths(paths)
+        db.session.rollback()
+        orphans = {}
+        for path, key in paths.items():
+            if path in known:
+                continue
+            if _is_recent(storage, key, cutoff):
+                # 可能是刚完成、尚未提交数据库的上传
+                summary['recent'] += 1
+                continue
+            orphans[path] = key
+        if repair and orphans:
+            # 隔离前再确认一次，期间提交的记录不受影响
+            known = _known_paths(orphans)
+            db.session.rollback()
+        for path, key in orphans.items():
+            if path in known:
+                continue
+            report('orphan', path)
+            if repair:
+                storage.move(key, quarantine_prefix + key)
+
+    # 未完成的分块上传：对应任务不存在或已结束的视为残留
+    for batch in _batched(storage.list_multipart_uploads(), batch_size):
+        upload_ids = [upload_id for _, upload_id in batch]
+        active = {
+            upload_id for (upload_id,) in db.session.query(
+                db.func.coalesce(UploadTask.storage_upload_id, UploadTask.id)
+            ).filter(
+                db.or_(UploadTask.storage_upload_id.in_(upload_ids), UploadTask.id.in_(upload_ids)),
+                UploadTask.status == 'uploading'
+            )
+        }
+        for key, upload_id in batch:
+            if upload_id not in active:
+                report('orphan_temp', key or upload_id)
+                if repair:
+                    storage.abort_multipart(key, upload_id)
+        db.session.rollback()
+
+    # 第二遍：数据库 -> 存储，找出缺失和不一致的记录；标记结果在读取结束后统一写回
+    flagged = []
+    cleared = []
+    rows = db.session.query(
+        File.id, File.filepath, File.file_size, File.file_hash, File.storage_issue,
+        File.codec, File.compressed_size
+    ).execution_options(yield_per=batch_size)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for batch in _batched(rows, batch_size):
+            summary['db_rows'] += len(batch)
+            issues = list(pool.map(lambda row: _check_row(storage, row, verify_hash), batch))
+            if verify_hash:
+                hashed = _check_hashes(storage, [row for row, issue in zip(batch, issues)
+                                                 if issue is None and row.file_hash], workers, hash_cache)
+                issues = [issue or hashed.get(row.id) for row, issue in zip(batch, issues)]
+            for row, issue in zip(batch, issues):
+                if issue:
+                    report(issue, row.filepath, row.id)
+                    if issue != row.storage_issue:
+                        flagged.append((row.id, issue))
+                elif row.storage_issue:
+                    cleared.append(row.id)
+    db.session.rollback()
+
+    if repair:
+        for batch in _batched(flagged, batch_size):
+            for file_id, issue in batch:
+                db.session.execute(db.update(File).where(File.id == file_id).values(storage_issue=issue))
+            db.session.commit()
+        for batch in _batched(cleared, batch_size):
+            db.session.execute(db.update(File).where(File.id.in_(batch)).values(storage_issue=None))
+            db.session.commit()
+        summary['cleared'] = len(cleared)
+
+    return summary
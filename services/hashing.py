@@ -0,0 +1,293 @@
+"""
+文件哈希
+一次读取同时计算多种摘要（如 SHA-256 与 MD5）。大文件用 mmap，其余用可复用的大缓冲区 readinto；
+hashlib 在处理大块数据时会释放 GIL，多个文件可以在线程池中真正并行。
+本地文件的结果按 (设备, inode, mtime, 大小) 缓存在 instance/hash_cache.sqlite3 中，
+文件未变化时不必重新读取；去重、一致性检查和 ETag 共用这里的实现。
+分块上传不使用客户端提供的哈希，合并后文件的哈希由后台 HashBackfill 计算（S3 上需要读取整个对象，
+不在完成上传的请求中进行），计算完成前 File.file_hash 为空
+"""
+
+import hashlib
+import logging
+import mmap
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from datetime import datetime
+
+from models import File, db
+from services.background import BackgroundWorker
+from storage import StorageError, get_storage
+
+logger = logging.getLogger(__name__)
+
+BUFFER_SIZE = 1024 * 1024
+# 大于该大小的文件用 mmap 读取，省去内核到用户态缓冲区的复制
+MMAP_THRESHOLD = 16 * 1024 * 1024
+# mmap 时每次交给 hashlib 的字节数，多种摘要依次处理同一段，数据仍在 CPU 缓存中
+MMAP_STEP = 8 * 1024 * 1024
+
+_local = threading.local()
+
+
+def _buffer():
+    """每个线程复用一个读取缓冲区"""
+    buffer = getattr(_local, 'buffer', None)
+    if buffer is None:
+        buffer = _local.buffer = bytearray(BUFFER_SIZE)
+    return buffer
+
+
+def _normalize(algorithms):
+    if isinstance(algorithms, str):
+        algorithms = (algorithms,)
+    return tuple(sorted(set(algorithms)))
+
+
+def _digests(digests):
+    return {name: digest.hexdigest() for name, digest in digests.items()}
+
+
+def hash_stream(stream, algorithms=('sha256',)):
+    """读取整个流，返回 {算法: 十六进制摘要}"""
+    digests = {name: hashlib.new(name) for name in _normalize(algorithms)}
+    updates = [digest.update for digest in digests.values()]
+    readinto = getattr(stream, 'readinto', None)
+    if readinto is None:
+        for chunk in iter(lambda: stream.read(BUFFER_SIZE), b''):
+            for update in updates:
+                update(chunk)
+        return _digests(digests)
+
+    buffer = _buffer()
+    view = memoryview(buffer)
+    while True:
+        n = readinto(buffer)
+        if not n:
+            break
+        chunk = view[:n] if n < len(buffer) else view
+        for update in updates:
+            update(chunk)
+    return _digests(digests)
+
+
+def hash_path(path, algorithms=('sha256',)):
+    """计算本地文件的摘要，返回 {算法: 十六进制摘要}"""
+    with open(path, 'rb', buffering=0) as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < MMAP_THRESHOLD:
+            return hash_stream(f, algorithms)
+        digests = {name: hashlib.new(name) for name in _normalize(algorithms)}
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if hasattr(mapped, 'madvise'):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            view = memoryview(mapped)
+            try:
+                for offset in range(0, size, MMAP_STEP):
+                    chunk = view[offset:offset + MMAP_STEP]
+                    for digest in digests.values():
+                        digest.update(chunk)
+                    chunk.release()
+            finally:
+                view.release()
+        return _digests(digests)
+
+
+class HashCache:
+    """按 (设备, inode, mtime, 大小, 算法) 保存摘要的 SQLite 缓存，可在多个进程间共享"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connection(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS file_hash ('
+                         'dev INTEGER, ino INTEGER, mtime_ns INTEGER, size INTEGER, algorithm TEXT, digest TEXT, '
+                         'PRIMARY KEY (dev, ino, algorithm))')
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def _stat_key(st):
+        return st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size
+
+    def get(self, st, algorithms):
+        """返回缓存中的 {算法: 摘要}，缺少任一算法时返回 None"""
+        dev, ino, mtime_ns, size = self._stat_key(st)
+        with self._lock:
+            rows = self._connection().execute(
+                'SELECT algorithm, digest FROM file_hash WHERE dev = ? AND ino = ? AND mtime_ns = ? AND size = ?',
+                (dev, ino, mtime_ns, size)
+            ).fetchall()
+        cached = dict(rows)
+        if all(name in cached for name in algorithms):
+            return {name: cached[name] for name in algorithms}
+        return None
+
+    def put(self, st, digests):
+        dev, ino, mtime_ns, size = self._stat_key(st)
+        # 同一 inode 只保留最新内容的摘要，文件被修改或 inode 被复用后旧记录会被覆盖
+        with self._lock:
+            self._connection().executemany(
+                'INSERT OR REPLACE INTO file_hash VALUES (?, ?, ?, ?, ?, ?)',
+                [(dev, ino, mtime_ns, size, name, digest) for name, digest in digests.items()]
+            )
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class Hasher:
+    """带缓存的文件哈希服务"""
+
+    def __init__(self, app=None):
+        self.cache = None
+        self.workers = 4
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('HASH_CACHE_ENABLED', True)
+        app.config.setdefault('HASH_WORKERS', 4)
+        self.workers = app.config['HASH_WORKERS']
+        if app.config['HASH_CACHE_ENABLED']:
+            self.cache = HashCache(os.path.join(app.instance_path, 'hash_cache.sqlite3'))
+        app.extensions['hasher'] = self
+
+    def hash_file(self, path, algorithms=('sha256',), use_cache=True):
+        """计算本地文件的摘要，文件自上次计算后没有变化时直接返回缓存结果"""
+        algorithms = _normalize(algorithms)
+        cache = self.cache if use_cache else None
+        if cache is None:
+            return hash_path(path, algorithms)
+        st = os.stat(path)
+        cached = cache.get(st, algorithms)
+        if cached is not None:
+            return cached
+        digests = hash_path(path, algorithms)
+        # 计算期间文件被修改时不缓存
+        if HashCache._stat_key(os.stat(path)) == HashCache._stat_key(st):
+            cache.put(st, digests)
+        return digests
+
+    def hash_stored(self, storage, key, algorithms=('sha256',), use_cache=True):
+        """计算存储对象的摘要：本地存储走带缓存的 hash_file，其他后端读取整个对象"""
+        local_path = storage.local_path(key)
+        if local_path is not None:
+            return self.hash_file(local_path, algorithms, use_cache)
+        with closing(storage.open(key)) as f:
+            return hash_stream(f, algorithms)
+
+    def hash_files(self, paths, algorithms=('sha256',), use_cache=True, workers=None):
+        """在线程池中计算多个文件的摘要，按输入顺序产出 (path, {算法: 摘要} 或异常)"""
+        def run(path):
+            try:
+                return path, self.hash_file(path, algorithms, use_cache)
+            except OSError as e:
+                return path, e
+
+        with ThreadPoolExecutor(max_workers=workers or self.workers) as pool:
+            yield from pool.map(run, paths)
+
+
+hasher = Hasher()
+
+
+class HashBackfill(BackgroundWorker):
+    """后台为还没有哈希的文件计算 SHA-256"""
+
+    name = 'hash-backfill'
+    enabled_config = ('HASH_BACKFILL_ENABLED', True)
+    interval_config = ('HASH_BACKFILL_INTERVAL', 300)  # 秒
+    default_metrics = {
+        'hashed_total': 0,
+        'errors_total': 0,
+        'last_run_at': None,
+    }
+
+    def __init__(self, app=None):
+        self._run_lock = threading.Lock()
+        super().__init__(app)
+
+    def init_app(self, app):
+        app.config.setdefault('HASH_BACKFILL_BATCH_SIZE', 50)
+        super().init_app(app)
+
+    def run_once(self):
+        self.hash_pending()
+
+    def hash_pending(self, max_batches=None):
+        """计算所有缺少哈希的文件，返回写入的文件数"""
+        with self._run_lock:
+            with self.app.app_context():
+                try:
+                    return self._hash_pending(max_batches)
+                finally:
+                    db.session.remove()
+
+    @staticmethod
+    def _hash_one(storage, filepath):
+        try:
+            return hasher.hash_stored(storage, storage.key_from_filepath(filepath))['sha256']
+        except (OSError, StorageError) as e:
+            logger.warning(f"计算文件哈希失败: {filepath}, 错误: {e}")
+            return None
+
+    def _hash_pending(self, max_batches):
+        storage = get_storage(self.app)
+        started = datetime.utcnow()
+        total = batches = 0
+        failed_ids = set()
+
+        with ThreadPoolExecutor(max_workers=hasher.workers) as pool:
+            while max_batches is None or batches < max_batches:
+                # 压缩存储的文件需要解压后才能计算原始内容的哈希，留给 fsck 等处理
+                query = db.session.query(File.id, File.filepath).filter(
+                    File.file_hash.is_(None), File.storage_issue.is_(None),
+                    File.codec.is_(None) | (File.codec == 'identity'))
+                if failed_ids:
+                    query = query.filter(~File.id.in_(failed_ids))
+                rows = query.order_by(File.upload_time.desc()).limit(
+                    self.app.config['HASH_BACKFILL_BATCH_SIZE']).all()
+                if not rows:
+                    break
+                db.session.rollback()  # 计算期间不占用读事务
+
+                digests = list(pool.map(lambda row: self._hash_one(storage, row.filepath), rows))
+                hashed = errors = 0
+                for row, digest in zip(rows, digests):
+                    if digest is None:
+                        failed_ids.add(row.id)
+                        errors += 1
+                        continue
+                    # 计算期间保存了新版本（filepath 和哈希都已更新）或文件被删除时不写入
+                    result = db.session.execute(db.update(File).where(
+                        File.id == row.id, File.filepath == row.filepath, File.file_hash.is_(None)
+                    ).values(file_hash=digest).execution_options(synchronize_session=False))
+                    if result.rowcount == 1:
+                        hashed += 1
+                    else:
+                        failed_ids.add(row.id)
+                db.session.commit()
+
+                total += hashed
+                batches += 1
+                self._incr_metrics(hashed_total=hashed, errors_total=errors)
+
+        self._update_metrics(last_run_at=started.isoformat())
+        return total
+
+
+hash_backfill = HashBackfill()
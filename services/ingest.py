@@ -0,0 +1,217 @@
+"""
+批量导入已有目录
+遍历目录树，在进程池中以大缓冲区计算文件哈希，按批创建 File 记录；
+存储与源目录在同一文件系统时用硬链接（或 reflink）放入存储，不复制数据。
+记录ID由 (用户, 源文件路径) 确定，中断后重新执行会跳过已导入的文件
+"""
+
+import errno
+import os
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+from werkzeug.utils import secure_filename
+
+from models import File, db
+from services import quota, stats
+from services.hashing import hash_path
+from services.listing_cache import bump_listing_version
+
+try:
+    import fcntl
+except ImportError:  # Windows 下没有 fcntl，不支持 reflink
+    fcntl = None
+
+LINK_MODES = ('auto', 'hardlink', 'reflink', 'copy')
+# 由 (用户ID, 源文件绝对路径) 生成稳定的记录ID
+INGEST_NAMESPACE = uuid.UUID('6f1c2a5e-4b1d-4c8e-9a53-0d7e2b9f61a4')
+# Linux 的 FICLONE ioctl，在 btrfs、XFS 等文件系统上创建共享数据块的副本
+_FICLONE = 0x40049409
+
+
+def hash_file(path):
+    """计算 SHA-256，返回 (path, size, hexdigest)；在进程池中执行"""
+    size = os.stat(path).st_size
+    return path, size, hash_path(path)['sha256']
+
+
+def iter_files(root):
+    """递归列出 root 下的普通文件（不跟随符号链接），按路径排序保证每次顺序相同"""
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        try:
+            entries = sorted(os.scandir(directory), key=lambda entry: entry.name)
+        except OSError:
+            continue
+        subdirs = []
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                yield entry.path
+        stack.extend(reversed(subdirs))
+
+
+def ingest_file_id(user_id, path):
+    return str(uuid.uuid5(INGEST_NAMESPACE, f'{user_id}:{os.path.abspath(path)}'))
+
+
+def _reflink(src, dst):
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, '当前系统不支持 reflink')
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+
+
+def place_file(storage, key, src, mode='auto'):
+    """把源文件放到存储键 key，返回实际使用的方式：hardlink、reflink 或 copy"""
+    dst = storage.local_path(key)
+    if dst is None or mode == 'copy':
+        with open(src, 'rb') as f:
+            storage.save(key, f, os.fstat(f.fileno()).st_size)
+        return 'copy'
+
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp_path = f'{dst}.{uuid.uuid4().hex}.part'
+    used = None
+    try:
+        if mode in ('auto', 'hardlink'):
+            try:
+                os.link(src, tmp_path)
+                used = 'hardlink'
+            except OSError as e:
+                if mode == 'hardlink' or e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise
+        if used is None and mode in ('auto', 'reflink'):
+            try:
+                _reflink(src, tmp_path)
+                used = 'reflink'
+            except OSError:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                if mode == 'reflink':
+                    raise
+        if used is None:
+            with open(src, 'rb') as f:
+                storage.save(key, f, os.fstat(f.fileno()).st_size)
+            return 'copy'
+        # 上次中断时可能已经放好了同一个键，直接覆盖
+        os.replace(tmp_path, dst)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return used
+
+
+def ingest_directory(storage, root, user_id, share_type='link_only', password=None, expiry_hours=None,
+                     allow_view=True, allow_download=True, link_mode='auto', workers=None,
+                     batch_size=500, on_batch=None):
+    """把 root 下的所有文件导入为 user_id 的文件，返回导入统计"""
+    if link_mode not in LINK_MODES:
+        raise ValueError(f'未知的导入方式: {link_mode}')
+    if not os.path.isdir(root):
+        raise ValueError(f'目录不存在: {root}')
+
+    now = datetime.utcnow()
+    expiry_time = now + timedelta(hours=expiry_hours) if expiry_hours else None
+    result = {'scanned': 0, 'skipped': 0, 'imported': 0, 'bytes': 0, 'errors': 0,
+              'hardlink': 0, 'reflink': 0, 'copy': 0, 'elapsed': 0.0}
+    started = time.perf_counter()
+
+    def pending_batches():
+        batch = []
+        for path in iter_files(root):
+            batch.append(path)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def new_paths(batch):
+        """去掉已经导入过的文件"""
+        ids = {ingest_file_id(user_id, path): path for path in batch}
+        existing = {file_id for (file_id,) in db.session.query(File.id).filter(File.id.in_(list(ids)))}
+        result['scanned'] += len(batch)
+        result['skipped'] += len(existing)
+        return [path for file_id, path in ids.items() if file_id not in existing]
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # 主进程写入当前批次时，进程池已在计算下一批的哈希
+        in_flight = None
+        for batch in pending_batches():
+            paths = new_paths(batch)
+            submitted = [pool.submit(hash_file, path) for path in paths]
+            if in_flight is not None:
+                _import_batch(storage, in_flight, user_id, share_type, password, expiry_time,
+                              allow_view, allow_download, link_mode, now, result)
+                _report(result, started, on_batch)
+            in_flight = submitted
+        if in_flight is not None:
+            _import_batch(storage, in_flight, user_id, share_type, password, expiry_time,
+                          allow_view, allow_download, link_mode, now, result)
+            _report(result, started, on_batch)
+
+    result['elapsed'] = time.perf_counter() - started
+    return result
+
+
+def _report(result, started, on_batch):
+    result['elapsed'] = time.perf_counter() - started
+    if on_batch:
+        on_batch(result)
+
+
+def _import_batch(storage, futures, user_id, share_type, password, expiry_time, allow_view, allow_download,
+                  link_mode, now, result):
+    rows = []
+    for future in futures:
+        try:
+            path, size, file_hash = future.result()
+        except OSError:
+            result['errors'] += 1
+            continue
+        file_id = ingest_file_id(user_id, path)
+        raw_filename = os.path.basename(path)
+        filename = secure_filename(raw_filename) or file_id
+        key = storage.shard_key(f'{file_id}_{filename}')
+        try:
+            used = place_file(storage, key, path, link_mode)
+        except OSError:
+            result['errors'] += 1
+            continue
+        result[used] += 1
+        result['bytes'] += size
+        rows.append({
+            'id': file_id,
+            'filename': key.rsplit('/', 1)[-1],
+            'original_filename': filename,
+            'raw_filename': raw_filename,
+            'filepath': storage.filepath_for(key),
+            'upload_time': now,
+            'user_id': user_id,
+            'is_public': share_type == 'public',
+            'share_type': share_type,
+            'password': password,
+            'expiry_time': expiry_time,
+            'file_size': size,
+            'file_hash': file_hash,
+            'allow_view': allow_view,
+            'allow_download': allow_download,
+            'allow_edit': False,
+            'download_count': 0,
+            'view_count': 0,
+            'bytes_served': 0,
+        })
+    if rows:
+        db.session.execute(File.__table__.insert(), rows)
+        # 管理员导入不受配额限制，但计入用量
+        quota.charge(user_id, sum(row['file_size'] for row in rows), len(rows), enforce=False)
+        stats.add_files(rows)
+        bump_listing_version([user_id], public=share_type == 'public')
+        db.session.commit()
+        result['imported'] += len(rows)
@@ -0,0 +1,54 @@
+"""
+存储目录布局迁移
+把平铺在 uploads/ 下的旧文件移动到哈希分级目录并改写 File.filepath。
+每批先移动文件再提交记录；移动后、提交前读取旧路径的请求由 LocalStorage 回退到新路径，
+中途中断后重新执行即可继续
+"""
+
+import time
+
+from models import File, db
+
+
+def migrate_flat_files(storage, batch_size=500, pause=0, on_batch=None):
+    """迁移所有平铺存放的文件，返回迁移统计"""
+    result = {'scanned': 0, 'moved': 0, 'missing': 0, 'batches': 0}
+    last_id = ''
+
+    while True:
+        rows = db.session.query(File.id, File.filepath).filter(
+            File.id > last_id
+        ).order_by(File.id).limit(batch_size).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+        result['scanned'] += len(rows)
+
+        updates = []
+        for row in rows:
+            key = storage.key_from_filepath(row.filepath)
+            if '/' in key:
+                continue
+            try:
+                new_key = storage.reshard(key)
+            except FileNotFoundError:
+                result['missing'] += 1
+                continue
+            updates.append({'id': row.id, 'filepath': storage.filepath_for(new_key)})
+
+        if updates:
+            for update in updates:
+                db.session.execute(db.update(File).where(File.id == update['id']).values(filepath=update['filepath']))
+            db.session.commit()
+        else:
+            db.session.rollback()
+
+        result['moved'] += len(updates)
+        result['batches'] += 1
+        if on_batch:
+            on_batch(result)
+        if pause and updates:
+            # 在线迁移时让出磁盘和数据库，避免影响正常请求
+            time.sleep(pause)
+
+    return result
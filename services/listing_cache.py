@@ -0,0 +1,210 @@
+"""
+文件列表片段缓存
+首页文件列表的每一行单独渲染并缓存，键由文件ID和该行显示的所有字段的摘要组成，内容变化后键随之变化，
+不需要主动失效。登录用户的整个列表另以 (用户ID, User.listing_version) 为键缓存：上传、修改分享设置、
+删除和过期清理时递增 listing_version，列表未变化的重复访问既不查询文件也不渲染模板。
+键对应的内容不会改变，所以本进程内按字节数限制大小的 LRU 可以直接放在可选的共享后端（Redis）之前
+"""
+
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from flask import current_app
+from markupsafe import Markup
+
+from models import ListingVersion, User, db
+from services.stats import upsert_add
+
+try:
+    import redis
+except ImportError:  # 共享缓存为可选依赖
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+ROW_TEMPLATE = 'files/_file_row.html'
+
+
+class LRUCache:
+    """按值的总长度（字符数）限制大小的 LRU 缓存，线程安全"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, keys):
+        found = {}
+        with self._lock:
+            for key in keys:
+                value = self._items.get(key)
+                if value is not None:
+                    self._items.move_to_end(key)
+                    found[key] = value
+        return found
+
+    def set_many(self, mapping):
+        with self._lock:
+            for key, value in mapping.items():
+                if len(value) > self.max_bytes:
+                    continue
+                old = self._items.pop(key, None)
+                if old is not None:
+                    self.size -= len(old)
+                self._items[key] = value
+                self.size += len(value)
+            while self.size > self.max_bytes:
+                _, value = self._items.popitem(last=False)
+                self.size -= len(value)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+
+class RedisBackend:
+    """多个进程共享的缓存，出错时按未命中处理"""
+
+    def __init__(self, url, ttl, prefix='fileshare:listing:'):
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get_many(self, keys):
+        try:
+            values = self.client.mget([self.prefix + key for key in keys])
+        except redis.RedisError as e:
+            logger.warning(f"读取共享列表缓存失败: {e}")
+            return {}
+        return {key: value.decode('utf-8') for key, value in zip(keys, values) if value is not None}
+
+    def set_many(self, mapping):
+        try:
+            with self.client.pipeline(transaction=False) as pipe:
+                for key, value in mapping.items():
+                    pipe.set(self.prefix + key, value.encode('utf-8'), ex=self.ttl)
+                pipe.execute()
+        except redis.RedisError as e:
+            logger.warning(f"写入共享列表缓存失败: {e}")
+
+
+class ListingCache:
+    """首页文件列表的行缓存和整页缓存"""
+
+    def __init__(self, app=None):
+        self.local = None
+        self.shared = None
+        self.enabled = False
+        self.max_entry_bytes = 0
+        self._generation = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('LISTING_CACHE_ENABLED', True)
+        app.config.setdefault('LISTING_CACHE_MAX_BYTES', 64 * 1024 * 1024)
+        app.config.setdefault('LISTING_CACHE_URL', None)  # 例如 redis://localhost:6379/0
+        app.config.setdefault('LISTING_CACHE_TTL', 24 * 3600)  # 共享后端中条目的有效期(秒)
+        self.enabled = app.config['LISTING_CACHE_ENABLED']
+        max_bytes = app.config['LISTING_CACHE_MAX_BYTES']
+        self.local = LRUCache(max_bytes)
+        # 单个整页列表最多占缓存的四分之一，避免一个超大列表挤掉其他所有条目
+        self.max_entry_bytes = max_bytes // 4
+        url = app.config['LISTING_CACHE_URL']
+        if url:
+            if redis is None:
+                logger.warning('未安装 redis，列表缓存只使用本进程内的 LRU')
+            else:
+                self.shared = RedisBackend(url, app.config['LISTING_CACHE_TTL'])
+        app.extensions['listing_cache'] = self
+
+    def _get_many(self, keys):
+        found = self.local.get_many(keys)
+        if self.shared is not None and len(found) < len(keys):
+            fetched = self.shared.get_many([key for key in keys if key not in found])
+            if fetched:
+                self.local.set_many(fetched)
+                found.update(fetched)
+        return found
+
+    def _set_many(self, mapping):
+        self.local.set_many(mapping)
+        if self.shared is not None:
+            self.shared.set_many(mapping)
+
+    def _template(self):
+        env = current_app.jinja_env
+        if self._generation is None:
+            # 模板修改后（重新部署）共享后端中的旧条目自然失效
+            source, _, _ = env.loader.get_source(env, ROW_TEMPLATE)
+            self._generation = hashlib.blake2b(source.encode('utf-8'), digest_size=4).hexdigest()
+        return env.get_template(ROW_TEMPLATE)
+
+    @staticmethod
+    def _row_key(generation, file, can_manage):
+        fields = (file.raw_filename, file.original_filename, file.upload_time, file.share_type, bool(file.password),
+                  file.allow_view, file.allow_download, file.allow_edit, file.expiry_time, can_manage,
+                  file.media_info.summary if file.media_info else None)
+        digest = hashlib.blake2b(repr(fields).encode('utf-8'), digest_size=12).hexdigest()
+        return f'row:{generation}:{file.id}:{digest}'
+
+    def render_row_list(self, files, can_manage=False):
+        """逐行渲染文件列表，返回每行的 HTML，未变化的行直接使用缓存"""
+        template = self._template()
+        if not self.enabled:
+            return [template.render(file=file, can_manage=can_manage) for file in files]
+
+        keys = [self._row_key(self._generation, file, can_manage) for file in files]
+        cached = self._get_many(keys)
+        rendered = {}
+        rows = []
+        for key, file in zip(keys, files):
+            row = cached.get(key)
+            if row is None:
+                row = rendered[key] = template.render(file=file, can_manage=can_manage)
+            rows.append(row)
+        if rendered:
+            self._set_many(rendered)
+        return rows
+
+    def render_rows(self, files, can_manage=False):
+        """渲染文件列表的所有行"""
+        return Markup(''.join(self.render_row_list(files, can_manage)))
+
+    def render_user_listing(self, user, load_files):
+        """登录用户自己的文件列表；listing_version 未变化时直接返回上次的结果，不调用 load_files"""
+        if not self.enabled:
+            return self.render_rows(load_files(), can_manage=True)
+        self._template()
+        key = f'page:{self._generation}:{user.id}:{user.listing_version or 0}'
+        cached = self._get_many([key]).get(key)
+        if cached is not None:
+            return Markup(cached)
+        listing = self.render_rows(load_files(), can_manage=True)
+        if len(listing) <= self.max_entry_bytes:
+            self._set_many({key: str(listing)})
+        return listing
+
+
+PUBLIC_LISTING = 'public'
+
+
+def bump_listing_version(user_ids=None, public=False):
+    """用户的文件列表发生变化，使整页缓存失效；不提交事务，与业务数据一起提交。
+    public=True 表示公开文件有变化（上传、删除、分享设置或过期时间），匿名首页随之更新"""
+    if public:
+        upsert_add(ListingVersion, ['name'], [{'name': PUBLIC_LISTING, 'version': 1}])
+    statement = db.update(User).values(listing_version=User.listing_version + 1)
+    if user_ids is not None:
+        user_ids = list(set(user_ids))
+        if not user_ids:
+            return
+        statement = statement.where(User.id.in_(user_ids))
+    db.session.execute(statement.execution_options(synchronize_session=False))
+
+
+listing_cache = ListingCache()
@@ -0,0 +1,643 @@
+"""
+文件元数据
+上传完成后在后台线程池中读取文件头部：按魔数识别真实的 MIME 类型，并用纯 Python 解析图片尺寸、
+音视频容器的时长和尺寸、PDF 页数，结果写入 FileMetadata 表。详情页和文件列表只读该表，不再读取文件内容。
+解析只读取所需的几段字节（文件头、末尾、MP4 的 moov 盒等），不读取整个文件；PDF 较小时整个扫描。
+每轮处理还没有元数据的文件，新文件优先；内容被替换（新版本）时删除旧记录，由下一轮重新提取
+"""
+
+import logging
+import mimetypes
+import os
+import re
+import struct
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from models import File, FileMetadata, db
+from services.background import BackgroundWorker
+from services.compression import open_seekable
+from services.listing_cache import bump_listing_version
+from services.text_preview import NotTextError, detect_encoding
+
+logger = logging.getLogger(__name__)
+
+HEAD_BYTES = 64 * 1024
+TAIL_BYTES = 64 * 1024
+# 读取 MP4 moov 盒和 Matroska 头部的上限
+MAX_HEADER_BYTES = 16 * 1024 * 1024
+# 不超过该大小的 PDF 整个扫描页数，更大的只扫描开头和末尾
+PDF_FULL_SCAN_BYTES = 16 * 1024 * 1024
+PDF_PARTIAL_SCAN_BYTES = 4 * 1024 * 1024
+
+# 浏览器能直接显示的类型，详情页据此决定预览方式
+PREVIEW_TYPES = {
+    'image/jpeg': 'image', 'image/png': 'image', 'image/gif': 'image', 'image/webp': 'image', 'image/bmp': 'image',
+    'video/mp4': 'video', 'video/webm': 'video', 'video/quicktime': 'video',
+    'audio/mpeg': 'audio', 'audio/wav': 'audio', 'audio/ogg': 'audio', 'audio/flac': 'audio', 'audio/aac': 'audio',
+    'audio/mp4': 'audio',
+    'application/pdf': 'pdf',
+}
+
+ARCHIVE_TYPES = {'application/zip', 'application/gzip', 'application/x-bzip2', 'application/x-xz',
+                 'application/x-7z-compressed', 'application/vnd.rar', 'application/x-tar', 'application/zstd'}
+
+
+class Source:
+    """按偏移读取文件内容"""
+
+    def __init__(self, stream, size):
+        self.stream = stream
+        self.size = size
+
+    def read(self, offset, length):
+        if offset >= self.size or length <= 0:
+            return b''
+        self.stream.seek(offset)
+        return self.stream.read(min(length, self.size - offset))
+
+
+# ---- 类型识别 ----
+
+def _ftyp_mime(head):
+    brand = head[8:12]
+    if brand == b'qt  ':
+        return 'video/quicktime'
+    if brand in (b'M4A ', b'M4B '):
+        return 'audio/mp4'
+    if brand in (b'avif', b'avis'):
+        return 'image/avif'
+    if brand in (b'heic', b'heix', b'mif1', b'msf1'):
+        return 'image/heic'
+    return 'video/mp4'
+
+
+# 文本中常见的字节：可打印 ASCII、常用控制字符和所有高位字节
+_TEXT_BYTES = bytes([7, 8, 9, 10, 11, 12, 13, 27]) + bytes(range(0x20, 0x7f)) + bytes(range(0x80, 0x100))
+
+
+def sniff_mime(head, filename=None):
+    """按文件开头的字节识别 MIME 类型，无法识别的二进制内容返回 application/octet-stream"""
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if head.startswith((b'GIF87a', b'GIF89a')):
+        return 'image/gif'
+    if head.startswith(b'BM') and len(head) >= 26 and struct.unpack_from('<I', head, 14)[0] in (
+            12, 40, 52, 56, 108, 124):
+        return 'image/bmp'
+    if head.startswith(b'RIFF') and len(head) >= 12:
+        return {b'WEBP': 'image/webp', b'WAVE': 'audio/wav', b'AVI ': 'video/x-msvideo'}.get(
+            head[8:12], 'application/octet-stream')
+    if head[4:8] == b'ftyp':
+        return _ftyp_mime(head)
+    if head.startswith(b'\x1a\x45\xdf\xa3'):
+        return 'video/webm' if b'webm' in head[:64] else 'video/x-matroska'
+    if head.startswith(b'%PDF-'):
+        return 'application/pdf'
+    if head.startswith(b'fLaC'):
+        return 'audio/flac'
+    if head.startswith(b'OggS'):
+        return 'audio/ogg'
+    if head.startswith(b'ID3'):
+        return 'audio/mpeg'
+    if head.startswith(b'PK\x03\x04') or head.startswith(b'PK\x05\x06'):
+        # docx、epub、jar 等都是 zip 容器，按扩展名细分
+        guessed = mimetypes.guess_type(filename or '')[0]
+        if guessed and (guessed.startswith('application/vnd.') or guessed in (
+                'application/epub+zip', 'application/java-archive')):
+            return guessed
+        return 'application/zip'
+    if head.startswith(b'\x1f\x8b'):
+        return 'application/gzip'
+    if head.startswith(b'BZh'):
+        return 'application/x-bzip2'
+    if head.startswith(b'\xfd7zXZ\x00'):
+        return 'application/x-xz'
+    if head.startswith(b"7z\xbc\xaf\x27\x1c"):
+        return 'application/x-7z-compressed'
+    if head.startswith(b'Rar!\x1a\x07'):
+        return 'application/vnd.rar'
+    if head.startswith(b'\x28\xb5\x2f\xfd'):
+        return 'application/zstd'
+    if head[257:262] == b'ustar':
+        return 'application/x-tar'
+    if len(head) >= 2 and head[0] == 0xff and head[1] & 0xf6 == 0xf0:
+        return 'audio/aac'
+    if len(head) >= 2 and head[0] == 0xff and head[1] & 0xe0 == 0xe0 and head[1] & 0x06:
+        return 'audio/mpeg'
+    if head.startswith((b'\x7fELF', b'MZ')):
+        return 'application/octet-stream'
+
+    if not head:
+        return 'application/x-empty'
+    try:
+        detect_encoding(head)
+    except NotTextError:
+        return 'application/octet-stream'
+    if len(head.translate(None, _TEXT_BYTES)) * 10 > len(head):
+        # 控制字符很多，按二进制处理
+        return 'application/octet-stream'
+    # 文本内容按扩展名细分（text/csv、application/json 等）
+    guessed = mimetypes.guess_type(filename or '')[0]
+    if guessed and (guessed.startswith('text/') or guessed in (
+            'application/json', 'application/xml', 'application/javascript')):
+        return guessed
+    return 'text/plain'
+
+
+def kind_of(mime_type):
+    if mime_type == 'application/pdf':
+        return 'pdf'
+    if mime_type in ARCHIVE_TYPES:
+        return 'archive'
+    major = mime_type.split('/', 1)[0]
+    if major in ('image', 'video', 'audio', 'text'):
+        return major
+    if mime_type in ('application/json', 'application/xml', 'application/javascript'):
+        return 'text'
+    return 'other'
+
+
+# ---- 图片 ----
+
+def _image_size(source, head, mime_type):
+    if mime_type == 'image/png' and head[12:16] == b'IHDR':
+        return struct.unpack_from('>II', head, 16)
+    if mime_type == 'image/gif':
+        return struct.unpack_from('<HH', head, 6)
+    if mime_type == 'image/bmp':
+        width, height = struct.unpack_from('<ii', head, 18)
+        return width, abs(height)
+    if mime_type == 'image/webp':
+        chunk = head[12:16]
+        if chunk == b'VP8 ' and head[23:26] == b'\x9d\x01\x2a':
+            width, height = struct.unpack_from('<HH', head, 26)
+            return width & 0x3fff, height & 0x3fff
+        if chunk == b'VP8L' and head[20] == 0x2f:
+            bits = int.from_bytes(head[21:25], 'little')
+            return (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+        if chunk == b'VP8X':
+            return int.from_bytes(head[24:27], 'little') + 1, int.from_bytes(head[27:30], 'little') + 1
+        return None
+    if mime_type == 'image/jpeg':
+        return _jpeg_size(source)
+    return None
+
+
+# 带尺寸的 SOF 段（不含 DHT/JPG/DAC）
+_JPEG_SOF = {0xc0, 0xc1, 0xc2, 0xc3, 0xc5, 0xc6, 0xc7, 0xc9, 0xca, 0xcb, 0xcd, 0xce, 0xcf}
+
+
+def _jpeg_size(source):
+    """跳过各段直到 SOF 段，EXIF 缩略图等较大的段只读段头"""
+    offset = 2
+    for _ in range(1000):
+        header = source.read(offset, 9)
+        if len(header) < 4 or header[0] != 0xff:
+            return None
+        marker = header[1]
+        if marker == 0xff:  # 填充字节
+            offset += 1
+            continue
+        if marker in (0xd8, 0x01) or 0xd0 <= marker <= 0xd7:
+            offset += 2
+            continue
+        (length,) = struct.unpack_from('>H', header, 2)
+        if marker in _JPEG_SOF:
+            if len(header) < 9:
+                return None
+            height, width = struct.unpack_from('>HH', header, 5)
+            return width, height
+        if marker == 0xd9:
+            return None
+        offset += 2 + length
+    return None
+
+
+# ---- 音视频 ----
+
+def _boxes(data, start=0, end=None):
+    """遍历 ISO BMFF 盒，产出 (类型, 数据起点, 盒终点)"""
+    end = len(data) if end is None else end
+    offset = start
+    while offset + 8 <= end:
+        size, kind = struct.unpack_from('>I4s', data, offset)
+        header = 8
+        if size == 1:
+            if offset + 16 > end:
+                return
+            (size,) = struct.unpack_from('>Q', data, offset + 8)
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header:
+            return
+        yield kind, offset + header, min(offset + size, end)
+        offset += size
+
+
+def _mp4_info(source):
+    """在顶层盒中找到 moov，读取 mvhd 的时长和第一个视频轨道 tkhd 的尺寸"""
+    offset = 0
+    moov = None
+    while offset + 8 <= source.size:
+        header = source.read(offset, 16)
+        size, kind = struct.unpack_from('>I4s', header)
+        header_size = 8
+        if size == 1:
+            (size,) = struct.unpack_from('>Q', header, 8)
+            header_size = 16
+        elif size == 0:
+            size = source.size - offset
+        if size < header_size:
+            break
+        if kind == b'moov':
+            if size > MAX_HEADER_BYTES:
+                return {}
+            moov = source.read(offset + header_size, size - header_size)
+            break
+        offset += size
+    if moov is None:
+        return {}
+
+    info = {}
+    for kind, start, end in _boxes(moov):
+        if kind == b'mvhd':
+            version = moov[start]
+            if version == 1:
+                timescale, duration = struct.unpack_from('>IQ', moov, start + 20)
+            else:
+                timescale, duration = struct.unpack_from('>II', moov, start + 12)
+            if timescale and duration != (0xffffffffffffffff if version == 1 else 0xffffffff):
+                info['duration'] = duration / timescale
+        elif kind == b'trak' and 'width' not in info:
+            for child, child_start, child_end in _boxes(moov, start, end):
+                if child == b'tkhd':
+                    position = child_start + (88 if moov[child_start] == 1 else 76)
+                    if position + 8 <= child_end:
+                        width, height = struct.unpack_from('>II', moov, position)
+                        if width and height:
+                            info['width'], info['height'] = width >> 16, height >> 16
+    return info
+
+
+def _riff_info(source, head, mime_type):
+    """WAV 按 fmt 的字节率和 data 大小计算时长；AVI 读取 avih 主头"""
+    if mime_type == 'video/x-msvideo':
+        position = head.find(b'avih')
+        if position < 0 or position + 48 > len(head):
+            return {}
+        usec_per_frame, = struct.unpack_from('<I', head, position + 8)
+        total_frames, = struct.unpack_from('<I', head, position + 24)
+        width, height = struct.unpack_from('<II', head, position + 40)
+        info = {'width': width, 'height': height}
+        if usec_per_frame and total_frames:
+            info['duration'] = usec_per_frame * total_frames / 1e6
+        return info
+
+    offset = 12
+    byte_rate = None
+    while offset + 8 <= source.size:
+        kind, size = struct.unpack('<4sI', source.read(offset, 8))
+        if kind == b'fmt ':
+            fmt = source.read(offset + 8, 16)
+            if len(fmt) >= 12:
+                (byte_rate,) = struct.unpack_from('<I', fmt, 8)
+        elif kind == b'data':
+            # 流式写入的 WAV data 大小可能是 0 或 0xFFFFFFFF，按文件剩余长度计算
+            if size in (0, 0xffffffff):
+                size = source.size - offset - 8
+            return {'duration': min(size, source.size - offset - 8) / byte_rate} if byte_rate else {}
+        offset += 8 + size + (size & 1)
+    return {}
+
+
+def _flac_info(head):
+    # STREAMINFO 总是第一个元数据块：采样率 20 位、声道 3 位、位深 5 位、总采样数 36 位
+    if len(head) < 26 or head[4] & 0x7f != 0:
+        return {}
+    streaminfo = head[8:42]
+    sample_rate = int.from_bytes(streaminfo[10:13], 'big') >> 4
+    total_samples = int.from_bytes(streaminfo[13:18], 'big') & 0xfffffffff
+    if sample_rate and total_samples:
+        return {'duration': total_samples / sample_rate}
+    return {}
+
+
+def _ogg_info(source, head):
+    """由第一页的编码头取采样率，最后一页的 granule position 即总采样数"""
+    position = head.find(b'\x01vorbis')
+    if position >= 0:
+        (sample_rate,) = struct.unpack_from('<I', head, position + 12)
+        pre_skip = 0
+    else:
+        position = head.find(b'OpusHead')
+        if position < 0:
+            return {}
+        (pre_skip,) = struct.unpack_from('<H', head, position + 10)
+        sample_rate = 48000  # Opus 的 granule position 固定以 48kHz 计
+    tail = source.read(max(0, source.size - TAIL_BYTES), TAIL_BYTES)
+    last = tail.rfind(b'OggS')
+    if last < 0 or last + 14 > len(tail) or not sample_rate:
+        return {}
+    (granule,) = struct.unpack_from('<q', tail, last + 6)
+    if granule <= 0:
+        return {}
+    return {'duration': max(0, granule - pre_skip) / sample_rate}
+
+
+_MP3_BITRATES = {
+    (1, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (1, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (1, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (2, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (2, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+_MP3_BITRATES[(2, 3)] = _MP3_BITRATES[(2, 2)]
+_MP3_SAMPLE_RATES = {1: (44100, 48000, 32000), 2: (22050, 24000, 16000), 2.5: (11025, 12000, 8000)}
+
+
+def _mp3_info(source, head):
+    """有 Xing/Info/VBRI 头时按帧数计算，否则按第一帧的码率估算（CBR）"""
+    offset = 0
+    if head.startswith(b'ID3') and len(head) >= 10:
+        offset = 10 + (head[6] << 21 | head[7] << 14 | head[8] << 7 | head[9])
+        if head[5] & 0x10:
+            offset += 10  # 尾部标签
+    data = source.read(offset, 4096)
+    position = 0
+    while position + 4 <= len(data):
+        if data[position] == 0xff and data[position + 1] & 0xe0 == 0xe0:
+            break
+        position += 1
+    else:
+        return {}
+    b1, b2, b3 = data[position + 1], data[position + 2], data[position + 3]
+    version = {3: 1, 2: 2, 0: 2.5}.get((b1 >> 3) & 3)
+    layer = {3: 1, 2: 2, 1: 3}.get((b1 >> 1) & 3)
+    bitrate_index, rate_index = b2 >> 4, (b2 >> 2) & 3
+    if version is None or layer is None or bitrate_index in (0, 15) or rate_index == 3:
+        return {}
+    sample_rate = _MP3_SAMPLE_RATES[version][rate_index]
+    bitrate = _MP3_BITRATES[(1 if version == 1 else 2, layer)][bitrate_index] * 1000
+    samples_per_frame = 384 if layer == 1 else (1152 if layer == 2 or version == 1 else 576)
+
+    mono = (b3 >> 6) == 3
+    side_info = (17 if mono else 32) if version == 1 else (9 if mono else 17)
+    xing = position + 4 + side_info
+    if data[xing:xing + 4] in (b'Xing', b'Info') and data[xing + 7] & 1:
+        (frames,) = struct.unpack_from('>I', data, xing + 8)
+        return {'duration': frames * samples_per_frame / sample_rate}
+    if data[position + 36:position + 40] == b'VBRI':
+        (frames,) = struct.unpack_from('>I', data, position + 50)
+        return {'duration': frames * samples_per_frame / sample_rate}
+    audio_bytes = source.size - offset - position
+    if source.size >= 128 and source.read(source.size - 128, 3) == b'TAG':
+        audio_bytes -= 128
+    return {'duration': audio_bytes * 8 / bitrate}
+
+
+# Matroska 中需要进入的主元素
+_EBML_SEGMENT, _EBML_INFO, _EBML_TRACKS, _EBML_TRACK_ENTRY, _EBML_VIDEO = (
+    0x18538067, 0x1549a966, 0x1654ae6b, 0xae, 0xe0)
+_EBML_CLUSTER = 0x1f43b675
+
+
+def _ebml_vint(data, offset, keep_marker):
+    first = data[offset]
+    length = 1
+    while length <= 8 and not first & (0x80 >> (length - 1)):
+        length += 1
+    if length > 8 or offset + length > len(data):
+        raise ValueError('EBML 长度无效')
+    value = int.from_bytes(data[offset:offset + length], 'big')
+    if not keep_marker:
+        value &= (1 << (7 * length)) - 1
+        if value == (1 << (7 * length)) - 1:
+            value = None  # 未知长度
+    return value, offset + length
+
+
+def _matroska_info(source):
+    """解析 Segment 中 Info 的时长和第一个视频轨道的像素尺寸，遇到 Cluster（媒体数据）停止"""
+    data = source.read(0, min(source.size, 1024 * 1024))
+    info = {}
+    scale = 1000000
+    duration = None
+
+    def walk(start, end):
+        nonlocal scale, duration
+        offset = start
+        while offset < end:
+            element, offset = _ebml_vint(data, offset, True)
+            size, offset = _ebml_vint(data, offset, False)
+            stop = end if size is None else min(offset + size, end)
+            if element == _EBML_CLUSTER:
+                return False
+            if element in (_EBML_SEGMENT, _EBML_INFO, _EBML_TRACKS, _EBML_TRACK_ENTRY, _EBML_VIDEO):
+                if walk(offset, stop) is False:
+                    return False
+            elif element == 0x2ad7b1:  # TimecodeScale
+                scale = int.from_bytes(data[offset:stop], 'big')
+            elif element == 0x4489:  # Duration
+                duration = struct.unpack('>f' if stop - offset == 4 else '>d', data[offset:stop])[0]
+            elif element == 0xb0 and 'width' not in info:  # PixelWidth
+                info['width'] = int.from_bytes(data[offset:stop], 'big')
+            elif element == 0xba and 'height' not in info:  # PixelHeight
+                info['height'] = int.from_bytes(data[offset:stop], 'big')
+            offset = stop
+        return True
+
+    try:
+        walk(0, len(data))
+    except (ValueError, IndexError, struct.error):
+        pass
+    if duration:
+        info['duration'] = duration * scale / 1e9
+    return info
+
+
+# ---- PDF ----
+
+_PDF_PAGES = re.compile(rb'/Type\s*/Pages\b')
+_PDF_COUNT = re.compile(rb'/Count\s+(\d+)')
+_PDF_PAGE = re.compile(rb'/Type\s*/Page\b(?!s)')
+_PDF_OBJECT_STREAM = re.compile(rb'/Type\s*/ObjStm\b')
+
+
+def _pdf_pages_in(data):
+    """页面树根节点的 /Count 是总页数，取所有 Pages 节点中最大的；没有时数 Page 对象"""
+    counts = []
+    for match in _PDF_PAGES.finditer(data):
+        window = data[max(0, match.start() - 512):match.end() + 512]
+        counts.extend(int(count) for count in _PDF_COUNT.findall(window))
+    return max(counts) if counts else 0, len(_PDF_PAGE.findall(data))
+
+
+def _pdf_pages(source):
+    if source.size <= PDF_FULL_SCAN_BYTES:
+        data = source.read(0, source.size)
+    else:
+        data = (source.read(0, PDF_PARTIAL_SCAN_BYTES) + b'\n'
+                + source.read(source.size - PDF_PARTIAL_SCAN_BYTES, PDF_PARTIAL_SCAN_BYTES))
+    pages, page_objects = _pdf_pages_in(data)
+    if pages:
+        return pages
+    # PDF 1.5 起对象可以压缩在对象流中，解压 FlateDecode 对象流后再找
+    for match in _PDF_OBJECT_STREAM.finditer(data):
+        start = data.find(b'stream', match.end())
+        if start < 0:
+            continue
+        start += 6
+        start += 2 if data[start:start + 2] == b'\r\n' else 1
+        try:
+            content = zlib.decompressobj().decompress(data[start:start + PDF_PARTIAL_SCAN_BYTES], MAX_HEADER_BYTES)
+        except zlib.error:
+            continue
+        found, objects = _pdf_pages_in(content)
+        pages = max(pages, found)
+        page_objects += objects
+    return pages or page_objects or None
+
+
+def extract(stream, size, filename=None):
+    """读取文件的元数据，返回 FileMetadata 的字段"""
+    source = Source(stream, size)
+    head = source.read(0, HEAD_BYTES)
+    mime_type = sniff_mime(head, filename)
+    result = {'mime_type': mime_type, 'kind': kind_of(mime_type), 'size': size}
+    try:
+        if mime_type.startswith('image/'):
+            dimensions = _image_size(source, head, mime_type)
+            if dimensions:
+                result['width'], result['height'] = dimensions
+        elif head[4:8] == b'ftyp':
+            result.update(_mp4_info(source))
+        elif head.startswith(b'RIFF'):
+            result.update(_riff_info(source, head, mime_type))
+        elif mime_type == 'audio/flac':
+            result.update(_flac_info(head))
+        elif mime_type == 'audio/ogg':
+            result.update(_ogg_info(source, head))
+        elif mime_type == 'audio/mpeg':
+            result.update(_mp3_info(source, head))
+        elif mime_type in ('video/webm', 'video/x-matroska'):
+            result.update(_matroska_info(source))
+        elif mime_type == 'application/pdf':
+            result['pages'] = _pdf_pages(source)
+    except (struct.error, IndexError, ValueError, ZeroDivisionError) as e:
+        # 文件头损坏时只保留类型
+        logger.info(f"解析 {filename} 的元数据失败: {e}")
+    return result
+
+
+def remove(file_ids):
+    """删除文件的元数据（文件删除或内容被替换时），不提交事务"""
+    file_ids = list(file_ids)
+    if file_ids:
+        db.session.execute(db.delete(FileMetadata).where(FileMetadata.file_id.in_(file_ids)))
+
+
+class MetadataExtractor(BackgroundWorker):
+    """后台为还没有元数据的文件提取元数据"""
+
+    name = 'metadata-extractor'
+    enabled_config = ('METADATA_EXTRACTOR_ENABLED', True)
+    interval_config = ('METADATA_EXTRACTOR_INTERVAL', 30)  # 秒
+    default_metrics = {
+        'extracted_total': 0,
+        'errors_total': 0,
+        'last_run_at': None,
+    }
+
+    def __init__(self, app=None):
+        self._extract_lock = threading.Lock()
+        super().__init__(app)
+
+    def init_app(self, app):
+        app.config.setdefault('METADATA_EXTRACTOR_BATCH_SIZE', 200)
+        app.config.setdefault('METADATA_EXTRACTOR_WORKERS', 4)
+        super().init_app(app)
+
+    def run_once(self):
+        self.extract_pending()
+
+    def extract_pending(self, max_batches=None):
+        """提取所有缺少元数据的文件，返回处理的文件数"""
+        with self._extract_lock:
+            with self.app.app_context():
+                try:
+                    return self._extract_pending(max_batches)
+                finally:
+                    db.session.remove()
+
+    def _extract_one(self, snapshot):
+        file_id, filepath, filename, size, codec = snapshot
+        with self.app.app_context():
+            # 线程中用脱离会话的临时对象读取存储，避免跨线程共享 ORM 对象
+            file = File(id=file_id, filepath=filepath, file_size=size, codec=codec)
+            try:
+                stream = open_seekable(file)
+                try:
+                    if size is None:
+                        size = stream.seek(0, os.SEEK_END)
+                    return extract(stream, size, filename)
+                finally:
+                    stream.close()
+            except Exception as e:
+                logger.warning(f"读取文件 {file_id} 的元数据失败: {e}")
+                return {'mime_type': 'application/octet-stream', 'kind': 'other', 'size': size,
+                        'error': str(e)[:255]}
+
+    def _extract_pending(self, max_batches):
+        batch_size = self.app.config['METADATA_EXTRACTOR_BATCH_SIZE']
+        started = datetime.utcnow()
+        total = batches = 0
+        failed_ids = set()
+
+        with ThreadPoolExecutor(max_workers=self.app.config['METADATA_EXTRACTOR_WORKERS']) as pool:
+            while max_batches is None or batches < max_batches:
+                query = db.session.query(
+                    File.id, File.filepath, db.func.coalesce(File.raw_filename, File.original_filename),
+                    File.file_size, File.codec, File.file_hash, File.user_id, File.share_type
+                ).outerjoin(FileMetadata, FileMetadata.file_id == File.id).filter(FileMetadata.file_id.is_(None))
+                if failed_ids:
+                    query = query.filter(~File.id.in_(failed_ids))
+                rows = query.order_by(File.upload_time.desc()).limit(batch_size).all()
+                if not rows:
+                    break
+                db.session.rollback()  # 提取期间不占用读事务
+
+                results = list(pool.map(lambda row: self._extract_one(tuple(row[:5])), rows))
+
+                # 提取期间文件可能被删除或替换内容，只写入内容未变化的文件
+                current = {row.id: (row.filepath, row.file_hash) for row in db.session.query(
+                    File.id, File.filepath, File.file_hash).filter(File.id.in_([row.id for row in rows]))}
+                now = datetime.utcnow()
+                values = []
+                for row, result in zip(rows, results):
+                    if current.get(row.id) != (row.filepath, row.file_hash):
+                        failed_ids.add(row.id)
+                        continue
+                    values.append(dict(result, file_id=row.id, extracted_at=now))
+                if values:
+                    db.session.execute(db.insert(FileMetadata), values)
+                    # 列表中的行显示尺寸和时长，需要重新渲染
+                    bump_listing_version((row.user_id for row in rows),
+                                         public=any(row.share_type == 'public' for row in rows))
+                db.session.commit()
+
+                errors = sum(1 for value in values if value.get('error'))
+                total += len(values)
+                batches += 1
+                self._incr_metrics(extracted_total=len(values) - errors, errors_total=errors)
+
+        self._update_metrics(last_run_at=started.isoformat())
+        return total
+
+
+metadata_extractor = MetadataExtractor()
@@ -0,0 +1,363 @@
+"""
+运行指标
+进程内用计数器和直方图累计请求耗时、分块上传、数据库查询等指标，后台线程定期把本进程的快照
+写入 instance/metrics/<pid>.json；/metrics 汇总所有进程的快照，按 Prometheus 文本格式输出。
+记录一次指标只是加锁后更新内存中的数值，可以在生产环境常开
+"""
+
+import atexit
+import bisect
+import glob
+import json
+import os
+import threading
+import time
+
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from services.background import BackgroundWorker, FileLock
+
+# 请求和数据库查询耗时的直方图分桶（秒）
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# 分块写入速度的分桶（字节/秒）
+THROUGHPUT_BUCKETS = (128 * 1024, 512 * 1024, 1024 ** 2, 4 * 1024 ** 2, 16 * 1024 ** 2,
+                      64 * 1024 ** 2, 256 * 1024 ** 2, 1024 ** 3)
+
+_DEAD_SNAPSHOT = '_dead.json'
+_SQL_OPERATIONS = {'SELECT', 'INSERT', 'UPDATE', 'DELETE'}
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, registry, name, documentation, labelnames=()):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def _key(self, labels):
+        return json.dumps([str(labels.get(name, '')) for name in self.labelnames])
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.registry.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Histogram(_Metric):
+    """保存各桶的非累计计数，最后两项为总和与次数"""
+
+    kind = 'histogram'
+
+    def __init__(self, registry, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(registry, name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.registry.lock:
+            data = self.values.get(key)
+            if data is None:
+                data = self.values[key] = [0] * (len(self.buckets) + 3)
+            data[index] += 1
+            data[-2] += value
+            data[-1] += 1
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(self, name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(self, name, documentation, labelnames, buckets))
+
+    def _register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def _reset_after_fork(self):
+        # fork 时锁可能正被其他线程持有，子进程中直接换一把新锁
+        self.lock = threading.Lock()
+        for metric in self.metrics.values():
+            metric.values = {}
+
+    def snapshot(self):
+        with self.lock:
+            return {name: {key: list(value) if isinstance(value, list) else value
+                           for key, value in metric.values.items()}
+                    for name, metric in self.metrics.items()}
+
+
+registry = Registry()
+if hasattr(os, 'register_at_fork'):
+    # fork 出的子进程不继承父进程已累计的数值，否则汇总时会重复计算
+    os.register_at_fork(after_in_child=registry._reset_after_fork)
+
+request_duration = registry.histogram(
+    'http_request_duration_seconds', '请求处理耗时（不含流式响应正文的发送）', ('endpoint', 'method', 'status'))
+chunk_bytes = registry.counter('upload_chunk_bytes_total', '已写入存储的分块字节数')
+chunk_duration = registry.histogram('upload_chunk_duration_seconds', '单个分块写入存储的耗时')
+chunk_throughput = registry.histogram(
+    'upload_chunk_throughput_bytes_per_second', '单个分块写入存储的速度', buckets=THROUGHPUT_BUCKETS)
+assembly_duration = registry.histogram('upload_assembly_duration_seconds', '分块上传完成时合并文件的耗时')
+download_bytes = registry.counter('download_bytes_total', '下载和预览响应的正文字节数', ('kind',))
+db_query_duration = registry.histogram('db_query_duration_seconds', '数据库查询耗时', ('operation',))
+
+
+def observe_chunk(size, seconds):
+    chunk_bytes.inc(size)
+    chunk_duration.observe(seconds)
+    if seconds > 0:
+        chunk_throughput.observe(size / seconds)
+
+
+# ---- 数据库查询 ----
+
+# 开始时间记在每条语句的执行上下文上，语句出错时随上下文一起丢弃，不会在连接上残留
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._metrics_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, '_metrics_start', None)
+    if started is None:
+        return
+    operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ''
+    db_query_duration.observe(time.perf_counter() - started,
+                              operation=operation if operation in _SQL_OPERATIONS else 'OTHER')
+
+
+def _listen_queries():
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+# ---- 多进程快照 ----
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True
+    return True
+
+
+def _read_json(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_json(path, data):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def _merge_values(target, source):
+    """累加计数器和直方图"""
+    for name, values in source.items():
+        merged = target.setdefault(name, {})
+        for key, value in values.items():
+            if isinstance(value, list):
+                current = merged.get(key)
+                merged[key] = value if current is None else [a + b for a, b in zip(current, value)]
+            else:
+                merged[key] = merged.get(key, 0) + value
+
+
+class MetricsExporter(BackgroundWorker):
+    """每个进程定期写出自己的指标快照，退出进程的累计值合并到 _dead.json"""
+
+    name = 'metrics-exporter'
+    enabled_config = ('METRICS_ENABLED', True)
+    interval_config = ('METRICS_EXPORT_INTERVAL', 10)  # 秒
+    single_process = False
+
+    def __init__(self, app=None):
+        self._started_at = time.time()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+        super().__init__(app)
+
+    def _after_fork(self):
+        self._started_at = time.time()
+
+    def init_app(self, app):
+        app.config.setdefault('METRICS_TOKEN', None)
+        super().init_app(app)
+        if not app.config['METRICS_ENABLED']:
+            return
+        self.directory = os.path.join(app.instance_path, 'metrics')
+        _listen_queries()
+        app.before_request(self._start_timer)
+        app.after_request(self._observe_request)
+
+    def _on_started(self):
+        # 只在处理请求的进程退出时写出快照，manage.py 等只导入 app 的进程不留下快照文件
+        atexit.register(self.export)
+
+    def _start_timer(self):
+        g.metrics_start = time.perf_counter()
+
+    def _observe_request(self, response):
+        start = g.pop('metrics_start', None)
+        if start is not None:
+            request_duration.observe(time.perf_counter() - start, endpoint=request.endpoint or 'unknown',
+                                     method=request.method, status=response.status_code)
+        return response
+
+    def run_once(self):
+        self.export()
+
+    def _local_snapshot(self):
+        worker_metrics = {
+            worker.name: {key: value for key, value in worker.get_metrics().items()
+                          if isinstance(value, (int, float)) and not isinstance(value, bool)}
+            for worker in self.app.extensions.values() if isinstance(worker, BackgroundWorker)
+        }
+        return {'pid': os.getpid(), 'started_at': self._started_at,
+                'values': registry.snapshot(), 'workers': worker_metrics}
+
+    def export(self):
+        """写出本进程的快照，并合并已退出进程的快照"""
+        if self.app is None or not self.app.config['METRICS_ENABLED']:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self._fold_dead()
+        _write_json(os.path.join(self.directory, f'{os.getpid()}.json'), self._local_snapshot())
+
+    def _is_stale(self, snapshot):
+        """快照所属进程已退出；进程号被复用时按启动时间区分"""
+        if snapshot['pid'] == os.getpid():
+            return snapshot.get('started_at') != self._started_at
+        return not _pid_alive(snapshot['pid'])
+
+    def _fold_dead(self):
+        with FileLock(os.path.join(self.directory, '.fold.lock')) as acquired:
+            if not acquired:
+                return
+            dead_path = os.path.join(self.directory, _DEAD_SNAPSHOT)
+            dead = _read_json(dead_path) or {'values': {}, 'workers': {}}
+            folded = []
+            for path in glob.glob(os.path.join(self.directory, '[0-9]*.json')):
+                snapshot = _read_json(path)
+                if snapshot is None or not self._is_stale(snapshot):
+                    continue
+                _merge_values(dead['values'], snapshot['values'])
+                # 后台任务的 *_total 指标同样需要保留，其余为瞬时值直接丢弃
+                for worker, values in snapshot.get('workers', {}).items():
+                    totals = dead['workers'].setdefault(worker, {})
+                    for key, value in values.items():
+                        if key.endswith('_total'):
+                            totals[key] = totals.get(key, 0) + value
+                folded.append(path)
+            if folded:
+                _write_json(dead_path, dead)
+                for path in folded:
+                    os.remove(path)
+
+    def collect(self):
+        """汇总所有进程的快照，返回 (计数器和直方图, 后台任务累计值, 后台任务瞬时值)"""
+        snapshots = [self._local_snapshot()]
+        if os.path.isdir(self.directory):
+            for path in glob.glob(os.path.join(self.directory, '*.json')):
+                snapshot = _read_json(path)
+                if snapshot is None or snapshot.get('pid') == os.getpid():
+                    continue
+                if 'pid' in snapshot and self._is_stale(snapshot):
+                    # 尚未合并的已退出进程：只取累计值
+                    snapshot = {'values': snapshot['values'], 'workers': {
+                        worker: {k: v for k, v in values.items() if k.endswith('_total')}
+                        for worker, values in snapshot.get('workers', {}).items()
+                    }}
+                snapshots.append(snapshot)
+
+        values, totals, gauges = {}, {}, {}
+        for snapshot in snapshots:
+            _merge_values(values, snapshot['values'])
+            for worker, metrics in snapshot.get('workers', {}).items():
+                for key, value in metrics.items():
+                    if key.endswith('_total'):
+                        totals[(worker, key)] = totals.get((worker, key), 0) + value
+                    else:
+                        gauges[(worker, key)] = max(gauges.get((worker, key), value), value)
+        return values, totals, gauges
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def render(exporter, gauges=None):
+    """按 Prometheus 文本格式输出所有指标；gauges 为 {名称: (说明, 数值)} 的附加瞬时值"""
+    values, worker_totals, worker_gauges = exporter.collect()
+    lines = []
+
+    for name, metric in registry.metrics.items():
+        lines.append(f'# HELP {name} {metric.documentation}')
+        lines.append(f'# TYPE {name} {metric.kind}')
+        for key, value in sorted(values.get(name, {}).items()):
+            pairs = list(zip(metric.labelnames, json.loads(key)))
+            if metric.kind == 'counter':
+                lines.append(f'{name}{_format_labels(pairs)} {_format_number(value)}')
+                continue
+            cumulative = 0
+            for bound, count in zip(metric.buckets + (float('inf'),), value[:-2]):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else _format_number(bound)
+                lines.append(f'{name}_bucket{_format_labels(pairs + [("le", le)])} {cumulative}')
+            lines.append(f'{name}_sum{_format_labels(pairs)} {_format_number(value[-2])}')
+            lines.append(f'{name}_count{_format_labels(pairs)} {value[-1]}')
+
+    for kind, data in (('counter', worker_totals), ('gauge', worker_gauges)):
+        by_name = {}
+        for (worker, key), value in data.items():
+            by_name.setdefault(f'background_{key}', []).append((worker, value))
+        for name, samples in sorted(by_name.items()):
+            lines.append(f'# TYPE {name} {kind}')
+            for worker, value in sorted(samples):
+                lines.append(f'{name}{_format_labels([("worker", worker)])} {_format_number(value)}')
+
+    for name, (documentation, value) in (gauges or {}).items():
+        lines.append(f'# HELP {name} {documentation}')
+        lines.append(f'# TYPE {name} gauge')
+        lines.append(f'{name} {_format_number(value)}')
+
+    return '\n'.join(lines) + '\n'
+
+
+metrics_exporter = MetricsExporter()
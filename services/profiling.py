@@ -0,0 +1,251 @@
+"""
+请求性能分析
+每个请求累计 SQL 语句数与耗时、存储操作耗时和模板渲染耗时，超过阈值的慢请求连同耗时分解写入日志。
+管理员可以为指定路由开启一段时间的 cProfile 采样，结果保存到 instance/profiling/ 下，
+可用 snakeviz、flameprof 等工具查看或生成火焰图
+"""
+
+import cProfile
+import functools
+import json
+import logging
+import os
+import random
+import threading
+import time
+from datetime import datetime
+
+from flask import g, has_request_context, request, template_rendered, before_render_template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+# 计入存储耗时的后端方法；iter_range 等生成器只统计创建时的开销
+STORAGE_METHODS = ('save', 'open', 'size', 'exists', 'delete', 'move', 'local_path', 'send', 'reshard',
+                   'upload_part', 'complete_multipart', 'abort_multipart')
+
+_TARGET_FILE = 'target.json'
+# 每个进程最多隔多久重新读取一次采样目标
+_TARGET_CHECK_INTERVAL = 1.0
+
+
+def _stats():
+    if not has_request_context():
+        return None
+    return g.get('profile_stats')
+
+
+# ---- SQL ----
+
+# 开始时间记在语句的执行上下文上，出错的语句不会在连接上留下记录
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None and _stats() is not None:
+        context._profile_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _stats()
+    started = getattr(context, '_profile_start', None)
+    if stats is None or started is None:
+        return
+    stats['sql_count'] += 1
+    stats['sql_time'] += time.perf_counter() - started
+
+
+# ---- 模板渲染 ----
+
+def _before_render(sender, template, context, **extra):
+    stats = _stats()
+    if stats is not None:
+        stats['render_starts'].append(time.perf_counter())
+
+
+def _after_render(sender, template, context, **extra):
+    stats = _stats()
+    if stats is not None and stats['render_starts']:
+        elapsed = time.perf_counter() - stats['render_starts'].pop()
+        # 嵌套渲染（模板中 include 另一次 render_template）只计最外层
+        if not stats['render_starts']:
+            stats['render_time'] += elapsed
+
+
+# ---- 存储 ----
+
+def _timed_storage_method(method):
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        stats = _stats()
+        if stats is None or stats['storage_depth']:
+            return method(*args, **kwargs)
+        stats['storage_depth'] += 1
+        started = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            stats['storage_depth'] -= 1
+            stats['storage_count'] += 1
+            stats['storage_time'] += time.perf_counter() - started
+    return wrapper
+
+
+def instrument_storage(storage):
+    """替换存储后端实例上的方法，使其耗时计入当前请求"""
+    for name in STORAGE_METHODS:
+        method = getattr(storage, name, None)
+        if method is not None and not getattr(method, '_profiled', False):
+            wrapper = _timed_storage_method(method)
+            wrapper._profiled = True
+            setattr(storage, name, wrapper)
+
+
+class RequestProfiler:
+    """请求耗时分解、慢请求日志和按路由采样的 cProfile"""
+
+    def __init__(self, app=None):
+        self.app = None
+        self._target = None
+        self._target_mtime = None
+        self._target_checked = 0
+        self._target_lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PROFILING_ENABLED', True)
+        app.config.setdefault('SLOW_REQUEST_THRESHOLD', 1.0)  # 秒
+        self.app = app
+        self.directory = os.path.join(app.instance_path, 'profiling')
+        app.extensions['request-profiler'] = self
+        if not app.config['PROFILING_ENABLED']:
+            return
+
+        if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        before_render_template.connect(_before_render, app)
+        template_rendered.connect(_after_render, app)
+
+        from storage import get_storage
+        instrument_storage(get_storage(app))
+
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+
+    # ---- 每个请求 ----
+
+    def _before_request(self):
+        g.profile_stats = {'start': time.perf_counter(), 'sql_count': 0, 'sql_time': 0.0,
+                           'storage_count': 0, 'storage_time': 0.0, 'storage_depth': 0,
+                           'render_time': 0.0, 'render_starts': []}
+        target = self._current_target()
+        if target and request.endpoint == target['endpoint'] and random.random() < target['rate']:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:  # 同一线程已有其他分析器
+                return
+            g.cprofile = profiler
+
+    def _after_request(self, response):
+        stats = g.get('profile_stats')
+        if stats is not None:
+            elapsed = time.perf_counter() - stats['start']
+            if elapsed >= self.app.config['SLOW_REQUEST_THRESHOLD']:
+                other = elapsed - stats['sql_time'] - stats['storage_time'] - stats['render_time']
+                logger.warning(
+                    f"慢请求 {request.method} {request.full_path.rstrip('?')} ({request.endpoint}) "
+                    f"{elapsed * 1000:.0f}ms: SQL {stats['sql_count']} 次 {stats['sql_time'] * 1000:.0f}ms, "
+                    f"存储 {stats['storage_count']} 次 {stats['storage_time'] * 1000:.0f}ms, "
+                    f"模板 {stats['render_time'] * 1000:.0f}ms, 其他 {max(other, 0) * 1000:.0f}ms"
+                )
+        return response
+
+    def _teardown_request(self, exc):
+        profiler = g.pop('cprofile', None)
+        if profiler is None:
+            return
+        profiler.disable()
+        try:
+            self._dump(profiler)
+        except OSError as e:
+            logger.warning(f"保存性能分析结果失败: {e}")
+
+    def _dump(self, profiler):
+        target = self._current_target()
+        if not target:
+            return
+        # 文件名带上采样批次，max_dumps 只限制本次 start() 保存的份数，之前的结果不计入
+        prefix = f"{target['endpoint'].replace('.', '_')}-{target.get('session', 'unknown')}-"
+        existing = [name for name in os.listdir(self.directory) if name.startswith(prefix)]
+        if len(existing) >= target['max_dumps']:
+            return
+        timestamp = datetime.utcnow().strftime('%Y%m%d_%H%M%S_%f')
+        profiler.dump_stats(os.path.join(self.directory, f'{prefix}{timestamp}-{os.getpid()}.prof'))
+
+    # ---- 采样目标（保存在文件中，所有进程共享） ----
+
+    def _current_target(self):
+        now = time.monotonic()
+        if now - self._target_checked >= _TARGET_CHECK_INTERVAL:
+            with self._target_lock:
+                self._target_checked = now
+                path = os.path.join(self.directory, _TARGET_FILE)
+                try:
+                    mtime = os.stat(path).st_mtime
+                except OSError:
+                    self._target, self._target_mtime = None, None
+                else:
+                    if mtime != self._target_mtime:
+                        try:
+                            with open(path, encoding='utf-8') as f:
+                                self._target = json.load(f)
+                        except (OSError, ValueError):
+                            self._target = None
+                        self._target_mtime = mtime
+        target = self._target
+        if target and time.time() > target['until']:
+            return None
+        return target
+
+    def start(self, endpoint, duration=300, rate=1.0, max_dumps=20):
+        """在 duration 秒内按 rate 比例对 endpoint 的请求做 cProfile，最多保存 max_dumps 份"""
+        if endpoint not in self.app.view_functions:
+            raise ValueError(f'路由不存在: {endpoint}')
+        target = {'endpoint': endpoint, 'rate': min(max(float(rate), 0.0), 1.0),
+                  'until': time.time() + duration, 'max_dumps': int(max_dumps),
+                  'session': datetime.utcnow().strftime('%Y%m%d_%H%M%S')}
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, _TARGET_FILE)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(target, f)
+        os.replace(tmp_path, path)
+        self._target_checked = 0
+        return target
+
+    def stop(self):
+        try:
+            os.remove(os.path.join(self.directory, _TARGET_FILE))
+        except FileNotFoundError:
+            pass
+        self._target_checked = 0
+
+    def list_dumps(self):
+        if not os.path.isdir(self.directory):
+            return []
+        dumps = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.prof'):
+                stat = entry.stat()
+                dumps.append({'name': entry.name, 'size': stat.st_size,
+                              'created_at': datetime.utcfromtimestamp(stat.st_mtime).isoformat()})
+        return sorted(dumps, key=lambda dump: dump['created_at'], reverse=True)
+
+    def get_status(self):
+        return {'target': self._current_target(), 'dumps': self.list_dumps()}
+
+
+request_profiler = RequestProfiler()
@@ -0,0 +1,198 @@
+"""
+匿名访问的公开文件列表快照
+匿名访客看到的首页对所有人相同：快照记录公开文件的总数和变化标记，各分页在第一次访问时按
+(upload_time, id) 倒序只查询这一页的文件并渲染，渲染好的页面缓存在快照中（最多 PUBLIC_LISTING_CACHED_PAGES 页），
+命中时不查询数据库，响应带 ETag / Last-Modified 和 Cache-Control: public，浏览器和代理可以直接复用。
+快照在以下情况重建（只重新统计总数，分页缓存清空后按需重新渲染）：
+  - 每隔 PUBLIC_LISTING_CHECK_INTERVAL 秒用两条很小的查询检查变化（公开列表的版本号、系统配置），
+    公开文件的上传、删除、分享设置和过期时间变化都会递增该版本号，其他进程中的修改也能发现，
+    用户私有文件的变化不会触发重建；
+  - 到达最早的过期时间，过期文件准时从列表中消失；
+  - 距上次重建超过 PUBLIC_LISTING_MAX_AGE 秒。
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from flask import abort, current_app, render_template, request, session
+from markupsafe import Markup
+from sqlalchemy import func
+from sqlalchemy.orm import selectinload
+
+from models import Config, File, ListingVersion, db
+from services.listing_cache import PUBLIC_LISTING, listing_cache
+
+# 分页导航中当前页前后显示的页码数
+PAGE_WINDOW = 2
+
+
+class _Snapshot:
+    """某一时刻的公开文件列表：总数和变化标记，分页 HTML 按需填充"""
+
+    def __init__(self, total, config, fingerprint, now, built_at, valid_until):
+        self.total = total
+        self.config = config
+        self.fingerprint = fingerprint
+        self.now = now  # 判断是否过期的时间点，同一快照的各页一致
+        self.built_at = built_at
+        self.valid_until = valid_until
+        self.last_modified = now.replace(microsecond=0)
+        self.checked_at = built_at
+        self.pages = OrderedDict()  # 页码 -> (HTML, ETag)
+        self.cursors = {}  # 页码 -> 该页最后一个文件的 (upload_time, id)，下一页从这里继续读取
+        self.lock = threading.Lock()
+
+
+def page_window(page, pages, radius=PAGE_WINDOW):
+    """分页导航显示的页码：首页、末页和当前页附近的页，中间省略的部分为 None"""
+    numbers = sorted({1, pages} | set(range(max(1, page - radius), min(pages, page + radius) + 1)))
+    window = []
+    for number in numbers:
+        if window and number - window[-1] > 1:
+            window.append(None)
+        window.append(number)
+    return window
+
+
+class PublicListing:
+    """匿名首页的快照缓存"""
+
+    def __init__(self, app=None):
+        self.page_size = 60
+        self.check_interval = 5
+        self.max_age = 300
+        self.cached_pages = 20
+        self._snapshot = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PUBLIC_LISTING_PAGE_SIZE', 60)
+        app.config.setdefault('PUBLIC_LISTING_CHECK_INTERVAL', 5)
+        app.config.setdefault('PUBLIC_LISTING_MAX_AGE', 300)
+        app.config.setdefault('PUBLIC_LISTING_CACHED_PAGES', 20)
+        self.page_size = app.config['PUBLIC_LISTING_PAGE_SIZE']
+        self.check_interval = app.config['PUBLIC_LISTING_CHECK_INTERVAL']
+        self.max_age = app.config['PUBLIC_LISTING_MAX_AGE']
+        self.cached_pages = app.config['PUBLIC_LISTING_CACHED_PAGES']
+        app.extensions['public_listing'] = self
+
+    @staticmethod
+    def _fingerprint():
+        """公开文件列表和系统配置的变化标记"""
+        version = db.session.execute(
+            db.select(ListingVersion.version).where(ListingVersion.name == PUBLIC_LISTING)
+        ).scalar() or 0
+        configs = tuple(sorted(db.session.execute(db.select(Config.key, Config.value)).all()))
+        return version, configs
+
+    @staticmethod
+    def _visible(now):
+        return db.and_(File.is_public.is_(True), (File.expiry_time.is_(None)) | (File.expiry_time > now))
+
+    def _build(self, fingerprint, previous):
+        now = datetime.utcnow()
+        total = db.session.query(func.count(File.id)).filter(self._visible(now)).scalar()
+        first_expiry = db.session.query(func.min(File.expiry_time)).filter(
+            File.is_public.is_(True), File.expiry_time > now).scalar()
+
+        built_at = time.time()
+        valid_until = built_at + self.max_age
+        if first_expiry is not None:
+            # 最早过期的文件到期时重建
+            valid_until = min(valid_until, built_at + (first_expiry - now).total_seconds())
+        snapshot = _Snapshot(total, dict(fingerprint[1]), fingerprint, now, built_at, valid_until)
+        if previous is not None and previous.fingerprint == fingerprint and previous.total == total:
+            # 只是到了重建时间，内容很可能没有变化，保留原来的 Last-Modified（ETag 按页面内容计算）
+            snapshot.last_modified = previous.last_modified
+        db.session.rollback()
+        return snapshot
+
+    def snapshot(self):
+        """返回当前有效的快照，过期或发现变化时重建"""
+        snapshot = self._snapshot
+        now = time.time()
+        if snapshot is not None and now < snapshot.valid_until and now - snapshot.checked_at < self.check_interval:
+            return snapshot
+
+        with self._lock:
+            snapshot = self._snapshot
+            now = time.time()
+            if snapshot is not None and now < snapshot.valid_until:
+                if now - snapshot.checked_at < self.check_interval:
+                    return snapshot
+                fingerprint = self._fingerprint()
+                if fingerprint == snapshot.fingerprint:
+                    snapshot.checked_at = now
+                    db.session.rollback()
+                    return snapshot
+            else:
+                fingerprint = self._fingerprint()
+            self._snapshot = self._build(fingerprint, snapshot)
+            return self._snapshot
+
+    def _page_files(self, snapshot, page):
+        """只查询第 page 页的文件；已知上一页的最后一个文件时从它之后继续读取，不用 OFFSET"""
+        query = File.query.filter(self._visible(snapshot.now)).order_by(
+            File.upload_time.desc(), File.id.desc()).options(selectinload(File.media_info))
+        cursor = snapshot.cursors.get(page - 1)
+        if cursor is not None and cursor[0] is not None:
+            upload_time, file_id = cursor
+            query = query.filter((File.upload_time < upload_time) |
+                                 ((File.upload_time == upload_time) & (File.id < file_id)))
+        else:
+            query = query.offset((page - 1) * self.page_size)
+        files = query.limit(self.page_size).all()
+        if files:
+            snapshot.cursors[page] = (files[-1].upload_time, files[-1].id)
+        return files
+
+    def _render(self, snapshot, page, pages):
+        files = self._page_files(snapshot, page)
+        listing = Markup(''.join(listing_cache.render_row_list(files)))
+        db.session.rollback()
+        pagination = {'page': page, 'pages': pages, 'window': page_window(page, pages)} if pages > 1 else None
+        return render_template('index.html', listing=listing, pagination=pagination, config=snapshot.config)
+
+    def response(self):
+        """匿名首页的响应"""
+        snapshot = self.snapshot()
+        pages = max(1, -(-snapshot.total // self.page_size))
+        page = request.args.get('page', 1, type=int)
+        if page < 1 or page > pages:
+            abort(404)
+
+        if '_flashes' in session:
+            # 有待显示的提示消息时页面因人而异，不使用也不写入分页缓存
+            return self._render(snapshot, page, pages)
+
+        with snapshot.lock:
+            cached = snapshot.pages.get(page)
+            if cached is not None:
+                snapshot.pages.move_to_end(page)
+        if cached is None:
+            body = self._render(snapshot, page, pages).encode('utf-8')
+            cached = (body, hashlib.blake2b(body, digest_size=16).hexdigest())
+            with snapshot.lock:
+                snapshot.pages[page] = cached
+                while len(snapshot.pages) > self.cached_pages:
+                    snapshot.pages.popitem(last=False)
+        body, etag = cached
+
+        response = current_app.response_class(body, mimetype='text/html')
+        response.set_etag(etag)
+        response.last_modified = snapshot.last_modified
+        response.cache_control.public = True
+        # 客户端缓存不超过下一次检查变化或最早过期的时间，之后用 ETag 重新验证
+        response.cache_control.max_age = max(0, int(min(snapshot.checked_at + self.check_interval,
+                                                        snapshot.valid_until) - time.time()))
+        # 登录用户访问同一地址看到的是自己的文件
+        response.vary.add('Cookie')
+        return response.make_conditional(request)
+
+
+public_listing = PublicListing()
@@ -0,0 +1,228 @@
+"""
+用户配额
+User 表上维护已用量 (used_bytes/used_files) 和预留量 (reserved_bytes/reserved_files)，检查配额只读写一行。
+创建分块上传任务时用一条带条件的 UPDATE 原子地预留字节数和文件数，并发上传不会超出配额；
+完成时预留转为已用量，失败或过期时释放。状态为 uploading 的 UploadTask 就是预留台账，
+任务离开该状态也用带条件的 UPDATE，保证每笔预留只结算一次。
+usage_synced_at 为空表示该用户的用量尚未统计（旧数据或批量导入后），首次检查时按 File 表重新计算
+"""
+
+import logging
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from models import File, UploadChunk, UploadTask, User, db
+from services.background import BackgroundWorker
+from storage import get_storage
+
+logger = logging.getLogger(__name__)
+
+
+class QuotaExceeded(Exception):
+    """超出用户配额"""
+
+
+# ---- 用量统计 ----
+
+def recalculate_usage(user_ids=None):
+    """按 File 表和进行中的上传任务重新计算用量；一条 UPDATE 完成，与并发的预留不冲突"""
+    _backfill_sizes(user_ids)
+    statement = db.update(User).values(
+        used_bytes=db.select(db.func.coalesce(db.func.sum(File.file_size), 0))
+        .where(File.user_id == User.id).scalar_subquery(),
+        used_files=db.select(db.func.count()).select_from(File)
+        .where(File.user_id == User.id).scalar_subquery(),
+        reserved_bytes=db.select(db.func.coalesce(db.func.sum(UploadTask.file_size), 0))
+        .where(UploadTask.user_id == User.id, UploadTask.status == 'uploading').scalar_subquery(),
+        reserved_files=db.select(db.func.count()).select_from(UploadTask)
+        .where(UploadTask.user_id == User.id, UploadTask.status == 'uploading').scalar_subquery(),
+        usage_synced_at=datetime.utcnow(),
+    )
+    if user_ids is not None:
+        statement = statement.where(User.id.in_(list(user_ids)))
+    db.session.execute(statement)
+    db.session.commit()
+
+
+def _backfill_sizes(user_ids):
+    """旧记录没有 file_size 时从存储读取并写回，之后统计只需 SUM"""
+    query = db.session.query(File.id, File.filepath).filter(File.file_size.is_(None))
+    if user_ids is not None:
+        query = query.filter(File.user_id.in_(list(user_ids)))
+    rows = query.all()
+    if not rows:
+        return
+    storage = get_storage()
+    updates = []
+    for row in rows:
+        try:
+            size = storage.size(storage.key_from_filepath(row.filepath))
+        except Exception:
+            continue
+        updates.append({'id': row.id, 'file_size': size})
+    if updates:
+        db.session.execute(db.update(File), updates)
+        db.session.commit()
+
+
+def ensure_usage(user_id):
+    """用量尚未统计时先统计"""
+    synced = db.session.query(User.usage_synced_at).filter(User.id == user_id).scalar()
+    if synced is None:
+        recalculate_usage([user_id])
+
+
+def invalidate_usage(user_ids=None):
+    """批量写入文件记录后标记用量需要重新统计，不提交事务"""
+    statement = db.update(User).values(usage_synced_at=None)
+    if user_ids is not None:
+        statement = statement.where(User.id.in_(list(user_ids)))
+    db.session.execute(statement)
+
+
+# ---- 预留与结算（均不提交事务，由调用方与业务数据一起提交） ----
+
+def _conditional_add(user_id, column_bytes, column_files, size, files, enforce):
+    statement = db.update(User).where(User.id == user_id).values({
+        column_bytes: getattr(User, column_bytes) + size,
+        column_files: getattr(User, column_files) + files,
+    })
+    if enforce:
+        statement = statement.where(
+            User.used_bytes + User.reserved_bytes + size <= User.max_total_size,
+            User.used_files + User.reserved_files + files <= User.max_total_files,
+        )
+    if db.session.execute(statement).rowcount == 1:
+        return
+    user = db.session.get(User, user_id)
+    if user is None:
+        raise QuotaExceeded('用户不存在')
+    db.session.refresh(user)
+    if user.used_files + user.reserved_files + files > user.max_total_files:
+        raise QuotaExceeded('已达到总文件数量限制')
+    raise QuotaExceeded('上传后将超过总文件大小限制')
+
+
+def reserve(user_id, size, files=1):
+    """为进行中的上传预留配额，超出时抛出 QuotaExceeded"""
+    _conditional_add(user_id, 'reserved_bytes', 'reserved_files', size, files, enforce=True)
+
+
+def charge(user_id, size, files=1, enforce=True):
+    """直接计入已用量（表单上传、导入等不经过预留的写入）"""
+    _conditional_add(user_id, 'used_bytes', 'used_files', size, files, enforce=enforce)
+
+
+def release(user_id, size, files=1):
+    """释放预留"""
+    db.session.execute(db.update(User).where(User.id == user_id).values(
+        reserved_bytes=User.reserved_bytes - size, reserved_files=User.reserved_files - files))
+
+
+def settle(user_id, reserved_size, actual_size, files=1):
+    """把预留转为已用量"""
+    db.session.execute(db.update(User).where(User.id == user_id).values(
+        reserved_bytes=User.reserved_bytes - reserved_size, reserved_files=User.reserved_files - files,
+        used_bytes=User.used_bytes + actual_size, used_files=User.used_files + files))
+
+
+def uncharge(rows):
+    """删除文件后扣减已用量，rows 为带 user_id、file_size 的记录"""
+    totals = defaultdict(lambda: [0, 0])
+    for row in rows:
+        totals[row.user_id][0] += row.file_size or 0
+        totals[row.user_id][1] += 1
+    if totals:
+        table = User.__table__
+        db.session.execute(
+            db.update(table).where(table.c.id == db.bindparam('b_id')).values(
+                used_bytes=table.c.used_bytes - db.bindparam('b_bytes'),
+                used_files=table.c.used_files - db.bindparam('b_files')),
+            [{'b_id': user_id, 'b_bytes': size, 'b_files': count} for user_id, (size, count) in totals.items()]
+        )
+
+
+def finish_task(task, status):
+    """把上传任务从 uploading 改为 status，成功时结算或释放预留并返回 True；
+    任务已被其他请求或过期清理处理时返回 False"""
+    result = db.session.execute(db.update(UploadTask).where(
+        UploadTask.id == task.id, UploadTask.status == 'uploading'
+    ).values(status=status, updated_at=datetime.utcnow()).execution_options(synchronize_session=False))
+    if result.rowcount != 1:
+        return False
+    if status == 'completed':
+        settle(task.user_id, task.file_size, task.file_size)
+    else:
+        release(task.user_id, task.file_size)
+    return True
+
+
+class UploadTaskExpirer(BackgroundWorker):
+    """把长时间没有新分块（或已过 expired_at）的上传任务标记为 expired，释放预留并清理已上传的分块"""
+
+    name = 'upload-task-expirer'
+    enabled_config = ('UPLOAD_TASK_EXPIRER_ENABLED', True)
+    interval_config = ('UPLOAD_TASK_EXPIRER_INTERVAL', 300)  # 秒
+    default_metrics = {
+        'runs_total': 0,
+        'tasks_expired_total': 0,
+        'bytes_released_total': 0,
+        'last_run_at': None,
+    }
+
+    def init_app(self, app):
+        app.config.setdefault('UPLOAD_TASK_TTL_HOURS', 24)
+        super().init_app(app)
+
+    def run_once(self):
+        self.expire()
+
+    def expire(self, now=None, batch_size=500):
+        """处理截至 now 已过期的上传任务，返回过期的任务数"""
+        now = now or datetime.utcnow()
+        cutoff = now - timedelta(hours=self.app.config['UPLOAD_TASK_TTL_HOURS'])
+        expired = released = 0
+        with self.app.app_context():
+            try:
+                storage = get_storage(self.app)
+                last_chunk = db.select(db.func.max(UploadChunk.uploaded_at)).where(
+                    UploadChunk.task_id == UploadTask.id).scalar_subquery()
+                while True:
+                    tasks = UploadTask.query.filter(
+                        UploadTask.status == 'uploading',
+                        db.or_(
+                            UploadTask.expired_at < now,
+                            # tus 上传没有分块记录，每次追加都会更新 updated_at
+                            db.and_(UploadTask.created_at < cutoff,
+                                    db.func.coalesce(last_chunk, UploadTask.updated_at, UploadTask.created_at)
+                                    < cutoff),
+                        )
+                    ).limit(batch_size).all()
+                    if not tasks:
+                        break
+                    done = [task for task in tasks if finish_task(task, 'expired')]
+                    if done:
+                        UploadChunk.query.filter(UploadChunk.task_id.in_([task.id for task in done])).delete(
+                            synchronize_session=False)
+                    db.session.commit()
+                    for task in done:
+                        if task.storage_key and task.storage_upload_id:
+                            try:
+                                if task.upload_offset is not None:
+                                    storage.abort_append(task.storage_key, task.storage_upload_id)
+                                else:
+                                    storage.abort_multipart(task.storage_key, task.storage_upload_id)
+                            except Exception as e:
+                                logger.warning(f"清理过期上传任务 {task.id} 的分块失败: {e}")
+                    expired += len(done)
+                    released += sum(task.file_size for task in done)
+                    if len(tasks) < batch_size:
+                        break
+            finally:
+                db.session.remove()
+        self._incr_metrics(runs_total=1, tasks_expired_total=expired, bytes_released_total=released)
+        self._update_metrics(last_run_at=now.isoformat())
+        return expired
+
+
+upload_task_expirer = UploadTaskExpirer()
@@ -0,0 +1,232 @@
+"""
+合成数据生成
+为压测和规模测试批量生成用户、文件记录和进行中的分块上传任务。
+全部使用 Core 批量 INSERT，每批一个事务；同一种子生成的数据相同。
+可选在本地存储中创建对应大小的稀疏文件（不占实际磁盘空间）
+"""
+
+import bisect
+import math
+import os
+import random
+from datetime import datetime, timedelta
+
+from werkzeug.security import generate_password_hash
+
+from models import File, UploadChunk, UploadTask, User, db
+from services import stats
+from services.quota import invalidate_usage
+from services.listing_cache import bump_listing_version
+
+# (扩展名, 权重, 典型大小)
+EXTENSIONS = [
+    ('.jpg', 25, 2 * 1024 ** 2), ('.png', 10, 500 * 1024), ('.pdf', 15, 1024 ** 2),
+    ('.txt', 10, 8 * 1024), ('.zip', 10, 50 * 1024 ** 2), ('.mp4', 8, 200 * 1024 ** 2),
+    ('.docx', 8, 300 * 1024), ('.mp3', 6, 5 * 1024 ** 2), ('.py', 4, 6 * 1024), ('.json', 4, 20 * 1024),
+]
+SHARE_TYPES = [('public', 50), ('link_only', 40), ('specified_users', 10)]
+USERNAME_PREFIX = 'seed_user_'
+SEED_PASSWORD = 'seed-password'
+# 一次插入的文件记录超过该数量时，先删除 File 表的二级索引，插入完成后重建
+DEFER_INDEXES_THRESHOLD = 100000
+
+
+class FileRowGenerator:
+    """生成 File 表的行，文件名扩展名、大小、分享方式和过期时间按上面的分布随机"""
+
+    def __init__(self, rng, storage, now=None, expiring_ratio=0.2, expired_ratio=0.05):
+        self.rng = rng
+        self.storage = storage
+        self.now = now or datetime.utcnow()
+        self.expiring_ratio = expiring_ratio
+        self.expired_ratio = expired_ratio
+        self.extensions = [ext for ext, _, _ in EXTENSIONS]
+        self.ext_cum_weights = _cumulative([weight for _, weight, _ in EXTENSIONS])
+        self.typical_sizes = [size for _, _, size in EXTENSIONS]
+        self.share_types = [share_type for share_type, _ in SHARE_TYPES]
+        self.share_cum_weights = _cumulative([weight for _, weight in SHARE_TYPES])
+
+    def rows(self, user_ids, start, count):
+        # 每行都要执行，避免 random.choices、uuid.UUID 等较慢的调用
+        rng = self.rng
+        random_, getrandbits, lognormvariate = rng.random, rng.getrandbits, rng.lognormvariate
+        storage, now = self.storage, self.now
+        ext_total, share_total = self.ext_cum_weights[-1], self.share_cum_weights[-1]
+        user_count = len(user_ids)
+        expired_ratio, expiring_cutoff = self.expired_ratio, self.expired_ratio + self.expiring_ratio
+
+        for i in range(start, start + count):
+            ext_index = bisect.bisect(self.ext_cum_weights, random_() * ext_total)
+            ext = self.extensions[ext_index]
+            share_type = self.share_types[bisect.bisect(self.share_cum_weights, random_() * share_total)]
+            name = f'seed_{i:08d}{ext}'
+            stored_name = f'{_uuid_string(getrandbits)}_{name}'
+            # 少数用户拥有大部分文件
+            user_id = user_ids[int(user_count * random_() ** 3)]
+
+            expiry_time = None
+            roll = random_()
+            if roll < expired_ratio:
+                expiry_time = now - timedelta(seconds=int(random_() * 30 * 86400) + 1)
+            elif roll < expiring_cutoff:
+                expiry_time = now + timedelta(seconds=int(random_() * 365 * 86400) + 1)
+
+            yield {
+                'id': _uuid_string(getrandbits),
+                'filename': stored_name,
+                'original_filename': name,
+                'raw_filename': name,
+                'filepath': storage.filepath_for(storage.shard_key(stored_name)),
+                'upload_time': now - timedelta(seconds=int(random_() * 365 * 86400)),
+                'user_id': user_id,
+                'is_public': share_type == 'public',
+                'share_type': share_type,
+                # 大小按典型值做对数正态分布
+                'file_size': max(1, int(lognormvariate(0, 1) * self.typical_sizes[ext_index])),
+                'expiry_time': expiry_time,
+                'download_count': 0,
+                'view_count': 0,
+                'bytes_served': 0,
+            }
+
+
+def _uuid_string(getrandbits):
+    """由随机数生成 UUID 格式的字符串"""
+    h = '%032x' % getrandbits(128)
+    return f'{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}'
+
+
+def _cumulative(weights):
+    total, result = 0, []
+    for weight in weights:
+        total += weight
+        result.append(total)
+    return result
+
+
+def _insert(table, rows, update_stats=True):
+    db.session.execute(table.insert(), rows)
+    if table is File.__table__ or table is UploadTask.__table__:
+        # 用量在下次检查配额时按 File 表重新统计
+        invalidate_usage({row['user_id'] for row in rows})
+        bump_listing_version({row['user_id'] for row in rows},
+                             public=any(row.get('share_type') == 'public' for row in rows))
+    if table is File.__table__ and update_stats:
+        stats.add_files(rows)
+    db.session.commit()
+
+
+def seed_users(count, batch_size=10000):
+    """创建 count 个普通用户（密码统一为 SEED_PASSWORD），返回所有合成用户的ID"""
+    start = User.query.filter(User.username.like(USERNAME_PREFIX + '%')).count()
+    # 哈希计算很慢，所有合成用户共用一个密码哈希
+    password_hash = generate_password_hash(SEED_PASSWORD)
+    now = datetime.utcnow()
+    table = User.__table__
+    for offset in range(0, count, batch_size):
+        _insert(table, [
+            {'username': f'{USERNAME_PREFIX}{start + i:07d}', 'password_hash': password_hash, 'role': 'user',
+             'max_file_size': 1024 ** 3, 'max_total_files': 1 << 30, 'max_total_size': 1 << 50,
+             'language': 'zh', 'theme': 'light', 'created_at': now}
+            for i in range(offset, min(offset + batch_size, count))
+        ])
+    return [user_id for (user_id,) in
+            db.session.query(User.id).filter(User.username.like(USERNAME_PREFIX + '%')).order_by(User.id)]
+
+
+def seed_files(generator, user_ids, count, start=0, batch_size=50000, sparse=False, on_batch=None,
+               update_stats=True):
+    """批量插入 count 条文件记录，sparse=True 时同时创建稀疏文件；update_stats=False 时不增量更新统计汇总"""
+    table = File.__table__
+    # 大批量插入时先删除二级索引、插入完再重建，比逐行维护随机顺序的索引快得多
+    deferred = list(table.indexes) if count >= DEFER_INDEXES_THRESHOLD else []
+    for index in deferred:
+        index.drop(bind=db.engine, checkfirst=True)
+    inserted = 0
+    try:
+        while inserted < count:
+            rows = list(generator.rows(user_ids, start + inserted, min(batch_size, count - inserted)))
+            _insert(table, rows, update_stats)
+            if sparse:
+                _create_sparse_files(generator.storage, rows)
+            inserted += len(rows)
+            if on_batch:
+                on_batch(inserted)
+    finally:
+        db.session.rollback()
+        for index in deferred:
+            index.create(bind=db.engine, checkfirst=True)
+    return inserted
+
+
+def _create_sparse_files(storage, rows):
+    for row in rows:
+        path = storage.local_path(storage.key_from_filepath(row['filepath']))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.truncate(row['file_size'])
+
+
+def seed_upload_tasks(rng, storage, user_ids, count, batch_size=10000):
+    """创建 count 个分块上传任务，大部分进行中并已上传部分分块，返回插入的分块记录数"""
+    now = datetime.utcnow()
+    chunk_size = 5 * 1024 * 1024
+    chunks_total = 0
+    for offset in range(0, count, batch_size):
+        tasks, chunks = [], []
+        for i in range(offset, min(offset + batch_size, count)):
+            task_id = _uuid_string(rng.getrandbits)
+            file_size = max(1, int(rng.lognormvariate(0, 1.5) * 100 * 1024 ** 2))
+            chunks_count = math.ceil(file_size / chunk_size)
+            status = rng.choices(('uploading', 'failed', 'completed'), (80, 10, 10))[0]
+            created_at = now - timedelta(seconds=rng.randrange(7 * 86400))
+            file_name = f'seed_upload_{i:07d}.bin'
+            tasks.append({
+                'id': task_id, 'user_id': user_ids[rng.randrange(len(user_ids))],
+                'file_hash': '%064x' % rng.getrandbits(256), 'file_name': file_name, 'file_size': file_size,
+                'content_type': 'application/octet-stream', 'chunk_size': chunk_size,
+                'chunks_count': chunks_count, 'status': status,
+                'storage_key': storage.shard_key(f'{task_id}_{file_name}'), 'storage_upload_id': task_id,
+                'share_options': '{}', 'created_at': created_at, 'updated_at': created_at,
+            })
+            uploaded = chunks_count if status == 'completed' else rng.randrange(chunks_count + 1)
+            for index in range(uploaded):
+                size = chunk_size if index < chunks_count - 1 else file_size - chunk_size * (chunks_count - 1)
+                chunks.append({'task_id': task_id, 'chunk_index': index, 'chunk_size': size,
+                               'uploaded_at': created_at})
+        _insert(UploadTask.__table__, tasks)
+        for chunk_offset in range(0, len(chunks), batch_size * 10):
+            _insert(UploadChunk.__table__, chunks[chunk_offset:chunk_offset + batch_size * 10])
+        chunks_total += len(chunks)
+    return chunks_total
+
+
+def seed_database(storage, users=100, files=100000, upload_tasks=100, sparse=False, seed=0,
+                  batch_size=50000, on_progress=None):
+    """生成一整套合成数据，返回各表插入的行数"""
+    if sparse and storage.local_path('probe') is None:
+        raise ValueError('只有本地存储支持创建稀疏文件')
+    user_ids = seed_users(users) if users else []
+    if not user_ids:
+        user_ids = [user_id for (user_id,) in db.session.query(User.id)]
+    if not user_ids:
+        raise ValueError('没有可用的用户，请先创建用户或指定 users > 0')
+    if on_progress:
+        on_progress('users', len(user_ids))
+
+    start = File.query.filter(File.original_filename.like('seed_%')).count()
+    # 已有合成数据时换一个随机序列，避免再次运行时生成重复的ID
+    rng = random.Random(f'{seed}-{start}')
+    generator = FileRowGenerator(rng, storage)
+    # 汇总已建立（或库中还没有文件）时增量更新即可保持正确，否则插入完后整体重建一次
+    stats_built = stats.is_built()
+    seeded_files = seed_files(generator, user_ids, files, start=start, batch_size=batch_size, sparse=sparse,
+                              on_batch=(lambda n: on_progress('files', n)) if on_progress else None,
+                              update_stats=stats_built)
+    if not stats_built:
+        stats.rebuild()
+    chunks = seed_upload_tasks(rng, storage, user_ids, upload_tasks) if upload_tasks else 0
+    if on_progress:
+        on_progress('upload_tasks', upload_tasks)
+
+    return {'users': users, 'files': seeded_files, 'upload_tasks': upload_tasks, 'upload_chunks': chunks}
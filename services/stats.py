@@ -0,0 +1,231 @@
+"""
+统计汇总
+系统统计页面和 manage.py show_stats 不再扫描 File 表：文件数和字节数按维度（总计、扩展名、分享类型）
+累计在 StatsCounter 中，现存文件按上传日累计在 StatsDaily 中，访问计数写回时同时累加到 access 维度，
+冷数据压缩节省的字节数累计在 compression 维度（存储实际占用 = 总字节数 - 节省的字节数）；
+每个用户的文件数和字节数就是配额用量 (User.used_files/used_bytes)。
+写入文件记录的地方在同一事务中调用 add_files / remove_files / replace_file，均不提交事务。
+已有文件的库第一次使用汇总前需要执行 manage.py rebuild_stats（数据量大时耗时较长，不在请求中执行），
+之前统计页面显示汇总尚未建立；数据不一致时同样可以重新执行
+"""
+
+import logging
+import os
+from collections import Counter, namedtuple
+from collections.abc import Mapping
+from datetime import datetime, timedelta
+
+from sqlalchemy.dialects import postgresql, sqlite
+
+from models import File, StatsCounter, StatsDaily, User, db
+
+logger = logging.getLogger(__name__)
+
+FileEntry = namedtuple('FileEntry', 'original_filename share_type file_size upload_time compressed_size')
+
+SHARE_TYPES = ('public', 'link_only', 'specified_users')
+
+
+def entry(file):
+    """文件当前计入统计的字段，修改文件前保存，之后传给 replace_file"""
+    if isinstance(file, Mapping):
+        return FileEntry(file.get('original_filename'), file.get('share_type'),
+                         file.get('file_size') or 0, file.get('upload_time'), file.get('compressed_size'))
+    return FileEntry(getattr(file, 'original_filename', None), getattr(file, 'share_type', None),
+                     getattr(file, 'file_size', None) or 0, getattr(file, 'upload_time', None),
+                     getattr(file, 'compressed_size', None))
+
+
+def extension(filename):
+    return os.path.splitext((filename or '').lower())[1]
+
+
+def _tally(entries, sign):
+    counters = Counter()
+    for item in map(entry, entries):
+        for key in (('total', ''), ('ext', extension(item.original_filename)), ('share', item.share_type or '')):
+            counters[key + ('count',)] += sign
+            counters[key + ('bytes',)] += sign * item.file_size
+        if item.compressed_size is not None:
+            counters[('compression', '', 'count')] += sign
+            counters[('compression', '', 'bytes')] += sign * (item.file_size - item.compressed_size)
+    return counters
+
+
+def upsert_add(model, key_columns, rows):
+    """把 rows 中的数值累加到汇总表，行不存在时插入"""
+    if not rows:
+        return
+    table = model.__table__
+    value_columns = [name for name in rows[0] if name not in key_columns]
+    dialect = db.session.get_bind().dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        insert = (sqlite if dialect == 'sqlite' else postgresql).insert(table)
+        statement = insert.on_conflict_do_update(
+            index_elements=key_columns,
+            set_={name: table.c[name] + insert.excluded[name] for name in value_columns})
+        db.session.execute(statement, rows)
+        return
+    for row in rows:
+        condition = db.and_(*(table.c[name] == row[name] for name in key_columns))
+        result = db.session.execute(db.update(table).where(condition).values(
+            {name: table.c[name] + row[name] for name in value_columns}))
+        if result.rowcount == 0:
+            db.session.execute(db.insert(table).values(row))
+
+
+def _rows(counters):
+    merged = {}
+    for (dimension, key, column), value in counters.items():
+        merged.setdefault((dimension, key), {'dimension': dimension, 'key': key, 'count': 0, 'bytes': 0})
+        merged[(dimension, key)][column] += value
+    return [row for row in merged.values() if row['count'] or row['bytes']]
+
+
+def _apply(counters):
+    upsert_add(StatsCounter, ['dimension', 'key'], _rows(counters))
+
+
+def _daily(entries, sign):
+    daily = {}
+    now = datetime.utcnow()
+    for item in entries:
+        day = (item.upload_time or now).date()
+        row = daily.setdefault(day, {'day': day, 'uploads': 0, 'upload_bytes': 0})
+        row['uploads'] += sign
+        row['upload_bytes'] += sign * item.file_size
+    upsert_add(StatsDaily, ['day'], [row for row in daily.values() if row['uploads'] or row['upload_bytes']])
+
+
+def add_files(files):
+    """新增文件记录（对象或字典），同时计入上传日的上传量"""
+    files = [entry(file) for file in files]
+    _apply(_tally(files, 1))
+    _daily(files, 1)
+
+
+def remove_files(files):
+    """删除文件记录，同时从上传日的上传量中扣除，与重建结果一致"""
+    files = [entry(file) for file in files]
+    _apply(_tally(files, -1))
+    _daily(files, -1)
+
+
+def replace_file(before, after):
+    """文件名、分享类型、大小或压缩后大小变化"""
+    before, after = entry(before), entry(after)
+    if before[:3] != after[:3] or before.compressed_size != after.compressed_size:
+        counters = _tally([before], -1)
+        counters.update(_tally([after], 1))
+        _apply(counters)
+        if before.file_size != after.file_size:
+            _daily([before], -1)
+            _daily([after], 1)
+
+
+def _access(downloads, views, bytes_served):
+    return Counter({('access', 'downloads', 'count'): downloads, ('access', 'views', 'count'): views,
+                    ('access', 'served', 'bytes'): bytes_served})
+
+
+def record_access(downloads, views, bytes_served):
+    """累加访问计数，与写回 File 表的计数在同一事务中"""
+    _apply(_access(downloads, views, bytes_served))
+
+
+def rebuild():
+    """按 File 表重新计算全部汇总（同时重新统计用户用量），返回文件数"""
+    from services.quota import recalculate_usage  # quota 统计前补齐缺少的 file_size
+    recalculate_usage()
+
+    counters = Counter()
+    daily = {}
+    total = 0
+    query = db.session.query(File.original_filename, File.share_type, File.file_size, File.upload_time,
+                             File.compressed_size)
+    for row in query.yield_per(10000):
+        counters.update(_tally([row], 1))
+        if row.upload_time is not None:
+            day = row.upload_time.date()
+            item = daily.setdefault(day, {'day': day, 'uploads': 0, 'upload_bytes': 0})
+            item['uploads'] += 1
+            item['upload_bytes'] += row.file_size or 0
+        total += 1
+    access = db.session.query(
+        db.func.coalesce(db.func.sum(File.download_count), 0),
+        db.func.coalesce(db.func.sum(File.view_count), 0),
+        db.func.coalesce(db.func.sum(File.bytes_served), 0)
+    ).one()
+
+    counters.update(_access(*access))
+    # 写入文件时的增量在汇总建立前就开始累计，重建时全部替换；meta 行表示汇总已建立
+    db.session.execute(db.delete(StatsCounter))
+    db.session.execute(db.delete(StatsDaily))
+    db.session.execute(db.insert(StatsCounter), _rows(counters) + [
+        {'dimension': 'meta', 'key': 'built', 'count': total, 'bytes': 0}])
+    if daily:
+        db.session.execute(db.insert(StatsDaily), list(daily.values()))
+    db.session.commit()
+    logger.info(f"统计汇总已重建，共 {total} 个文件")
+    return total
+
+
+def is_built():
+    """汇总是否已建立；还没有任何文件时直接建立（重建不需要扫描）"""
+    if db.session.query(StatsCounter.count).filter_by(dimension='meta', key='built').first() is not None:
+        return True
+    if db.session.query(File.id).first() is None:
+        rebuild()
+        return True
+    return False
+
+
+def summary(days=30):
+    """统计页面所需的汇总数据，只读取汇总表和用户表；built 为 False 时汇总尚未建立，各项数值不可信"""
+    built = is_built()
+    counters = {}
+    for row in db.session.query(StatsCounter):
+        counters.setdefault(row.dimension, {})[row.key] = (row.count, row.bytes)
+
+    total_files, total_bytes = counters.get('total', {}).get('', (0, 0))
+    file_types = sorted(((ext, count) for ext, (count, _) in counters.get('ext', {}).items() if ext and count),
+                        key=lambda item: (-item[1], item[0]))
+    shares = counters.get('share', {})
+    access = counters.get('access', {})
+
+    today = datetime.utcnow().date()
+    series = {row.day: row for row in StatsDaily.query.filter(StatsDaily.day > today - timedelta(days=days))}
+    daily_uploads = []
+    for offset in range(days - 1, -1, -1):
+        day = today - timedelta(days=offset)
+        row = series.get(day)
+        daily_uploads.append({'day': day, 'uploads': row.uploads if row else 0,
+                              'bytes': row.upload_bytes if row else 0})
+
+    return {
+        'built': built,
+        'total_files': total_files,
+        'total_bytes': total_bytes,
+        'file_types': dict(file_types),
+        'share_types': {share: shares.get(share, (0, 0))[0] for share in SHARE_TYPES},
+        'recent_files': sum(item['uploads'] for item in daily_uploads[-7:]),
+        'daily_uploads': daily_uploads,
+        'access_totals': {'downloads': access.get('downloads', (0, 0))[0],
+                          'views': access.get('views', (0, 0))[0],
+                          'bytes': access.get('served', (0, 0))[1]},
+    }
+
+
+def storage_totals():
+    """(文件数, 原始字节数, 存储实际占用字节数)，汇总尚未建立时返回 None"""
+    if not is_built():
+        return None
+    counters = {row.dimension: (row.count, row.bytes) for row in db.session.query(StatsCounter).filter(
+        StatsCounter.dimension.in_(('total', 'compression')), StatsCounter.key == '')}
+    files, logical_bytes = counters.get('total', (0, 0))
+    return files, logical_bytes, logical_bytes - counters.get('compression', (0, 0))[1]
+
+
+def top_users(limit=10):
+    """占用存储最多的用户（配额用量）"""
+    return User.query.filter(User.used_files > 0).order_by(User.used_bytes.desc()).limit(limit).all()
@@ -0,0 +1,289 @@
+"""
+大文本文件分页预览
+按行号读取任意大小文本文件的一段，不从头读取：稀疏行索引每隔 LINE_INDEX_STRIDE 行记录该行起始的字节偏移，
+读取时从不超过起始行的最近一个检查点处开始，只多读不到一个间隔的内容。
+索引按需建立：读到哪里就延伸到哪里，第一页只读第一页的字节；读到文件末尾后记录总行数。
+编码在建立索引时根据文件开头检测一次，与索引一起保存。
+索引保存在 instance/line_index，按 File.content_key 命名，内容变化（新版本）后自然使用新的索引。
+查看末尾（tail）时从文件末尾向前读取，同样只读所需的字节。冷数据压缩的文件无法随机访问，需要从头解压
+"""
+
+import codecs
+import json
+import logging
+import os
+import struct
+import tempfile
+from array import array
+from collections import deque
+
+from services.background import StripedLock
+from services.compression import iter_file_range
+
+logger = logging.getLogger(__name__)
+
+SNIFF_BYTES = 64 * 1024
+TAIL_BLOCK = 64 * 1024
+MAX_PAGE_LINES = 1000
+# 单行最多返回的字节数，超长的行（如压缩过的 JSON）截断显示
+MAX_LINE_BYTES = 16 * 1024
+# 按顺序尝试的编码，都无法解码时按 latin-1 显示
+CANDIDATE_ENCODINGS = ('utf-8', 'gb18030')
+FORMAT_VERSION = 1
+
+
+class NotTextError(Exception):
+    """文件不是可按行预览的文本"""
+
+
+def detect_encoding(sample):
+    """根据文件开头的字节检测编码，二进制或 UTF-16/32 文件抛出 NotTextError"""
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if sample.startswith((codecs.BOM_UTF32_LE, codecs.BOM_UTF32_BE, codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        raise NotTextError('不支持 UTF-16/UTF-32 编码的文件')
+    if b'\x00' in sample:
+        raise NotTextError('文件不是文本文件')
+    for encoding in CANDIDATE_ENCODINGS:
+        try:
+            sample.decode(encoding)
+            return encoding
+        except UnicodeDecodeError as e:
+            # 样本末尾可能截断了一个多字节字符
+            if e.start >= len(sample) - 4 and e.reason in ('unexpected end of data', 'incomplete multibyte sequence'):
+                return encoding
+    return 'latin-1'
+
+
+class LineIndex:
+    """一个文件内容的稀疏行索引：offsets[i] 是第 i * stride + 1 行起始的字节偏移"""
+
+    def __init__(self, encoding, stride, size, offsets=None, total_lines=None):
+        self.encoding = encoding
+        self.stride = stride
+        self.size = size
+        self.offsets = offsets if offsets is not None else array('Q', [0])
+        self.total_lines = total_lines  # 读到文件末尾后才知道
+
+    @property
+    def complete(self):
+        return self.total_lines is not None
+
+    def checkpoint(self, line):
+        """不超过 line 的最近检查点，返回 (行号, 字节偏移)"""
+        index = min((line - 1) // self.stride, len(self.offsets) - 1)
+        return index * self.stride + 1, self.offsets[index]
+
+    def dump(self):
+        header = json.dumps({'version': FORMAT_VERSION, 'encoding': self.encoding, 'stride': self.stride,
+                             'size': self.size, 'total_lines': self.total_lines}).encode('utf-8')
+        return struct.pack('<I', len(header)) + header + self.offsets.tobytes()
+
+    @classmethod
+    def load(cls, data):
+        (length,) = struct.unpack_from('<I', data)
+        header = json.loads(data[4:4 + length])
+        if header.get('version') != FORMAT_VERSION:
+            raise ValueError('索引格式版本不符')
+        offsets = array('Q')
+        offsets.frombytes(data[4 + length:])
+        return cls(header['encoding'], header['stride'], header['size'], offsets, header['total_lines'])
+
+
+class TextPreview:
+    """按行分页读取文本文件，行索引保存在实例目录中"""
+
+    def __init__(self, app=None):
+        self.directory = None
+        self.stride = 256
+        self._lock = StripedLock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('LINE_INDEX_STRIDE', 256)
+        self.directory = os.path.join(app.instance_path, 'line_index')
+        self.stride = app.config['LINE_INDEX_STRIDE']
+        app.extensions['text_preview'] = self
+
+    def _path(self, file):
+        key = file.content_key
+        return os.path.join(self.directory, key[:2], f'{key}.idx')
+
+    def _load(self, file, path):
+        try:
+            with open(path, 'rb') as f:
+                index = LineIndex.load(f.read())
+            if index.stride == self.stride and index.size == file.file_size:
+                return index
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError, struct.error) as e:
+            logger.warning(f"行索引 {path} 无效，重新建立: {e}")
+
+        sample = b''
+        for data in iter_file_range(file, 0, SNIFF_BYTES):
+            sample += data
+        return LineIndex(detect_encoding(sample), self.stride, file.file_size)
+
+    def _save(self, path, index):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(index.dump())
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def _decode(self, index, raw_lines):
+        lines = []
+        for raw, truncated in raw_lines:
+            text = raw.rstrip(b'\r').decode(index.encoding, errors='replace')
+            lines.append({'text': text, 'truncated': truncated})
+        return lines
+
+    def read_lines(self, file, start, count):
+        """读取从第 start 行（从 1 开始）起的 count 行，沿途延伸索引"""
+        count = max(1, min(count, MAX_PAGE_LINES))
+        start = max(1, start)
+        path = self._path(file)
+        with self._lock(path):
+            index = self._load(file, path)
+            known = len(index.offsets)
+            raw_lines, has_more = self._scan(file, index, start, count)
+            if len(index.offsets) != known or (index.complete and not os.path.exists(path)):
+                self._save(path, index)
+        return {
+            'encoding': index.encoding,
+            'start': start,
+            'lines': self._decode(index, raw_lines),
+            'has_more': has_more,
+            'total_lines': index.total_lines,
+        }
+
+    def _scan(self, file, index, start, count):
+        """从最近的检查点向后读，记录经过的检查点，收集 [start, start + count) 行"""
+        if index.complete and start > index.total_lines:
+            return [], False
+        line, offset = index.checkpoint(start)  # line 为正在读取的行
+        end_line = start + count
+        stride = index.stride
+        next_checkpoint = len(index.offsets) * stride + 1  # 下一个待记录检查点的行号
+        raw_lines = []
+        current = bytearray()
+        truncated = False
+        partial = False  # 当前行已有内容但还没读到换行符
+
+        position = offset
+        for data in iter_file_range(file, offset, None):
+            begin = 0
+            size = len(data)
+            newlines = data.count(b'\n')  # 本块中 begin 之后的换行符数
+            while begin < size:
+                if line < start:
+                    # 起始行之前只需要找到下一个检查点或起始行所在的换行符
+                    need = min(start, next_checkpoint) - line
+                    if newlines < need:
+                        line += newlines
+                        partial = data[-1:] != b'\n' if newlines else True
+                        break
+                    newline = begin - 1
+                    for _ in range(need):
+                        newline = data.find(b'\n', newline + 1)
+                    newlines -= need
+                    line += need
+                    begin = newline + 1
+                    partial = False
+                else:
+                    newline = data.find(b'\n', begin)
+                    end = size if newline < 0 else newline
+                    if not truncated:
+                        room = MAX_LINE_BYTES - len(current)
+                        current += data[begin:begin + min(end - begin, room)]
+                        truncated = end - begin > room
+                    if newline < 0:
+                        partial = True
+                        break
+                    raw_lines.append((bytes(current), truncated))
+                    current.clear()
+                    truncated = partial = False
+                    newlines -= 1
+                    line += 1
+                    begin = newline + 1
+                if line == next_checkpoint:
+                    index.offsets.append(position + begin)
+                    next_checkpoint += stride
+                if line >= end_line:
+                    return raw_lines, position + begin < index.size
+            position += size
+
+        # 到达文件末尾，最后一行没有换行符时也算一行
+        if partial:
+            if line >= start:
+                raw_lines.append((bytes(current), truncated))
+            index.total_lines = line
+        else:
+            index.total_lines = line - 1
+        return raw_lines, False
+
+    def tail(self, file, count):
+        """文件最后 count 行，从末尾向前读取；索引已读到末尾时同时给出行号"""
+        count = max(1, min(count, MAX_PAGE_LINES))
+        path = self._path(file)
+        with self._lock(path):
+            index = self._load(file, path)
+            if not os.path.exists(path):
+                self._save(path, index)
+        partial = False
+        if file.is_compressed:
+            pieces = self._tail_stream(file, count)
+        else:
+            # 超长的行只显示前 MAX_LINE_BYTES 字节，读取量同样有上限
+            blocks = []
+            newlines = read = 0
+            limit = (count + 1) * (MAX_LINE_BYTES + 1)
+            position = index.size or 0
+            while position > 0 and newlines <= count and read < limit:
+                block_start = max(0, position - TAIL_BLOCK)
+                block = b''.join(iter_file_range(file, block_start, position))
+                blocks.append(block)
+                newlines += block.count(b'\n')
+                read += len(block)
+                position = block_start
+            buffer = b''.join(reversed(blocks))
+            # 忽略文件末尾的换行符
+            if buffer.endswith(b'\n'):
+                buffer = buffer[:-1]
+            pieces = buffer.split(b'\n') if buffer or position > 0 else []
+            # 第一段可能不是完整的行：行数足够时丢弃，否则只显示读到的末尾部分
+            partial = position > 0 and len(pieces) <= count
+            pieces = pieces[-count:]
+        raw_lines = [(piece[:MAX_LINE_BYTES], len(piece) > MAX_LINE_BYTES) for piece in pieces]
+        if partial:
+            raw_lines[0] = (pieces[0][-MAX_LINE_BYTES:], True)
+        start = index.total_lines - len(raw_lines) + 1 if index.complete else None
+        return {
+            'encoding': index.encoding,
+            'start': start,
+            'lines': self._decode(index, raw_lines),
+            'has_more': False,
+            'total_lines': index.total_lines,
+        }
+
+    @staticmethod
+    def _tail_stream(file, count):
+        """压缩存储的文件无法从末尾读取，顺序解压并只保留最后 count 行"""
+        lines = deque(maxlen=count)
+        rest = b''
+        for data in iter_file_range(file, 0, None):
+            pieces = (rest + data).split(b'\n')
+            rest = pieces.pop()[:MAX_LINE_BYTES + 1]
+            lines.extend(piece[:MAX_LINE_BYTES + 1] for piece in pieces)
+        if rest:
+            lines.append(rest)
+        return list(lines)
+
+
+text_preview = TextPreview()
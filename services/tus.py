@@ -0,0 +1,98 @@
+"""
+tus 1.0 可续传上传协议（https://tus.io/protocols/resumable-upload）
+支持 creation、expiration、checksum、termination 扩展，上传任务仍是 UploadTask，配额预留与分块上传相同。
+每次 PATCH 把请求体从 Upload-Offset 处流式追加到存储的暂存文件，不缓存在内存中，也不写分块记录；
+暂存文件的大小就是已接收的偏移，写入期间持有文件锁，同一上传的并发 PATCH 会被拒绝
+"""
+
+import base64
+import binascii
+import hashlib
+import hmac
+import os
+
+from werkzeug.exceptions import ClientDisconnected
+
+from services.hashing import hasher
+from storage import UploadLocked
+
+TUS_VERSION = '1.0.0'
+TUS_EXTENSIONS = ('creation', 'expiration', 'checksum', 'termination')
+CHECKSUM_ALGORITHMS = ('md5', 'sha1', 'sha256')
+BUFFER_SIZE = 1024 * 1024
+# Upload-Checksum 校验失败时的状态码（tus checksum 扩展定义）
+CHECKSUM_MISMATCH = 460
+
+
+class TusError(Exception):
+    """按 tus 协议返回给客户端的错误"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def parse_metadata(header):
+    """解析 Upload-Metadata：逗号分隔的 "键 base64值"，值可以省略"""
+    metadata = {}
+    for pair in filter(None, (item.strip() for item in (header or '').split(','))):
+        key, _, value = pair.partition(' ')
+        try:
+            metadata[key] = base64.b64decode(value, validate=True).decode('utf-8') if value else ''
+        except (binascii.Error, UnicodeDecodeError):
+            raise TusError(400, f'Upload-Metadata 中 {key} 的值无效')
+    return metadata
+
+
+def parse_checksum(header):
+    """解析 Upload-Checksum："算法 base64摘要"，返回 (算法, 摘要字节)"""
+    algorithm, _, value = header.strip().partition(' ')
+    if algorithm not in CHECKSUM_ALGORITHMS:
+        raise TusError(400, f'不支持的校验算法: {algorithm}')
+    try:
+        return algorithm, base64.b64decode(value, validate=True)
+    except binascii.Error:
+        raise TusError(400, 'Upload-Checksum 格式无效')
+
+
+def append(storage, task, offset, stream, length=None, checksum=None):
+    """把 stream 写到任务暂存文件的 offset 处，返回 (新偏移, 上传完成时的 SHA-256 或 None)。
+    客户端中途断开时保留已收到的部分；带校验和时整段校验失败或不完整都会丢弃"""
+    remaining = task.file_size - offset
+    if length is not None and length > remaining:
+        raise TusError(413, '上传内容超过 Upload-Length')
+    try:
+        f = storage.open_append(task.storage_key, task.storage_upload_id)
+    except UploadLocked as e:
+        raise TusError(423, str(e))
+    except FileNotFoundError:
+        raise TusError(404, '上传已终止')
+
+    with f:
+        size = f.seek(0, os.SEEK_END)
+        if size != offset:
+            raise TusError(409, f'Upload-Offset 不匹配，当前偏移为 {size}')
+        digest = hashlib.new(checksum[0]) if checksum else None
+        limit = remaining if length is None else length
+        written = 0
+        try:
+            while written < limit:
+                data = stream.read(min(BUFFER_SIZE, limit - written))
+                if not data:
+                    break
+                f.write(data)
+                if digest is not None:
+                    digest.update(data)
+                written += len(data)
+        except ClientDisconnected:
+            pass
+        if digest is not None and (written != limit or not hmac.compare_digest(digest.digest(), checksum[1])):
+            f.truncate(offset)
+            raise TusError(CHECKSUM_MISMATCH, '数据校验失败')
+        f.flush()
+        new_offset = offset + written
+        file_hash = None
+        if new_offset == task.file_size:
+            # 暂存文件在本机磁盘上；本地存储完成时改名，inode 不变，哈希缓存对最终文件同样有效
+            file_hash = hasher.hash_file(f.name)['sha256']
+    return new_offset, file_hash
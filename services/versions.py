@@ -0,0 +1,406 @@
+"""
+文件版本
+版本内容按内容定义分块（FastCDC 式 gear 滚动哈希）切成数据块，块按 SHA-256 保存在存储的
+.versions/<文件ID>/ 下，同一文件的各版本共享相同的块。客户端用相同参数切块后先查询服务器缺少哪些块，
+只上传缺少的块，再提交块列表创建新版本，每次修改的上传量和新增占用都与改动大小成正比。
+当前版本仍完整保存在 File.filepath，下载、预览、冷数据压缩等逻辑不变；历史版本下载时按块顺序流式拼接。
+因此有版本的文件当前内容存了两份（完整文件和块），再加上各版本的差异：这样所有读取路径仍能直接定位读取，
+完整文件变冷后还会被压缩；块只在第一次创建版本时才生成，从不修改的文件没有额外占用。
+FILE_VERSIONS_MAX_SIZE 限制可以创建版本的文件大小，控制这部分额外空间
+"""
+
+import hashlib
+import io
+import mimetypes
+import re
+from collections import namedtuple
+from contextlib import closing
+from datetime import datetime, timedelta
+
+from flask import Response, current_app, request
+from sqlalchemy.exc import IntegrityError
+
+from models import FileBlock, FileVersion, FileVersionBlock, User, db
+from services import metadata, quota, stats
+from services.compression import open_file
+from services.deletion import enqueue_unlink
+from services.listing_cache import bump_listing_version
+from storage.base import CHUNK_SIZE, content_disposition
+
+# 分块参数：块大小在 [CHUNK_MIN, CHUNK_MAX] 之间，平均约 CHUNK_AVG
+CHUNK_MIN = 16 * 1024
+CHUNK_AVG = 64 * 1024
+CHUNK_MAX = 256 * 1024
+# gear 表：GEAR[b] 为 sha256(bytes([b])) 前 8 字节的大端整数，客户端可以直接算出同一张表
+GEAR = tuple(int.from_bytes(hashlib.sha256(bytes([i])).digest()[:8], 'big') for i in range(256))
+_HASH_MASK = (1 << 64) - 1
+# 取哈希的高位判断切点：第 k 位只受最近 k+1 个字节影响，高位对应更长的窗口。
+# 块长不足 CHUNK_AVG 时用更多位（更难切），超过后用更少位，块大小集中在平均值附近
+MASK_BITS_SMALL = 18
+MASK_BITS_LARGE = 14
+_MASK_SMALL = ((1 << MASK_BITS_SMALL) - 1) << (64 - MASK_BITS_SMALL)
+_MASK_LARGE = ((1 << MASK_BITS_LARGE) - 1) << (64 - MASK_BITS_LARGE)
+
+BLOCK_PREFIX = '.versions'
+# 提交时一次查询的块数，避免 IN 列表过长
+_QUERY_BATCH = 500
+
+_Unlink = namedtuple('_Unlink', 'id filepath file_size')
+_BLOCK_HASH = re.compile(r'[0-9a-f]{64}')
+
+
+class VersionError(Exception):
+    """无法创建版本，missing 为服务器缺少的块"""
+
+    def __init__(self, message, missing=None):
+        super().__init__(message)
+        self.missing = missing or []
+
+
+def chunking_parameters():
+    """客户端切块需要的参数"""
+    return {
+        'algorithm': 'gear',
+        'min_size': CHUNK_MIN,
+        'avg_size': CHUNK_AVG,
+        'max_size': CHUNK_MAX,
+        'gear': 'sha256(byte)[:8] big-endian',
+        'hash_update': 'h = ((h << 1) + gear[byte]) mod 2^64',
+        'mask_bits_small': MASK_BITS_SMALL,
+        'mask_bits_large': MASK_BITS_LARGE,
+        'block_hash': 'sha256',
+    }
+
+
+def find_boundary(buf, start, end):
+    """返回从 start 开始的块的结束位置；end 之后还有数据时调用方需保证 end - start >= CHUNK_MAX"""
+    length = end - start
+    if length <= CHUNK_MIN:
+        return end
+    length = min(length, CHUNK_MAX)
+    normal = min(length, CHUNK_AVG)
+    gear = GEAR
+    h = 0
+    i = start + CHUNK_MIN
+    # 前 CHUNK_MIN 字节不可能成为切点，直接跳过
+    for b in buf[i:start + normal]:
+        h = ((h << 1) + gear[b]) & _HASH_MASK
+        i += 1
+        if not h & _MASK_SMALL:
+            return i
+    for b in buf[i:start + length]:
+        h = ((h << 1) + gear[b]) & _HASH_MASK
+        i += 1
+        if not h & _MASK_LARGE:
+            return i
+    return start + length
+
+
+def iter_blocks(stream, read_size=4 * CHUNK_MAX):
+    """从流中按内容定义的边界切出数据块"""
+    buf = b''
+    pos = 0
+    eof = False
+    while True:
+        while not eof and len(buf) - pos < CHUNK_MAX:
+            data = stream.read(read_size)
+            if not data:
+                eof = True
+            else:
+                buf = buf[pos:] + data
+                pos = 0
+        if pos >= len(buf):
+            return
+        cut = find_boundary(buf, pos, len(buf))
+        yield buf[pos:cut]
+        pos = cut
+
+
+def is_block_hash(value):
+    return isinstance(value, str) and _BLOCK_HASH.fullmatch(value) is not None
+
+
+def block_key(file_id, block_hash):
+    return f'{BLOCK_PREFIX}/{file_id}/{block_hash[:2]}/{block_hash}'
+
+
+def _block_sizes(file_id, hashes):
+    sizes = {}
+    unique = list(dict.fromkeys(hashes))
+    for i in range(0, len(unique), _QUERY_BATCH):
+        sizes.update(db.session.query(FileBlock.block_hash, FileBlock.size).filter(
+            FileBlock.file_id == file_id, FileBlock.block_hash.in_(unique[i:i + _QUERY_BATCH])))
+    return sizes
+
+
+def missing_blocks(file_id, hashes):
+    """返回 hashes 中服务器还没有的块，保持顺序、去重"""
+    sizes = _block_sizes(file_id, hashes)
+    return [block_hash for block_hash in dict.fromkeys(hashes) if block_hash not in sizes]
+
+
+def _record_blocks(file_id, blocks):
+    """登记已写入存储的块 [(哈希, 大小)] 并提交；同一块被并发上传时跳过已登记的"""
+    db.session.add_all(FileBlock(file_id=file_id, block_hash=block_hash, size=size) for block_hash, size in blocks)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        existing = _block_sizes(file_id, [block_hash for block_hash, _ in blocks])
+        db.session.add_all(FileBlock(file_id=file_id, block_hash=block_hash, size=size)
+                           for block_hash, size in blocks if block_hash not in existing)
+        db.session.commit()
+
+
+def store_block(storage, file_id, data, block_hash=None):
+    """保存客户端上传的一个块，给出 block_hash 时校验内容；返回块的哈希"""
+    if len(data) > CHUNK_MAX:
+        raise VersionError(f'数据块超过 {CHUNK_MAX} 字节')
+    actual = hashlib.sha256(data).hexdigest()
+    if block_hash is not None and actual != block_hash.lower():
+        raise VersionError('数据块内容与哈希不一致')
+    if db.session.get(FileBlock, (file_id, actual)) is None:
+        storage.save(block_key(file_id, actual), io.BytesIO(data), len(data))
+        _record_blocks(file_id, [(actual, len(data))])
+    return actual
+
+
+def _store_stream(storage, file_id, stream, batch_size=256):
+    """把整个流切块保存，新块按批登记；返回 (块哈希列表, 总字节数, SHA-256)"""
+    hashes = []
+    size = 0
+    digest = hashlib.sha256()
+    seen = set()
+    pending = []
+    for data in iter_blocks(stream):
+        block_hash = hashlib.sha256(data).hexdigest()
+        if block_hash not in seen and db.session.get(FileBlock, (file_id, block_hash)) is None:
+            storage.save(block_key(file_id, block_hash), io.BytesIO(data), len(data))
+            pending.append((block_hash, len(data)))
+            if len(pending) >= batch_size:
+                _record_blocks(file_id, pending)
+                pending = []
+        seen.add(block_hash)
+        hashes.append(block_hash)
+        size += len(data)
+        digest.update(data)
+    if pending:
+        _record_blocks(file_id, pending)
+    return hashes, size, digest.hexdigest()
+
+
+def _latest(file_id):
+    return FileVersion.query.filter_by(file_id=file_id).order_by(FileVersion.version.desc()).first()
+
+
+def _add_version(file_id, version, hashes, sizes, file_hash, user_id, comment):
+    """写入版本及其块列表，不提交事务"""
+    new_version = FileVersion(file_id=file_id, version=version, file_size=sum(sizes[h] for h in hashes),
+                              file_hash=file_hash, blocks_count=len(hashes), comment=comment,
+                              created_by=user_id)
+    db.session.add(new_version)
+    db.session.flush()
+    rows = []
+    offset = 0
+    for seq, block_hash in enumerate(hashes):
+        rows.append({'version_id': new_version.id, 'seq': seq, 'block_hash': block_hash, 'offset': offset})
+        offset += sizes[block_hash]
+    if rows:
+        db.session.execute(FileVersionBlock.__table__.insert(), rows)
+    return new_version
+
+
+def _check_size(size):
+    limit = current_app.config.get('FILE_VERSIONS_MAX_SIZE')
+    if limit is not None and size > limit:
+        raise VersionError(f'超过 {limit // (1024*1024)}MB 的文件不支持版本')
+
+
+def ensure_base_version(storage, file):
+    """文件还没有版本时，把当前内容切块保存为版本 1，之后的版本可以与之共享块"""
+    if _latest(file.id) is not None:
+        return
+    _check_size(file.get_size())
+    with closing(open_file(file)) as stream:
+        hashes, _, file_hash = _store_stream(storage, file.id, stream)
+    sizes = _block_sizes(file.id, hashes)
+    _add_version(file.id, 1, hashes, sizes, file_hash, file.user_id, None)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # 其他请求已经创建了版本 1
+        db.session.rollback()
+
+
+def create_version(storage, file, hashes, user_id, expected_hash=None, comment=None):
+    """用已上传的块创建新版本，并把它写为文件的当前内容；块缺失时抛出 VersionError"""
+    ensure_base_version(storage, file)
+    hashes = [block_hash.lower() for block_hash in hashes]
+    sizes = _block_sizes(file.id, hashes)
+    missing = [block_hash for block_hash in dict.fromkeys(hashes) if block_hash not in sizes]
+    if missing:
+        raise VersionError('缺少数据块', missing)
+    size = sum(sizes[block_hash] for block_hash in hashes)
+    _check_size(size)
+    owner = db.session.get(User, file.user_id)
+    if size > owner.max_file_size:
+        raise VersionError(f'文件大小超过限制 ({owner.max_file_size // (1024*1024)}MB)')
+
+    # 按块顺序写出完整的当前版本，同时计算整个文件的哈希
+    new_key = storage.new_key(file.original_filename)
+    writer = storage.writer(new_key)
+    digest = hashlib.sha256()
+    try:
+        for block_hash in hashes:
+            for data in storage.iter_range(block_key(file.id, block_hash)):
+                digest.update(data)
+                writer.write(data)
+    except FileNotFoundError:
+        writer.abort()
+        raise VersionError('数据块已被清理，请重新上传', [block_hash])
+    except BaseException:
+        writer.abort()
+        raise
+    file_hash = digest.hexdigest()
+    if expected_hash and expected_hash.lower() != file_hash:
+        writer.abort()
+        raise VersionError('文件哈希不一致')
+    writer.commit()
+
+    try:
+        latest = _latest(file.id)
+        new_version = _add_version(file.id, latest.version + 1, hashes, sizes, file_hash, user_id, comment)
+        # 配额按文件所有者的当前版本大小计算，历史版本的块不计入
+        delta = size - (file.file_size or 0)
+        quota.charge(file.user_id, delta, files=0, enforce=delta > 0)
+        before = stats.entry(file)
+        # 旧的完整文件延迟删除，让正在进行的下载读完
+        enqueue_unlink([_Unlink(file.id, file.filepath, file.file_size)], delay=600)
+        file.filepath = storage.filepath_for(new_key)
+        file.filename = new_key.rsplit('/', 1)[-1]
+        file.file_size = size
+        file.file_hash = file_hash
+        file.codec = None
+        file.compressed_size = None
+        file.storage_issue = None
+        # 刚修改过的文件不是冷数据
+        file.last_accessed_at = datetime.utcnow()
+        stats.replace_file(before, file)
+        # 列表中显示大小，需要重新渲染
+        bump_listing_version([file.user_id], public=file.is_public)
+        # 内容已变化，元数据由后台重新提取
+        metadata.remove([file.id])
+        prune_versions(storage, file.id, current_app.config['FILE_VERSIONS_KEEP'])
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        storage.delete(new_key)
+        raise VersionError('文件已被其他人更新，请刷新后重试')
+    except BaseException:
+        db.session.rollback()
+        storage.delete(new_key)
+        raise
+    metadata.metadata_extractor.wakeup()
+    return new_version
+
+
+def create_version_from_stream(storage, file, stream, user_id, comment=None):
+    """由完整内容创建新版本（客户端不切块时），服务器切块后只保存新出现的块"""
+    ensure_base_version(storage, file)
+    hashes, _, file_hash = _store_stream(storage, file.id, stream)
+    return create_version(storage, file, hashes, user_id, file_hash, comment)
+
+
+def prune_versions(storage, file_id, keep, now=None):
+    """只保留最近 keep 个版本，并清理不再被引用的块；不提交事务。
+    被删除版本用过的块立即清理；从未被引用的块可能属于进行中的上传，超过上传任务有效期后才清理"""
+    now = now or datetime.utcnow()
+    old_ids = [version_id for (version_id,) in db.session.query(FileVersion.id).filter(
+        FileVersion.file_id == file_id).order_by(FileVersion.version.desc()).offset(keep)]
+    released = set()
+    if old_ids:
+        released = {block_hash for (block_hash,) in db.session.query(FileVersionBlock.block_hash).filter(
+            FileVersionBlock.version_id.in_(old_ids)).distinct()}
+        db.session.execute(db.delete(FileVersionBlock).where(FileVersionBlock.version_id.in_(old_ids)))
+        db.session.execute(db.delete(FileVersion).where(FileVersion.id.in_(old_ids)))
+
+    cutoff = now - timedelta(hours=current_app.config['UPLOAD_TASK_TTL_HOURS'])
+    referenced = {block_hash for (block_hash,) in db.session.query(FileVersionBlock.block_hash).join(
+        FileVersion, FileVersion.id == FileVersionBlock.version_id
+    ).filter(FileVersion.file_id == file_id).distinct()}
+    unused = [row for row in db.session.query(FileBlock.block_hash, FileBlock.size, FileBlock.created_at).filter(
+        FileBlock.file_id == file_id)
+        if row.block_hash not in referenced and (row.block_hash in released or row.created_at < cutoff)]
+    if unused:
+        enqueue_unlink([_Unlink(file_id, storage.filepath_for(block_key(file_id, row.block_hash)), row.size)
+                        for row in unused], delay=600)
+        hashes = [row.block_hash for row in unused]
+        for i in range(0, len(hashes), _QUERY_BATCH):
+            db.session.execute(db.delete(FileBlock).where(
+                FileBlock.file_id == file_id, FileBlock.block_hash.in_(hashes[i:i + _QUERY_BATCH])))
+
+
+def purge_versions(storage, file_ids):
+    """删除文件时一并删除其所有版本，块交给删除队列；不提交事务"""
+    file_ids = list(file_ids)
+    blocks = db.session.query(FileBlock.file_id, FileBlock.block_hash, FileBlock.size).filter(
+        FileBlock.file_id.in_(file_ids)).all()
+    if blocks:
+        enqueue_unlink([_Unlink(row.file_id, storage.filepath_for(block_key(row.file_id, row.block_hash)), row.size)
+                        for row in blocks])
+        db.session.execute(db.delete(FileBlock).where(FileBlock.file_id.in_(file_ids)))
+    version_ids = db.select(FileVersion.id).where(FileVersion.file_id.in_(file_ids))
+    db.session.execute(db.delete(FileVersionBlock).where(FileVersionBlock.version_id.in_(version_ids)))
+    db.session.execute(db.delete(FileVersion).where(FileVersion.file_id.in_(file_ids)))
+
+
+def _iter_version(storage, file_id, blocks, start, end):
+    """按块顺序产出版本中 [start, end) 范围的字节，blocks 为 (块哈希, 起始偏移, 大小)"""
+    for block_hash, offset, size in blocks:
+        if offset + size <= start:
+            continue
+        if offset >= end:
+            break
+        yield from storage.iter_range(block_key(file_id, block_hash), max(start - offset, 0),
+                                      min(end - offset, size), CHUNK_SIZE)
+
+
+def send_version(storage, file, version, download_name=None):
+    """流式返回某个版本的内容，支持 Range 和 If-None-Match"""
+    etag = version.file_hash
+    if etag and request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    size = version.file_size
+    start, end, status = 0, size, 200
+    if request.range and request.range.units == 'bytes':
+        byte_range = request.range.range_for_length(size)
+        if byte_range is None:
+            response = Response(status=416)
+            response.headers['Content-Range'] = f'bytes */{size}'
+            return response
+        start, end = byte_range
+        status = 206
+
+    # 块列表在请求上下文内查出，生成器只读存储
+    query = db.session.query(FileVersionBlock.block_hash, FileVersionBlock.offset, FileBlock.size).join(
+        FileBlock, db.and_(FileBlock.file_id == file.id, FileBlock.block_hash == FileVersionBlock.block_hash)
+    ).filter(FileVersionBlock.version_id == version.id, FileVersionBlock.offset + FileBlock.size > start)
+    if end < size:
+        query = query.filter(FileVersionBlock.offset < end)
+    blocks = query.order_by(FileVersionBlock.seq).all()
+
+    mimetype = mimetypes.guess_type(file.original_filename)[0] or 'application/octet-stream'
+    response = Response(_iter_version(storage, file.id, blocks, start, end), status=status, mimetype=mimetype,
+                        direct_passthrough=True)
+    response.content_length = end - start
+    response.headers['Accept-Ranges'] = 'bytes'
+    if status == 206:
+        response.headers['Content-Range'] = f'bytes {start}-{end - 1}/{size}'
+    if etag:
+        response.set_etag(etag)
+    if download_name:
+        response.headers['Content-Disposition'] = content_disposition(download_name, as_attachment=True)
+    return response
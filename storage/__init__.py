@@ -0,0 +1,49 @@
+"""
+存储后端
+所有文件读写都通过 get_storage() 返回的后端进行。
+后端以“键”定位对象，键是相对于存储根目录、以 / 分隔的路径；
+File.filepath 仍保存为 UPLOAD_FOLDER/键 的形式，由 key_from_filepath() 换算
+"""
+
+import os
+
+from flask import current_app
+
+from storage.base import StorageBackend, StorageError, UploadLocked
+from storage.local import LocalStorage
+
+
+def init_app(app):
+    app.config.setdefault('STORAGE_BACKEND', 'local')
+    app.config.setdefault('STORAGE_SHARD_DEPTH', 2)
+    backend = app.config['STORAGE_BACKEND']
+
+    if backend == 'local':
+        storage = LocalStorage(app.config['UPLOAD_FOLDER'], shard_depth=app.config['STORAGE_SHARD_DEPTH'])
+    elif backend == 's3':
+        from storage.s3 import S3Storage
+        storage = S3Storage(
+            bucket=app.config['S3_BUCKET'],
+            prefix=app.config.get('S3_PREFIX', ''),
+            path_prefix=app.config['UPLOAD_FOLDER'],
+            endpoint_url=app.config.get('S3_ENDPOINT_URL'),
+            region_name=app.config.get('S3_REGION'),
+            access_key=app.config.get('S3_ACCESS_KEY'),
+            secret_key=app.config.get('S3_SECRET_KEY'),
+            presigned_downloads=app.config.get('S3_PRESIGNED_DOWNLOADS', True),
+            shard_depth=app.config['STORAGE_SHARD_DEPTH'],
+        )
+    else:
+        raise ValueError(f'未知的存储后端: {backend}')
+
+    storage.append_dir = os.path.join(app.instance_path, 'tus')
+    app.extensions['storage'] = storage
+    return storage
+
+
+def get_storage(app=None):
+    """返回当前应用的存储后端"""
+    return (app or current_app).extensions['storage']
+
+
+__all__ = ['StorageBackend', 'StorageError', 'UploadLocked', 'LocalStorage', 'init_app', 'get_storage']
@@ -0,0 +1,289 @@
+"""
+存储后端接口
+"""
+
+import hashlib
+import io
+import mimetypes
+import os
+import posixpath
+import tempfile
+import unicodedata
+import uuid
+from urllib.parse import quote
+
+from flask import Response, request
+from werkzeug.utils import secure_filename
+
+try:
+    import fcntl
+except ImportError:  # Windows 下没有 fcntl，改用 msvcrt 的字节锁
+    fcntl = None
+    try:
+        import msvcrt
+    except ImportError:
+        msvcrt = None
+
+# 流式读写的默认块大小
+CHUNK_SIZE = 1024 * 1024
+
+# 以点开头的顶层目录（如 .quarantine）和分块临时目录不属于文件键空间
+TEMP_PREFIX = 'temp'
+
+
+class StorageError(Exception):
+    """存储后端操作失败"""
+
+
+class UploadLocked(StorageError):
+    """追加上传的暂存文件正被另一个请求写入"""
+
+
+class StorageBackend:
+    """存储后端基类，子类实现具体的读写"""
+
+    # 分块上传时每块的最小字节数（最后一块除外），S3 要求至少 5MB
+    min_part_size = 0
+
+    def __init__(self, path_prefix='uploads', shard_depth=2):
+        self.path_prefix = path_prefix
+        self.shard_depth = shard_depth
+        # 追加上传（tus）的暂存目录，由 init_app 设置为实例目录下的 tus
+        self.append_dir = os.path.join(tempfile.gettempdir(), 'fileshare-append')
+
+    # ---- 键与 File.filepath 的换算 ----
+
+    def new_key(self, filename):
+        """为新上传的文件生成存储键"""
+        return self.shard_key(str(uuid.uuid4()) + '_' + secure_filename(filename))
+
+    def shard_key(self, name):
+        """按名称哈希分散到多级子目录，例如 ab/cd/<name>，避免单个目录中文件过多"""
+        digest = hashlib.md5(name.encode('utf-8')).hexdigest()
+        levels = [digest[i * 2:i * 2 + 2] for i in range(self.shard_depth)]
+        return '/'.join(levels + [name])
+
+    def filepath_for(self, key):
+        """由存储键得到保存在 File.filepath 中的路径"""
+        return os.path.join(self.path_prefix, *key.split('/'))
+
+    def key_from_filepath(self, filepath):
+        """由 File.filepath 得到存储键"""
+        relpath = os.path.relpath(filepath, self.path_prefix)
+        if relpath.startswith(os.pardir):
+            relpath = os.path.basename(filepath)
+        return relpath.replace(os.sep, '/')
+
+    @staticmethod
+    def check_key(key):
+        """拒绝会逃出存储根目录的键"""
+        normalized = posixpath.normpath(key)
+        if not key or normalized.startswith('../') or normalized == '..' or posixpath.isabs(normalized):
+            raise StorageError(f'非法的存储键: {key}')
+        return normalized
+
+    # ---- 子类实现 ----
+
+    def writer(self, key):
+        """返回按顺序写入 key 的对象，commit() 后内容才可见，abort() 丢弃已写入的数据"""
+        return MultipartWriter(self, key)
+
+    def save(self, key, stream, length=None):
+        """从可读流写入对象，返回写入的字节数"""
+        raise NotImplementedError
+
+    def open(self, key):
+        """以二进制只读流打开对象"""
+        raise NotImplementedError
+
+    def iter_range(self, key, start=0, end=None, chunk_size=CHUNK_SIZE):
+        """按块产出 [start, end) 范围内的字节，end 为 None 表示读到末尾"""
+        raise NotImplementedError
+
+    def size(self, key):
+        """返回对象字节数，对象不存在时抛出 FileNotFoundError"""
+        raise NotImplementedError
+
+    def modified_time(self, key):
+        """对象最后修改时间（Unix 时间戳），对象不存在时抛出 FileNotFoundError"""
+        raise NotImplementedError
+
+    def exists(self, key):
+        try:
+            self.size(key)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def delete(self, key):
+        """删除对象，对象不存在时返回 False"""
+        raise NotImplementedError
+
+    def move(self, src_key, dst_key):
+        raise NotImplementedError
+
+    def iter_keys(self, workers=8):
+        """遍历所有对象，产出 (键, 大小)，不包括分块临时数据和以点开头的目录"""
+        raise NotImplementedError
+
+    def local_path(self, key):
+        """对象在本机磁盘上的路径，非本地后端返回 None"""
+        return None
+
+    def presigned_url(self, key, expires_in=3600, download_name=None):
+        """生成可直接下载对象的临时链接，不支持时返回 None"""
+        return None
+
+    # ---- 分块上传 ----
+
+    def begin_multipart(self, key):
+        """开始分块上传，返回上传ID"""
+        raise NotImplementedError
+
+    def upload_part(self, key, upload_id, part_index, data):
+        """写入第 part_index 块（从0开始）"""
+        raise NotImplementedError
+
+    def complete_multipart(self, key, upload_id, parts_count):
+        """按顺序合并所有分块，返回最终对象字节数；分块缺失时抛出 StorageError"""
+        raise NotImplementedError
+
+    def abort_multipart(self, key, upload_id):
+        raise NotImplementedError
+
+    def list_multipart_uploads(self):
+        """列出存储中所有未完成的分块上传，产出 (键, 上传ID)，后端不记录键时键为 None"""
+        raise NotImplementedError
+
+    # ---- 追加上传：按偏移续传，数据先写入本机的暂存文件 ----
+
+    def _append_path(self, upload_id):
+        return os.path.join(self.append_dir, self.check_key(upload_id).replace('/', '_'))
+
+    def begin_append(self, key):
+        """开始追加上传，创建空的暂存文件并返回上传ID"""
+        upload_id = str(uuid.uuid4())
+        os.makedirs(self.append_dir, exist_ok=True)
+        open(self._append_path(upload_id), 'xb').close()
+        return upload_id
+
+    def open_append(self, key, upload_id):
+        """以读写方式打开暂存文件并加排他锁，已被其他请求锁定时抛出 UploadLocked，
+        上传已中止时抛出 FileNotFoundError；暂存文件总在本机磁盘上，返回的是普通文件对象"""
+        f = open(self._append_path(upload_id), 'r+b')
+        try:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            elif msvcrt is not None:
+                # 锁住第一个字节，关闭文件时释放
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            f.close()
+            raise UploadLocked('上传正在被其他请求写入')
+        return f
+
+    def appended_size(self, key, upload_id):
+        """暂存文件当前的字节数，即下一次追加的偏移"""
+        return os.path.getsize(self._append_path(upload_id))
+
+    def complete_append(self, key, upload_id):
+        """把暂存文件写入 key，返回最终对象字节数"""
+        path = self._append_path(upload_id)
+        with open(path, 'rb') as f:
+            size = self.save(key, f, os.fstat(f.fileno()).st_size)
+        os.remove(path)
+        return size
+
+    def abort_append(self, key, upload_id):
+        try:
+            os.remove(self._append_path(upload_id))
+        except FileNotFoundError:
+            pass
+
+    # ---- HTTP 响应 ----
+
+    def send(self, key, download_name=None, as_attachment=False, mimetype=None, etag=None):
+        """返回对象内容的流式响应，支持 Range 请求；给出 etag（如内容哈希）时支持 If-None-Match"""
+        if etag and request.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+        size = self.size(key)
+        if mimetype is None:
+            mimetype = mimetypes.guess_type(download_name or key)[0] or 'application/octet-stream'
+
+        start, end, status = 0, size, 200
+        if request.range and request.range.units == 'bytes':
+            byte_range = request.range.range_for_length(size)
+            if byte_range is None:
+                response = Response(status=416)
+                response.headers['Content-Range'] = f'bytes */{size}'
+                return response
+            start, end = byte_range
+            status = 206
+
+        response = Response(self.iter_range(key, start, end), status=status, mimetype=mimetype,
+                            direct_passthrough=True)
+        response.content_length = end - start
+        response.headers['Accept-Ranges'] = 'bytes'
+        if status == 206:
+            response.headers['Content-Range'] = f'bytes {start}-{end - 1}/{size}'
+        if etag:
+            response.set_etag(etag)
+        if download_name:
+            response.headers['Content-Disposition'] = content_disposition(download_name, as_attachment)
+        return response
+
+
+class MultipartWriter:
+    """通过分块上传接口流式写入对象，内存中最多缓存一块；数据不足一块时改为一次 save"""
+
+    def __init__(self, storage, key, part_size=8 * 1024 * 1024):
+        self.storage = storage
+        self.key = key
+        self.part_size = max(part_size, storage.min_part_size)
+        self.size = 0
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = 0
+
+    def write(self, data):
+        self._buffer += data
+        self.size += len(data)
+        while len(self._buffer) >= self.part_size:
+            self._flush_part(self.part_size)
+        return len(data)
+
+    def _flush_part(self, length):
+        if self._upload_id is None:
+            self._upload_id = self.storage.begin_multipart(self.key)
+        self.storage.upload_part(self.key, self._upload_id, self._parts, bytes(self._buffer[:length]))
+        del self._buffer[:length]
+        self._parts += 1
+
+    def commit(self):
+        if self._upload_id is None:
+            self.storage.save(self.key, io.BytesIO(self._buffer), len(self._buffer))
+        else:
+            if self._buffer:
+                self._flush_part(len(self._buffer))
+            self.storage.complete_multipart(self.key, self._upload_id, self._parts)
+        self._buffer = bytearray()
+
+    def abort(self):
+        self._buffer = bytearray()
+        if self._upload_id is not None:
+            self.storage.abort_multipart(self.key, self._upload_id)
+            self._upload_id = None
+
+
+def content_disposition(download_name, as_attachment=True):
+    """生成 Content-Disposition 头，非 ASCII 文件名按 RFC 5987 编码"""
+    disposition = 'attachment' if as_attachment else 'inline'
+    try:
+        download_name.encode('ascii')
+    except UnicodeEncodeError:
+        fallback = unicodedata.normalize('NFKD', download_name).encode('ascii', 'ignore').decode('ascii')
+        fallback = fallback.replace('"', '') or 'download'
+        return f'{disposition}; filename="{fallback}"; filename*=UTF-8\'\'{quote(download_name, safe="")}'
+    return f'{disposition}; filename="{download_name.replace(chr(34), "")}"'
@@ -0,0 +1,273 @@
+"""
+本地磁盘存储后端
+"""
+
+import os
+import queue
+import shutil
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import send_file
+
+from storage.base import CHUNK_SIZE, TEMP_PREFIX, StorageBackend, StorageError
+
+# 并行遍历时扫描线程与消费者之间的队列长度，决定最多缓存多少条目
+_WALK_QUEUE_SIZE = 10000
+_DIR_DONE = object()
+
+
+class LocalStorage(StorageBackend):
+    """文件保存在 root 目录下，键中的 / 对应子目录"""
+
+    def __init__(self, root, shard_depth=2):
+        super().__init__(path_prefix=root, shard_depth=shard_depth)
+        self.root = root
+
+    def _path(self, key):
+        return os.path.join(self.root, *self.check_key(key).split('/'))
+
+    def _resolve(self, key):
+        """读取时使用的路径：旧的平铺文件在迁移到分级目录后，仍可通过原来的键读到"""
+        path = self._path(key)
+        if '/' not in key and self.shard_depth and not os.path.exists(path):
+            sharded = self._path(self.shard_key(key))
+            if os.path.exists(sharded):
+                return sharded
+        return path
+
+    def _part_dir(self, upload_id):
+        return os.path.join(self.root, TEMP_PREFIX, self.check_key(upload_id))
+
+    def local_path(self, key):
+        return self._resolve(key)
+
+    def writer(self, key):
+        return _LocalWriter(self._path(key))
+
+    def save(self, key, stream, length=None):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 先写临时文件再改名，避免读到写了一半的文件
+        tmp_path = f'{path}.{uuid.uuid4().hex}.part'
+        try:
+            with open(tmp_path, 'wb') as f:
+                shutil.copyfileobj(stream, f, CHUNK_SIZE)
+                size = f.tell()
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return size
+
+    def open(self, key):
+        return open(self._resolve(key), 'rb')
+
+    def iter_range(self, key, start=0, end=None, chunk_size=CHUNK_SIZE):
+        with self.open(key) as f:
+            f.seek(start)
+            remaining = None if end is None else end - start
+            while remaining is None or remaining > 0:
+                data = f.read(chunk_size if remaining is None else min(chunk_size, remaining))
+                if not data:
+                    break
+                if remaining is not None:
+                    remaining -= len(data)
+                yield data
+
+    def size(self, key):
+        return os.path.getsize(self._resolve(key))
+
+    def modified_time(self, key):
+        return os.path.getmtime(self._resolve(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self._resolve(key))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def move(self, src_key, dst_key):
+        dst = self._path(dst_key)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        shutil.move(self._resolve(src_key), dst)
+
+    def reshard(self, key):
+        """把平铺的旧文件移动到分级目录，返回新键；文件已被移动过时直接返回新键"""
+        new_key = self.shard_key(key)
+        src = self._path(key)
+        dst = self._path(new_key)
+        if os.path.exists(src):
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            os.replace(src, dst)
+        elif not os.path.exists(dst):
+            raise FileNotFoundError(key)
+        return new_key
+
+    def iter_keys(self, workers=8):
+        """用线程池并行 os.scandir 各级目录，通过有界队列逐个产出，内存占用与文件总数无关"""
+        results = queue.Queue(maxsize=_WALK_QUEUE_SIZE)
+        lock = threading.Lock()
+        remaining = [1]
+        # 消费者提前停止（关闭生成器或抛出异常）时通知扫描线程退出，避免阻塞在已满的队列上
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    results.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def scan(path, prefix):
+            try:
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        if stop.is_set():
+                            return
+                        if entry.name.startswith('.') or entry.name.endswith('.part'):
+                            continue
+                        if entry.is_dir(follow_symlinks=False):
+                            if not prefix and entry.name == TEMP_PREFIX:
+                                continue
+                            with lock:
+                                remaining[0] += 1
+                            pool.submit(scan, entry.path, prefix + entry.name + '/')
+                        elif entry.is_file(follow_symlinks=False):
+                            try:
+                                size = entry.stat(follow_symlinks=False).st_size
+                            except OSError:
+                                continue
+                            put((prefix + entry.name, size))
+            except (OSError, RuntimeError):
+                # RuntimeError: 停止后线程池已关闭，不能再提交子目录
+                pass
+            finally:
+                put(_DIR_DONE)
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            try:
+                pool.submit(scan, self.root, '')
+                while True:
+                    item = results.get()
+                    if item is _DIR_DONE:
+                        with lock:
+                            remaining[0] -= 1
+                            if remaining[0] == 0:
+                                break
+                        continue
+                    yield item
+            finally:
+                stop.set()
+                # 清空队列，让阻塞在 put 上的线程尽快退出，线程池关闭时不会一直等待
+                while True:
+                    try:
+                        results.get_nowait()
+                    except queue.Empty:
+                        break
+
+    def begin_multipart(self, key):
+        upload_id = str(uuid.uuid4())
+        os.makedirs(self._part_dir(upload_id), exist_ok=True)
+        return upload_id
+
+    def upload_part(self, key, upload_id, part_index, data):
+        part_dir = self._part_dir(upload_id)
+        os.makedirs(part_dir, exist_ok=True)
+        with open(os.path.join(part_dir, f'chunk_{part_index:06d}'), 'wb') as f:
+            f.write(data)
+
+    def complete_multipart(self, key, upload_id, parts_count):
+        part_dir = self._part_dir(upload_id)
+        if not os.path.isdir(part_dir):
+            raise StorageError('分块文件已丢失，请重新上传文件')
+
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{uuid.uuid4().hex}.part'
+        try:
+            with open(tmp_path, 'wb') as final_file:
+                for i in range(parts_count):
+                    chunk_path = os.path.join(part_dir, f'chunk_{i:06d}')
+                    if not os.path.exists(chunk_path):
+                        raise StorageError(f'分块文件不存在: {chunk_path}')
+                    with open(chunk_path, 'rb') as chunk_file:
+                        shutil.copyfileobj(chunk_file, final_file, CHUNK_SIZE)
+                size = final_file.tell()
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        shutil.rmtree(part_dir, ignore_errors=True)
+        return size
+
+    def abort_multipart(self, key, upload_id):
+        shutil.rmtree(self._part_dir(upload_id), ignore_errors=True)
+
+    def list_multipart_uploads(self):
+        temp_root = os.path.join(self.root, TEMP_PREFIX)
+        if not os.path.isdir(temp_root):
+            return
+        with os.scandir(temp_root) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    yield None, entry.name
+
+    # 暂存文件放在 temp/<上传ID>/ 下，与最终文件在同一文件系统，完成时直接改名；
+    # 进行中的任务持有该目录，一致性检查按分块上传同样处理
+
+    def _append_path(self, upload_id):
+        return os.path.join(self._part_dir(upload_id), 'append')
+
+    def begin_append(self, key):
+        upload_id = self.begin_multipart(key)
+        open(self._append_path(upload_id), 'xb').close()
+        return upload_id
+
+    def complete_append(self, key, upload_id):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        staged = self._append_path(upload_id)
+        size = os.path.getsize(staged)
+        os.replace(staged, path)
+        shutil.rmtree(self._part_dir(upload_id), ignore_errors=True)
+        return size
+
+    def abort_append(self, key, upload_id):
+        self.abort_multipart(key, upload_id)
+
+    def send(self, key, download_name=None, as_attachment=False, mimetype=None, etag=None):
+        # 本地文件交给 send_file，可以利用 wsgi.file_wrapper/sendfile 并自动处理 Range 和条件请求
+        return send_file(os.path.abspath(self._resolve(key)), mimetype=mimetype, as_attachment=as_attachment,
+                         download_name=download_name, conditional=True, etag=etag or True)
+
+
+class _LocalWriter:
+    """写入目标目录下的临时文件，commit() 时改名为最终文件，不再复制一次"""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.size = 0
+        self._tmp_path = f'{path}.{uuid.uuid4().hex}.part'
+        self._file = open(self._tmp_path, 'wb')
+
+    def write(self, data):
+        self._file.write(data)
+        self.size += len(data)
+        return len(data)
+
+    def commit(self):
+        self._file.close()
+        os.replace(self._tmp_path, self.path)
+
+    def abort(self):
+        self._file.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
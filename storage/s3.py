@@ -0,0 +1,181 @@
+"""
+S3 兼容对象存储后端（AWS S3、MinIO 等）
+需要安装 boto3
+"""
+
+import posixpath
+
+from flask import redirect
+
+from storage.base import CHUNK_SIZE, TEMP_PREFIX, StorageBackend, StorageError, content_disposition
+
+
+class S3Storage(StorageBackend):
+    """对象保存在 bucket 的 prefix 下，分块上传直接使用 S3 multipart upload"""
+
+    # S3 multipart upload 除最后一块外每块至少 5MB
+    min_part_size = 5 * 1024 * 1024
+
+    def __init__(self, bucket, prefix='', path_prefix='uploads', endpoint_url=None, region_name=None,
+                 access_key=None, secret_key=None, presigned_downloads=True, shard_depth=2):
+        try:
+            import boto3
+            from botocore.config import Config as BotoConfig
+        except ImportError:
+            raise StorageError('使用 S3 存储后端需要安装 boto3')
+
+        super().__init__(path_prefix=path_prefix, shard_depth=shard_depth)
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self.presigned_downloads = presigned_downloads
+        # boto3 client 是线程安全的，整个进程共用一个
+        self.client = boto3.client(
+            's3',
+            endpoint_url=endpoint_url,
+            region_name=region_name,
+            aws_access_key_id=access_key,
+            aws_secret_access_key=secret_key,
+            config=BotoConfig(signature_version='s3v4', max_pool_connections=50),
+        )
+
+    def _object_key(self, key):
+        key = self.check_key(key)
+        return posixpath.join(self.prefix, key) if self.prefix else key
+
+    def _is_not_found(self, error):
+        return error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+    def save(self, key, stream, length=None):
+        # upload_fileobj 会按需自动切换为 multipart upload，不会把整个文件读入内存
+        counter = _CountingReader(stream)
+        self.client.upload_fileobj(counter, self.bucket, self._object_key(key))
+        return counter.count
+
+    def open(self, key):
+        from botocore.exceptions import ClientError
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self._object_key(key))['Body']
+        except ClientError as e:
+            if self._is_not_found(e):
+                raise FileNotFoundError(key)
+            raise
+
+    def iter_range(self, key, start=0, end=None, chunk_size=CHUNK_SIZE):
+        from botocore.exceptions import ClientError
+        if end is not None and end <= start:
+            return
+        byte_range = f'bytes={start}-' + ('' if end is None else str(end - 1))
+        try:
+            body = self.client.get_object(Bucket=self.bucket, Key=self._object_key(key), Range=byte_range)['Body']
+        except ClientError as e:
+            if self._is_not_found(e):
+                raise FileNotFoundError(key)
+            raise
+        try:
+            for data in body.iter_chunks(chunk_size):
+                yield data
+        finally:
+            body.close()
+
+    def size(self, key):
+        from botocore.exceptions import ClientError
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self._object_key(key))['ContentLength']
+        except ClientError as e:
+            if self._is_not_found(e):
+                raise FileNotFoundError(key)
+            raise
+
+    def modified_time(self, key):
+        from botocore.exceptions import ClientError
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self._object_key(key))['LastModified'].timestamp()
+        except ClientError as e:
+            if self._is_not_found(e):
+                raise FileNotFoundError(key)
+            raise
+
+    def delete(self, key):
+        if not self.exists(key):
+            return False
+        self.client.delete_object(Bucket=self.bucket, Key=self._object_key(key))
+        return True
+
+    def move(self, src_key, dst_key):
+        self.client.copy({'Bucket': self.bucket, 'Key': self._object_key(src_key)},
+                         self.bucket, self._object_key(dst_key))
+        self.client.delete_object(Bucket=self.bucket, Key=self._object_key(src_key))
+
+    def iter_keys(self, workers=8):
+        prefix = self.prefix + '/' if self.prefix else ''
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                key = obj['Key'][len(prefix):]
+                top = key.split('/', 1)[0]
+                if top == TEMP_PREFIX or top.startswith('.'):
+                    continue
+                yield key, obj['Size']
+
+    def presigned_url(self, key, expires_in=3600, download_name=None):
+        params = {'Bucket': self.bucket, 'Key': self._object_key(key)}
+        if download_name:
+            params['ResponseContentDisposition'] = content_disposition(download_name, as_attachment=True)
+        return self.client.generate_presigned_url('get_object', Params=params, ExpiresIn=expires_in)
+
+    def begin_multipart(self, key):
+        return self.client.create_multipart_upload(Bucket=self.bucket, Key=self._object_key(key))['UploadId']
+
+    def upload_part(self, key, upload_id, part_index, data):
+        self.client.upload_part(Bucket=self.bucket, Key=self._object_key(key), UploadId=upload_id,
+                                PartNumber=part_index + 1, Body=data)
+
+    def complete_multipart(self, key, upload_id, parts_count):
+        from botocore.exceptions import ClientError
+        object_key = self._object_key(key)
+        parts = []
+        try:
+            paginator = self.client.get_paginator('list_parts')
+            for page in paginator.paginate(Bucket=self.bucket, Key=object_key, UploadId=upload_id):
+                parts.extend({'PartNumber': p['PartNumber'], 'ETag': p['ETag']} for p in page.get('Parts', []))
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') == 'NoSuchUpload':
+                raise StorageError('分块文件已丢失，请重新上传文件')
+            raise
+        if len(parts) != parts_count:
+            raise StorageError(f'分块不完整，存储中只有 {len(parts)}/{parts_count} 块')
+
+        parts.sort(key=lambda p: p['PartNumber'])
+        self.client.complete_multipart_upload(Bucket=self.bucket, Key=object_key, UploadId=upload_id,
+                                              MultipartUpload={'Parts': parts})
+        return self.size(key)
+
+    def abort_multipart(self, key, upload_id):
+        self.client.abort_multipart_upload(Bucket=self.bucket, Key=self._object_key(key), UploadId=upload_id)
+
+    def list_multipart_uploads(self):
+        prefix = self.prefix + '/' if self.prefix else ''
+        paginator = self.client.get_paginator('list_multipart_uploads')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            for upload in page.get('Uploads', []):
+                yield upload['Key'][len(prefix):], upload['UploadId']
+
+    def send(self, key, download_name=None, as_attachment=False, mimetype=None, etag=None):
+        # 下载直接重定向到预签名链接，由对象存储承担传输
+        if as_attachment and self.presigned_downloads:
+            return redirect(self.presigned_url(key, download_name=download_name))
+        return super().send(key, download_name=download_name, as_attachment=as_attachment, mimetype=mimetype,
+                            etag=etag)
+
+
+class _CountingReader:
+    """包装可读流，统计读取的字节数"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.count = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.count += len(data)
+        return data